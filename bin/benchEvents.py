@@ -0,0 +1,225 @@
+#! /usr/bin/env python
+
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+#
+from __future__ import with_statement
+import sys, os, time, socket, threading
+import optparse, traceback
+import lsst.pex.harness.run as run
+from lsst.pex.logging import Log
+from lsst.daf.base import PropertySet
+from lsst.ctrl.mospipe.StageTiming import percentile
+
+usage = """Usage: %prog [-vqsd] [-V int] [-n count] [-r rate] [-B burst] [-k visit|log] [broker]"""
+
+desc = """measure the publish/receive rate and the delivery latency of
+visit events and log events.  If no broker is given, the events are sent
+through the in-process LocalEventBroker; otherwise the given ActiveMQ broker
+is used.
+"""
+
+cl = optparse.OptionParser(usage=usage, description=desc)
+run.addAllVerbosityOptions(cl, "V")
+cl.add_option("-n", "--count", action="store", type="int", default=10000,
+              dest="count", metavar="count",
+              help="number of events to send (def: 10000)")
+cl.add_option("-r", "--rate", action="store", type="float", default=0,
+              dest="rate", metavar="events/s",
+              help="target publish rate; 0 means as fast as possible (def: 0)")
+cl.add_option("-B", "--burst", action="store", type="int", default=1,
+              dest="burst", metavar="count",
+              help="publish events in bursts of this size (def: 1)")
+cl.add_option("-k", "--kind", action="append", type="choice",
+              choices=("visit", "log"), default=None, dest="kinds",
+              help="kind of events to send: visit or log (def: both)")
+cl.add_option("-t", "--topic", action="store", type="str",
+              default="mospipeBench", dest="topic", metavar="topic",
+              help="event topic name (def: mospipeBench)")
+cl.add_option("-w", "--wait-time", action="store", type="int", default=10,
+              dest="wait", metavar="seconds",
+              help="seconds to wait for stragglers after sending (def: 10)")
+
+logger = Log(Log.getDefaultLog(), "benchEvents")
+VERB = logger.INFO-2
+
+def main():
+    """execute the benchEvents script"""
+
+    try:
+        (cl.opts, cl.args) = cl.parse_args()
+        Log.getDefaultLog().setThreshold(
+            run.verbosity2threshold(cl.opts.verbosity, 0))
+
+        broker = None
+        if len(cl.args) > 0:
+            broker = cl.args[0]
+        kinds = cl.opts.kinds or ["visit", "log"]
+
+        for kind in kinds:
+            results = benchEvents(broker, kind, cl.opts.count, cl.opts.rate,
+                                  cl.opts.burst, cl.opts.topic, cl.opts.wait)
+            printResults(kind, results)
+
+    except run.UsageError, e:
+        print >> sys.stderr, "%s: %s" % (cl.get_prog_name(), e)
+        sys.exit(1)
+    except Exception, e:
+        logger.log(Log.FATAL, str(e))
+        traceback.print_exc(file=sys.stderr)
+        sys.exit(2)
+
+def getEventsModule(broker):
+    """
+    return the module providing EventTransmitter and EventReceiver:  the
+    local stand-in if broker is None, lsst.ctrl.events otherwise.
+    """
+    if broker is None:
+        import lsst.ctrl.mospipe.LocalEventBroker as events
+    else:
+        import lsst.ctrl.events as events
+    return events
+
+def makeVisitEvent(seq):
+    """
+    create an event that looks like those sent by eventFromFitsfile
+    """
+    event = PropertySet()
+    event.setInt("exposureId", 700000 + seq)
+    event.setString("datasetId", "D4")
+    event.setString("filter", "r")
+    event.setDouble("expTime", 15.0)
+    event.setDouble("ra", 5.80)
+    event.setDouble("decl", -0.31)
+    event.setDouble("equinox", 2000.0)
+    event.setDouble("airmass", 1.2)
+    event.setDouble("dateObs", 54000.0 + seq / 86400.0)
+    return event
+
+def makeLogEvent(seq):
+    """
+    create an event that looks like those sent through an EventLog
+    """
+    event = PropertySet()
+    event.setString("LOG", "harness.slice.visit.stage.process")
+    event.setInt("LEVEL", Log.DEBUG)
+    event.setString("COMMENT", "benchmark message %d" % seq)
+    event.setString("runId", "benchEvents")
+    event.setInt("sliceId", seq % 16)
+    event.setString("hostId", socket.gethostname())
+    event.setString("pipeline", "IP")
+    return event
+
+eventMakers = { "visit": makeVisitEvent, "log": makeLogEvent }
+
+def benchEvents(broker, kind, count, rate=0, burst=1, topic="mospipeBench",
+                wait=10):
+    """
+    send count events of the given kind and receive them on a separate
+    thread, timing both ends.
+    @param broker  the host running the event broker, or None to use the
+                     in-process LocalEventBroker
+    @param kind    the kind of event to send: "visit" or "log"
+    @param count   the number of events to send
+    @param rate    the target publish rate in events/s; 0 = unthrottled
+    @param burst   the number of events to publish back-to-back
+    @param topic   the event topic to use
+    @param wait    seconds to wait for outstanding events after sending
+    @return dict   the measured rates and latencies
+    """
+    events = getEventsModule(broker)
+    host = broker or "localhost"
+    makeEvent = eventMakers[kind]
+
+    rcvr = events.EventReceiver(host, topic)
+    trx = events.EventTransmitter(host, topic)
+
+    latencies = []
+    state = { "first": None, "last": None }
+    done = threading.Event()
+
+    def receiveAll():
+        while len(latencies) < count:
+            event = rcvr.receive(wait * 1000)
+            if event is None:
+                break
+            now = time.time()
+            if state["first"] is None:
+                state["first"] = now
+            state["last"] = now
+            latencies.append(now - event.getDouble("sendTime"))
+        done.set()
+
+    listener = threading.Thread(target=receiveAll)
+    listener.setDaemon(True)
+    listener.start()
+
+    logger.log(VERB, "Sending %d %s events" % (count, kind))
+    interval = 0
+    if rate > 0:
+        interval = float(burst) / rate
+    start = time.time()
+    next = start
+    for seq in xrange(count):
+        event = makeEvent(seq)
+        event.setDouble("sendTime", time.time())
+        trx.publish(event)
+        if interval and (seq + 1) % burst == 0:
+            next += interval
+            pause = next - time.time()
+            if pause > 0:
+                time.sleep(pause)
+    sent = time.time()
+
+    done.wait(wait + (sent - start))
+
+    results = { "sent": count, "received": len(latencies),
+                "publishTime": sent - start }
+    if state["first"] is not None:
+        results["receiveTime"] = state["last"] - start
+    latencies.sort()
+    results["latencies"] = latencies
+    return results
+
+def printResults(kind, results):
+    pubtime = results["publishTime"] or 1.0e-9
+    print "%s events: sent %d in %.3f s (%.1f/s)" % \
+          (kind, results["sent"], results["publishTime"],
+           results["sent"] / pubtime)
+    if results.has_key("receiveTime"):
+        rcvtime = results["receiveTime"] or 1.0e-9
+        print "%s events: received %d in %.3f s (%.1f/s)" % \
+              (kind, results["received"], results["receiveTime"],
+               results["received"] / rcvtime)
+    else:
+        print "%s events: none received" % kind
+
+    lat = results["latencies"]
+    if lat:
+        print "%s latency (ms): min=%.3f p50=%.3f p95=%.3f p99=%.3f max=%.3f" % \
+              (kind, 1000 * lat[0], 1000 * percentile(lat, 0.50),
+               1000 * percentile(lat, 0.95), 1000 * percentile(lat, 0.99),
+               1000 * lat[-1])
+
+if __name__ == "__main__":
+    main()
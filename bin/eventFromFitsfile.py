@@ -23,16 +23,18 @@
 #
 
 
-import os, sys, re, optparse, traceback
-import eups
-import lsst.afw.image as afwImage
-import lsst.afw.math as afwMath
-import lsst.pex.policy as pexPolicy
+import os, sys, re, time, optparse, traceback
+from lsst.ctrl.mospipe.LazyImport import lazyModule
 import lsst.pex.logging as pexLog
-import lsst.daf.base as dafBase
-import lsst.ctrl.events as ctrlEvents
 from lsst.pex.harness import run
-from lsst.ctrl.mospipe.MetadataStages import transformMetadata, validateMetadata
+
+# the heavy modules are only needed once an event is actually sent
+afwImage = lazyModule("lsst.afw.image")
+pexPolicy = lazyModule("lsst.pex.policy")
+dafBase = lazyModule("lsst.daf.base")
+ctrlEvents = lazyModule("lsst.ctrl.events")
+MetadataStages = lazyModule("lsst.ctrl.mospipe.MetadataStages")
+PolicyCache = lazyModule("lsst.ctrl.mospipe.PolicyCache")
 
 usage = """Usage: %prog [-dvqs] [-V lev] [-b host] [-t topic] FITSfile policyfile"""
 desc = """Send an incoming visit event to instruct the alert production to process
@@ -77,9 +79,9 @@ def main(cmdline):
         metadataPolicy = pexPolicy.Policy.createPolicy(mpf,
                                                        mpf.getRepositoryPath())
     else:
-        metadataPolicy = pexPolicy.Policy.createPolicy(mdPolicyFileName)
+        metadataPolicy = PolicyCache.loadPolicy(mdPolicyFileName)
 
-    dataPolicy = pexPolicy.Policy.createPolicy(cl.args[1])
+    dataPolicy = PolicyCache.loadPolicy(cl.args[1])
 
     if not EventFromInputfile(cl.args[0], dataPolicy, metadataPolicy,
                               cl.opts.topic, cl.opts.broker):
@@ -106,10 +108,11 @@ def EventFromInputfile(inputfile,
 #    logger.log(logger.INFO,"Original metadata:\n" + metadata.toString())
 
     # First, transform the input metdata
-    transformMetadata(metadata, datatypePolicy, metadataPolicy, 'Keyword')
+    MetadataStages.transformMetadata(metadata, datatypePolicy, metadataPolicy,
+                                     'Keyword')
 
     # To be consistent...
-    if not validateMetadata(metadata, metadataPolicy):
+    if not MetadataStages.validateMetadata(metadata, metadataPolicy):
         logger.log(logger.FATAL, 'Unable to create event from %s' % inputfile)
 
     # Create event policy, using defaults from input metadata
@@ -135,6 +138,8 @@ def EventFromInputfile(inputfile,
                   "Event data: datasetId=%s; ra=%f, dec=%f" %
                   (event.get("datasetId"), event.get("ra"), event.get("decl")))
 
+    # lets latency trackers measure from the moment the event went out
+    event.setDouble('publishTime', time.time())
     eventTransmitter.publish(event)
 
     return True
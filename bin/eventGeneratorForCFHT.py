@@ -25,17 +25,13 @@
 
 import os, sys, re, traceback
 import glob
-import imp
 import time
-import eups
-import lsst.afw.image as afwImage
-import lsst.afw.math as afwMath
-import lsst.pex.policy as pexPolicy
+from lsst.ctrl.mospipe.LazyImport import lazyModule
 import lsst.pex.logging as pexLog
-import lsst.daf.base as dafBase
-import lsst.ctrl.events as ctrlEvents
 from lsst.pex.harness import run
-from lsst.ctrl.dc3pipe.MetadataStages import transformMetadata, validateMetadata
+
+pexPolicy = lazyModule("lsst.pex.policy")
+PolicyCache = lazyModule("lsst.ctrl.mospipe.PolicyCache")
 usage = """Usage: %prog [-dvqs] [-V lev] [-b host] [-t topic] <D1|D2|D3|D4|ALL> <policy_file> [<exp time>] [<slew time>]"""
 desc = """Generate events for the IPSD (and MOPS) pipeline by extracting the relevant 
 information from the FITS files in the standard DC3 CFHT subdirectories.
@@ -57,23 +53,11 @@ and then sends an event for the second exposure. At that point, it waits
 (exptime + slewtime) seconds before passing to the next visit.
 """
 
-# Import EventFromInputfile from eventFromFitsfile.py so that we do not have to
-# re-write that one. We do not use the imputil modules since it is deprecated as
-# of Python 2.6 and removed in Python 3.0.
-# From http://docs.python.org/3.0/library/imp.html
-# Fast path: see if the module has already been imported.
-if('eventFromFitsfile' in sys.modules):
-    import eventFromFitsfile
-else:
-    thisDir = this_dir = os.path.dirname(os.path.realpath(__file__))
-    fp, pathname, description = imp.find_module('eventFromFitsfile', [thisDir,])
-try:
-    eventFromFitsfile = imp.load_module('eventFromFitsfile', fp, pathname, 
-                                        description)
-finally:
-    # Since we may exit via an exception, close fp explicitly.
-    if fp:
-        fp.close()
+# Import EventFromInputfile from eventFromFitsfile.py, which lives next to
+# this script, so that we do not have to re-write that one.  It defers its
+# own heavy imports until an event is sent.
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+import eventFromFitsfile
 
 
 
@@ -223,7 +207,7 @@ def main(cmdline):
                              % ', '.join(SUBSETS) )
     
     inputDirectoryList = cl.args[0]
-    datatypePolicy = pexPolicy.Policy.createPolicy(cl.args[1])
+    datatypePolicy = PolicyCache.loadPolicy(cl.args[1])
     expTime = EXP_TIME
     slewTime = SLEW_TIME
     if len(cl.args) > 2:
@@ -233,7 +217,7 @@ def main(cmdline):
     
     metadataPolicy = None
     if cl.opts.mdpolicy is not None:
-        metadataPolicy = pexPolicy.Policy.createPolicy(metadataPolicy)
+        metadataPolicy = PolicyCache.loadPolicy(cl.opts.mdpolicy)
     
     EventFromInputSubsets(subsets, datatypePolicy, expTime, 
                           slewTime, cl.opts.maxvisits, cl.opts.topic, 
@@ -0,0 +1,171 @@
+#! /usr/bin/env python
+
+# 
+# LSST Data Management System
+# Copyright 2008, 2009, 2010 LSST Corporation.
+# 
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the LSST License Statement and 
+# the GNU General Public License along with this program.  If not, 
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+#
+import sys, os, time
+import optparse, traceback
+import lsst.pex.harness.run as run
+from lsst.pex.logging import Log
+from lsst.ctrl.mospipe.StageTiming import TIMING_LOG, timingFromRecord
+from lsst.ctrl.mospipe.LogArchive import LogArchiveReader, recordFromEvent
+from lsst.ctrl.mospipe.LogBatching import UnbatchingReceiver
+from lsst.ctrl.mospipe.Stragglers import StragglerDetector
+
+usage = """Usage: %prog [-vqsd] [-V int] [-r runid] [-n slices] [-f frac] [-g lag] [-p seconds] [-N count] {-b broker | -d archive}"""
+
+desc = """find the slices and hosts that hold up the pipeline at stage
+barriers.  For every exposure and stage, the end times reported by the
+slices are compared; slices that finish in the tail are counted, and the
+slowest slice is charged with the time the others waited for it.  Either
+listen to an event broker (reporting periodically and when interrupted) or
+read a log archive written by recordLogs.py.
+"""
+
+cl = optparse.OptionParser(usage=usage, description=desc)
+run.addAllVerbosityOptions(cl, "V")
+cl.add_option("-b", "--broker", action="store", type="str", default=None,
+              dest="broker", metavar="host",
+              help="listen for timings on this event broker")
+cl.add_option("-d", "--archive-dir", action="store", type="str",
+              default=None, dest="archive", metavar="dir",
+              help="read timings from this log archive")
+cl.add_option("-r", "--runid", action="store", type="str", default=None,
+              dest="runid", metavar="runid",
+              help="restrict to given run ID")
+cl.add_option("-n", "--slices", action="store", type="int", default=None,
+              dest="nslices", metavar="count",
+              help="the number of slices in the pipeline")
+cl.add_option("-f", "--tail-fraction", action="store", type="float",
+              default=0.1, dest="tailfrac", metavar="frac",
+              help="fraction of slices considered the tail of a stage (def: 0.1)")
+cl.add_option("-g", "--min-lag", action="store", type="float", default=0.5,
+              dest="minlag", metavar="seconds",
+              help="minimum lag behind the median to count as tail (def: 0.5)")
+cl.add_option("-p", "--report-interval", action="store", type="int",
+              default=300, dest="interval", metavar="seconds",
+              help="when listening, report this often (def: 300)")
+cl.add_option("-N", "--top", action="store", type="int", default=10,
+              dest="top", metavar="count",
+              help="number of slices and hosts to list (def: 10)")
+
+logger = Log(Log.getDefaultLog(), "findStragglers")
+VERB = logger.INFO-2
+
+def main():
+    """execute the findStragglers script"""
+
+    try:
+        (cl.opts, cl.args) = cl.parse_args()
+        Log.getDefaultLog().setThreshold(
+            run.verbosity2threshold(cl.opts.verbosity, 0))
+        if bool(cl.opts.broker) == bool(cl.opts.archive):
+            raise run.UsageError("Specify exactly one of -b or -d")
+
+        detector = StragglerDetector(cl.opts.nslices, cl.opts.tailfrac,
+                                     cl.opts.minlag)
+        if cl.opts.archive:
+            reader = LogArchiveReader(cl.opts.archive)
+            for rec in reader.query(runId=cl.opts.runid,
+                                    lognames=[TIMING_LOG]):
+                timing = timingFromRecord(rec)
+                if timing is not None:
+                    detector.addTiming(timing, rec["ts"])
+        else:
+            listen(detector, cl.opts.broker, cl.opts.runid, cl.opts.interval,
+                   cl.opts.top)
+
+        detector.collect(flush=True)
+        printReport(detector, cl.opts.top)
+
+    except run.UsageError, e:
+        print >> sys.stderr, "%s: %s" % (cl.get_prog_name(), e)
+        sys.exit(1)
+    except Exception, e:
+        logger.log(Log.FATAL, str(e))
+        traceback.print_exc(file=sys.stderr)
+        sys.exit(2)
+
+# the most events, and seconds, taken from the broker between collections
+DRAIN_EVENTS = 1000
+DRAIN_SECONDS = 1.0
+
+def listen(detector, broker, runid=None, interval=300, top=10):
+    """
+    feed timings from the logging topic to the detector until interrupted
+    """
+    import lsst.ctrl.events as events
+    rcvr = UnbatchingReceiver(
+        events.EventReceiver(broker, events.EventLog.getLoggingTopic()))
+    nextReport = time.time() + interval
+    try:
+        while True:
+            event = rcvr.receive(1000)
+            # under a steady stream, stop draining now and then so that
+            # the barriers get analyzed and reported
+            drained = 0
+            drainEnd = time.time() + DRAIN_SECONDS
+            while event:
+                if event.getString("LOG", "") == TIMING_LOG:
+                    timing = timingFromRecord(recordFromEvent(event))
+                    if timing is not None and \
+                       (runid is None or timing["runId"] == runid):
+                        detector.addTiming(timing)
+                drained += 1
+                if drained >= DRAIN_EVENTS or time.time() >= drainEnd:
+                    break
+                event = rcvr.receive(0)
+            detector.collect()
+            if time.time() >= nextReport:
+                printReport(detector, top)
+                nextReport = time.time() + interval
+    except KeyboardInterrupt:
+        logger.log(VERB, "KeyboardInterrupt: stopping straggler detection")
+
+def printReport(detector, top=10, dest=sys.stdout):
+    print >> dest, "%d stage barriers analyzed; %.1f s spent waiting on the slowest slice" % \
+          (detector.groupsAnalyzed, detector.totalLost)
+    for label, table in (("slice", detector.slices),
+                         ("host", detector.hosts)):
+        flagged = set([s.name for s in detector.stragglers(table)])
+        print >> dest
+        print >> dest, "%-12s %7s %7s %7s %9s %9s  %s" % \
+              (label, "stages", "tail%", "slowest", "lost(s)", "lag(s)",
+               "worst stages")
+        for stats in detector.ranked(table)[:top]:
+            stages = stats.byStage.items()
+            stages.sort(lambda a, b: cmp(b[1][1], a[1][1]))
+            worst = ", ".join(["%d:%s=%.1f" % (idx, name, lost)
+                               for idx, (name, lost) in stages[:3]])
+            mark = ""
+            if stats.name in flagged:
+                mark = " *"
+            print >> dest, "%-12s %7d %7.1f %7d %9.1f %9.2f  %s%s" % \
+                  (str(stats.name)[:12], stats.groups, 100 * stats.tailRate(),
+                   stats.slowest, stats.lostTime, stats.meanLag(), worst, mark)
+    print >> dest
+    print >> dest, "* consistently in the tail"
+    dest.flush()
+
+if __name__ == "__main__":
+    main()
@@ -23,11 +23,13 @@
 #
 
 #
-import re, sys, os, os.path, shutil, subprocess
+import re, sys, os, os.path, shutil, subprocess, signal, time
+import threading, tempfile, Queue
 import optparse, traceback
 from lsst.pex.logging import Log
 from lsst.pex.policy import Policy
 from lsst.pex.exceptions import LsstCppException
+from lsst.ctrl.mospipe.PolicyCache import loadPolicy
 
 usage = """usage: %prog [-vqs] [-V int] [-r reposDir ] [-p dc3pipe_policy_file] [-i runId] [node ...]
 
@@ -62,12 +64,19 @@ cl.add_option("-i", "--runid", action="store", dest="runid",
 cl.add_option("-r", "--repository-dir", action="store", dest="repos", 
               default=None, metavar="dir",
            help="assume the given policy repository directory (for -p and -l)")
+cl.add_option("-j", "--jobs", action="store", type="int", dest="jobs",
+              default=16, metavar="count",
+              help="number of nodes to contact at once (def: 16)")
+cl.add_option("-t", "--timeout", action="store", type="int", dest="timeout",
+              default=30, metavar="seconds",
+              help="give up on a node after this many seconds (def: 30)")
 
 # command line results
 cl.opts = {}
 cl.args = []
 
 pkgdirvar = "CTRL_DC3PIPE_DIR"
+mospkgdirvar = "CTRL_MOSPIPE_DIR"
 defDomain = ".ncsa.uiuc.edu"
 remkill = "killpipe.sh"
 
@@ -87,15 +96,19 @@ def main():
 
         nodes = []
         if cl.opts.prodpol is not None:
-            policy = Policy.createPolicy(cl.opts.prodpol, False)
             repos = cl.opts.repos
             if repos is None:
                 try:
+                    policy = Policy.createPolicy(cl.opts.prodpol, False)
                     repos = getRepositoryDir(policy)
                 except:
                     pass
-            if repos is not None:
-                policy.loadPolicyFiles(repos)
+            if repos is None and os.environ.has_key(mospkgdirvar):
+                # the default launchMospipe uses
+                repos = os.path.join(os.environ[mospkgdirvar], "pipeline")
+            if repos is None:
+                raise RuntimeError("Unable to determine the policy repository directory for %s; use -r" % cl.opts.prodpol)
+            policy = loadPolicy(cl.opts.prodpol, repos)
 
             nodes.extend(getHeadNodes(policy))
             
@@ -104,17 +117,21 @@ def main():
             nodes.extend(getHeadNode(policy))
             
         nodes.extend(cl.args)
+        nodes = uniqueNodes(nodes)
         logger.log(Log.DEBUG, "Killing pipelines on " + ", ".join(nodes))
 
         remcmd = "%s %s" % \
             (os.path.join(os.environ[pkgdirvar], "bin", remkill),cl.opts.runid)
         remcmd = remcmd.strip()
 
-        for node in nodes:
-            cmd = ("ssh", node, remcmd)
-            logger.log(Log.INFO, "executing: %s %s '%s'" % cmd)
-            if not cl.opts.showOnly and subprocess.call(cmd) != 0:
-                logger.log(Log.WARN, "Failed to kill processes on " + node)
+        if cl.opts.showOnly:
+            for node in nodes:
+                logger.log(Log.INFO, "executing: %s" %
+                           " ".join(sshCommand(node, remcmd, cl.opts.timeout)))
+        else:
+            results = killOnNodes(nodes, remcmd, cl.opts.jobs,
+                                  cl.opts.timeout)
+            reportResults(results)
 
     except:
         tb = traceback.format_exception(sys.exc_info()[0],
@@ -126,6 +143,112 @@ def main():
 
     sys.exit(0)
 
+def uniqueNodes(nodes):
+    """return the given node names without duplicates, in order"""
+    seen = set()
+    out = []
+    for node in nodes:
+        if node not in seen:
+            seen.add(node)
+            out.append(node)
+    return out
+
+def sshCommand(node, remcmd, timeout):
+    """
+    return the command for running remcmd on node.  The ssh options keep
+    an unreachable node or a password prompt from blocking.
+    """
+    return ("ssh", "-o", "BatchMode=yes",
+            "-o", "ConnectTimeout=%d" % max(1, timeout), node, remcmd)
+
+def runWithTimeout(cmd, timeout):
+    """
+    run a command, killing it if it does not finish in time.
+    @return tuple   (status, exit code or None, elapsed seconds, output)
+                      where status is "ok", "failed", "timeout" or "error"
+    """
+    start = time.time()
+    out = tempfile.TemporaryFile()
+    try:
+        try:
+            proc = subprocess.Popen(cmd, stdin=open(os.devnull),
+                                    stdout=out, stderr=subprocess.STDOUT)
+        except OSError, e:
+            return ("error", None, time.time() - start, str(e))
+
+        deadline = start + timeout
+        delay = 0.01
+        while proc.poll() is None:
+            if time.time() >= deadline:
+                try:
+                    os.kill(proc.pid, signal.SIGKILL)
+                except OSError:
+                    pass
+                proc.wait()
+                status = "timeout"
+                break
+            time.sleep(delay)
+            delay = min(2 * delay, 0.25)
+        else:
+            status = "ok"
+            if proc.returncode != 0:
+                status = "failed"
+
+        out.seek(0)
+        return (status, proc.returncode, time.time() - start,
+                out.read().strip())
+    finally:
+        out.close()
+
+def killOnNodes(nodes, remcmd, jobs=16, timeout=30):
+    """
+    run the kill command on all the given nodes, at most jobs at a time
+    @return list   a (node, status, exit code, elapsed, output) tuple for
+                     each node, in the order given
+    """
+    work = Queue.Queue()
+    for i, node in enumerate(nodes):
+        work.put((i, node))
+    results = [None] * len(nodes)
+
+    def worker():
+        while True:
+            try:
+                i, node = work.get_nowait()
+            except Queue.Empty:
+                return
+            cmd = sshCommand(node, remcmd, timeout)
+            logger.log(Log.DEBUG, "executing: %s" % " ".join(cmd))
+            results[i] = (node,) + runWithTimeout(cmd, timeout)
+
+    threads = []
+    for i in xrange(max(1, min(jobs, len(nodes)))):
+        t = threading.Thread(target=worker)
+        t.setDaemon(True)
+        t.start()
+        threads.append(t)
+    for t in threads:
+        t.join()
+    return results
+
+def reportResults(results):
+    """log a summary of the per-node results of killOnNodes()"""
+    failed = 0
+    for node, status, code, elapsed, output in results:
+        msg = "%-24s %-8s %6.1f s" % (node, status, elapsed)
+        if status == "failed":
+            msg += "  (exit code %d)" % code
+        if status == "ok":
+            logger.log(Log.INFO, msg)
+        else:
+            failed += 1
+            logger.log(Log.WARN, msg)
+            if output:
+                logger.log(Log.WARN, "  %s: %s" %
+                           (node, output.splitlines()[-1]))
+    logger.log(Log.INFO, "Killed pipelines on %d of %d nodes" %
+               (len(results) - failed, len(results)))
+
 def getHeadNodes(prodpolicy, file=None):
     """return the head from a platform policy.
     @param prodpolicy   a production policy object
@@ -9,19 +9,30 @@ if [ -z "$runid" ]; then
    runid=$mpiexeccmd
 fi
 
-pypids=`pgrep python`
-pypids=`echo $pypids | sed -e 's/ /,/g'`
-if [ -n "$pypids" ]; then
-    if [ -n "$runid" -a -n "$pypids" ]; then
-        mpiexecpids=`ps -uww -p $pypids | grep -v killPipeline | grep $runid | awk '{print $2}'`
-    fi
+# Take a single snapshot of the process table and select, in one pass:
+#   * python processes whose command line mentions the runid (other than
+#     killPipeline itself), and
+#   * mpd processes whose parent is a python process.
+pids=`ps -eo pid=,ppid=,comm=,args= | \
+      awk -v runid="$runid" -v mpd="$mpdcmd" '
+      {
+          pid[NR] = $1; ppid[NR] = $2; comm[NR] = $3
+          sub(/^[ \t]*[0-9]+[ \t]+[0-9]+[ \t]+[^ \t]+[ \t]*/, "")
+          args[NR] = $0
+          if (comm[NR] ~ /python/) ispy[pid[NR]] = 1
+      }
+      END {
+          for (i = 1; i <= NR; i++) {
+              if (ispy[pid[i]]) {
+                  if (index(args[i], runid) && args[i] !~ /killPipeline/)
+                      print pid[i]
+              }
+              else if (ispy[ppid[i]] && index(args[i], mpd)) {
+                  print pid[i]
+              }
+          }
+      }'`
 
-    if [ -n "$mpiexecpids" ]; then
-        kill $mpiexecpids
-    fi
-
-    mpdpids=`pgrep -P $pypids -f $mpdcmd`
-    if [ -n "$mpdpids" ];then
-        kill $mpdpids
-    fi  
+if [ -n "$pids" ]; then
+    kill $pids
 fi
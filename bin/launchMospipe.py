@@ -26,14 +26,15 @@
 from __future__ import with_statement
 import sys, os, time
 import optparse, traceback
+from lsst.ctrl.mospipe.LazyImport import lazyModule
 import lsst.pex.harness.run as run
 from lsst.pex.logging import Log, LogRec
-from lsst.pex.policy import Policy
 from lsst.pex.exceptions import LsstException
-from lsst.daf.base import PropertySet
-import lsst.ctrl.events as events
 
-usage = """usage: %prog [-vqsd] [-V int] [-L lev] [-r dir] [-e script] [-C coll] [-m maxvisits] [-t cfht|sim] mospipe_policy_file runId [ visitListFile ... ]
+events = lazyModule("lsst.ctrl.events")
+dafBase = lazyModule("lsst.daf.base")
+
+usage = """usage: %prog [-vqsd] [-V int] [-L lev] [-r dir] [-e script] [-H secs] [-S secs] [-C coll] [-m maxvisits] [-t cfht|sim] mospipe_policy_file runId [ visitListFile ... ]
 """
 desc = """Launch all or parts of the mophot productin according to a
 given production policy file."""
@@ -66,13 +67,17 @@ cl.add_option("-t", "--data-type", action="store", default="cfht",
               dest="datatype",
               help="type of data in given visit files; choices: cfht|sim; " +
               "minimum match, case-insensitive; def: cfht")
+cl.add_option("-H", "--heartbeat-timeout", action="store", type="int",
+              default=30, dest="hbtimeout", metavar="seconds",
+              help="fail if a pipeline process is silent this long during startup (def: 30)")
+cl.add_option("-S", "--start-timeout", action="store", type="int",
+              default=300, dest="starttimeout", metavar="seconds",
+              help="fail if a pipeline process has not been heard from this long after launch (def: 300)")
 cl.add_option("-C", "--collections", action="store", default=None, 
               dest="colls", help="a list of the datset collections names (support: D1|D2|D3|D4)")
 
 mospkg   = "ctrl_mospipe"
 pkgdirvar = mospkg.upper() + "_DIR"
-loggingEventTopic = events.EventLog.getLoggingTopic()
-waitLogName = "harness.pipeline.visit.stage.handleEvents.eventwait"
 setuptime = 3000    # seconds
 shortsetuptime = 30 # seconds
 datatypes = { "cfht": "datatypePolicy/cfhtDataTypePolicy.paf",
@@ -90,9 +95,6 @@ def main():
         (cl.opts, cl.args) = cl.parse_args()
         Log.getDefaultLog().setThreshold(-10 * cl.opts.verbosity)
 
-        if cl.opts.pipeverb is None:
-            cl.opts.pipeverb = "trace"
-
         t = filter(lambda x: x.startswith(cl.opts.datatype.lower()),
                    datatypes.keys())
         if len(t) > 1:
@@ -120,21 +122,26 @@ def main():
 def launchMos(policyFile, runid, visitFiles, colls, opts, logger):
 
     if not os.environ.has_key(pkgdirvar):
-        raise pexExcept.LsstException("%s env. var not set (setup %s)"
-                                      % (pkgdirvar, mospkg))
+        raise LsstException("%s env. var not set (setup %s)"
+                            % (pkgdirvar, mospkg))
     if opts.repos is None:
         opts.repos = os.path.join(os.environ[pkgdirvar], "pipeline")
 
-    policy = Policy.createPolicy(policyFile, opts.repos)
+    from lsst.ctrl.mospipe.PolicyCache import loadPolicy
+
+    policy = loadPolicy(policyFile, opts.repos)
     broker = policy.get("eventBrokerHost")
     logger.log(Log.DEBUG, "Using event broker on %s" % broker)
     print >> sys.stderr, "Using event broker on %s" % broker
 
-    recvr = events.EventReceiver(broker, loggingEventTopic)
+    # the startup and eventwait messages are never batched
+    recvr = events.EventReceiver(broker, events.EventLog.getLoggingTopic())
     
+    launchTime = time.time()
     runOrca(policyFile, runid, opts, logger)
 
-    waitForReady(policy, runid, recvr, opts.pipeverb, logger)
+    waitForReady(policy, runid, recvr, opts.pipeverb, logger, launchTime,
+                 opts.hbtimeout, opts.starttimeout)
 
     runEventGen(policy, visitFiles, colls, opts, broker, logger)
 
@@ -156,13 +163,22 @@ def runOrca(policyFile, runid, opts, logger):
     except OSError, e:
         raise LsstException("orca.py failed: " + str(e))
 
-def waitForReady(policy, runid, eventrcvr, logverb, logger):
+def waitForReady(policy, runid, eventrcvr, logverb, logger, launchTime=None,
+                 hbtimeout=30, starttimeout=300):
     """
     attempt to wait until all pipelines are configured and running before
-    sending event data.
+    sending event data.  Raise an LsstException if a pipeline process stops
+    sending heartbeats for hbtimeout seconds, or if one of the processes
+    its policy calls for has not been heard from starttimeout seconds
+    after launch.
     """
-    # This implimentation tries to wait until all pipelines have reached
-    # the point of waiting for their first event
+    # Each pipeline process reports its startup phases and sends heartbeats
+    # to the mospipe.startup log (see lsst.ctrl.mospipe.Startup); a pipeline
+    # is ready once it reports waiting for its first event, which it only
+    # does at trace level, or with its handleEvents log kept at trace by
+    # the logThresholds of its stage policies.
+    from lsst.ctrl.mospipe.Startup import StartupTracker, eventwaitLogged, \
+         expectedSlices, describeSlice
 
     # determine whether the pipeline verbosity is enough to get the
     # particular "ready" signals we will be looking for
@@ -177,62 +193,93 @@ def waitForReady(policy, runid, eventrcvr, logverb, logger):
     pldescs = policy.get("pipelines")
     names = pldescs.policyNames(True)
     pipelines = []
+    slices = {}
+    watched = []
     for pl in names:
         plpol = pldescs.getPolicy(pl)
         if not plpol.getBool("launch"):
             continue
 
-        if prodthresh is None or prodthresh > -1:
-            config = plpol.getPolicy("configuration")
-            if config.exists("execute"):
-                config = config.getPolicy("execute")
+        config = plpol.getPolicy("configuration")
+        if config.exists("execute"):
+            config = config.getPolicy("execute")
+        if (prodthresh is None or prodthresh > -1) and \
+           not eventwaitLogged(config):
             if config.exists("logThreshold") and \
                config.getInt("logThreshold") > -1:
                 logger.log(Log.WARN, "%s pipeline's logging not verbose enough to track its readiness" % pl)
                 continue
 
         pipelines.append(pl)
+        slices[pl] = expectedSlices(config)
         logger.log(Log.DEBUG,
                    "Waiting for the %s pipeline to be ready..." % pl)
 
+        # the startup messages are sent at INFO level
+        thresh = prodthresh
+        if thresh is None and config.exists("logThreshold"):
+            thresh = config.getInt("logThreshold")
+        if thresh is None or thresh <= Log.INFO:
+            watched.append(pl)
+        else:
+            logger.log(Log.WARN, "%s pipeline's logging not verbose enough to track its startup" % pl)
+
     if "IPSD" not in pipelines:
         timeout = shortsetuptime # seconds
 
-    if len(pipelines) > 0:
-        logger.log(Log.INFO,
-                   "Waiting for pipelines to setup (this can take a while)...")
-
-        tick = time.time()
-        while len(pipelines) > 0:
-            waittime = 1000 * (timeout - int(round(time.time()-tick)))
-            if waittime > 0:
-#                waitprops = eventrcvr.receive(waittime)
-                waitprops = eventrcvr.matchingReceive("LOG", waitLogName,
-                                                      waittime)
-            else:
-                waitprops = None
-
-            if waitprops is None:
-                LogRec(logger, Log.WARN) \
-                  << "Have yet to hear back from the following pipelines: " +\
-                      ", ".join(pipelines) \
-                  << "Proceeding to send visit events" << LogRec.endr
-                break
-            if waitprops.getString("STATUS", "") == "start" and \
-               waitprops.getString("runId", "") == runid:
-                pipename = waitprops.getString("pipeline", "unknown")
-                if pipename in pipelines:
-                    pipelines.remove(pipename)
-#                pipelines.pop(0)
-                logger.log(Log.DEBUG, "%s is ready" % pipename)
-
-    else:
+    if len(pipelines) == 0:
         LogRec(logger, Log.WARN) \
                        << "Unable to detect when pipelines are ready" \
                        << "Proceeding to send visit events in %d seconds" % \
                           shortsetuptime \
                        << LogRec.endr
         time.sleep(shortsetuptime)
+        return
+
+    logger.log(Log.INFO,
+               "Waiting for pipelines to setup (this can take a while)...")
+
+    tracker = StartupTracker(pipelines, runid, hbtimeout, launchTime,
+                             starttimeout, slices)
+    tick = time.time()
+    while len(tracker.waitingFor()) > 0:
+        waittime = 1000 * (timeout - int(round(time.time()-tick)))
+        if waittime <= 0:
+            LogRec(logger, Log.WARN) \
+              << "Have yet to hear back from the following pipelines: " +\
+                  ", ".join(tracker.waitingFor()) \
+              << "Proceeding to send visit events" << LogRec.endr
+            break
+
+        event = eventrcvr.receive(min(waittime, 1000))
+        while event is not None:
+            tracker.add(event)
+            event = eventrcvr.receive(0)
+
+        failures = []
+        for pipename, proc in tracker.hung():
+            if pipename in watched:
+                failures.append("no word from %s %s on %s for %d s (last phase: %s)"
+                                % (pipename, describeSlice(proc.sliceId),
+                                   proc.hostId, time.time() - proc.lastHeard,
+                                   proc.latestPhase()))
+        for pipename, sliceId in tracker.missing():
+            if pipename in watched:
+                failures.append("%s %s never started" %
+                                (pipename, describeSlice(sliceId)))
+        if failures:
+            rec = LogRec(logger, Log.FATAL)
+            rec << "Pipeline startup failed"
+            for line in failures + tracker.report():
+                rec << line
+            rec << LogRec.endr
+            raise LsstException("pipeline startup failed: %s; shut the pipelines down with killPipeline.py" % "; ".join(failures))
+
+    rec = LogRec(logger, Log.INFO)
+    rec << "Pipeline startup report"
+    for line in tracker.report():
+        rec << line
+    rec << LogRec.endr
 
     return
 
@@ -294,7 +341,7 @@ def runEventGen(policy, visitFiles, colls, opts, broker, logger):
         pass
 #        if stopEventTopic is not None:
 #            trx = events.EventTransmitter(broker, stopEventTopic)
-#            trx.publish(PropertySet())
+#            trx.publish(dafBase.PropertySet())
 
     return
 
@@ -0,0 +1,145 @@
+#! /usr/bin/env python
+
+# 
+# LSST Data Management System
+# Copyright 2008, 2009, 2010 LSST Corporation.
+# 
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the LSST License Statement and 
+# the GNU General Public License along with this program.  If not, 
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+#
+import sys, os, time, threading
+import optparse, traceback
+import BaseHTTPServer
+import lsst.pex.harness.run as run
+from lsst.pex.logging import Log
+from lsst.ctrl.mospipe.Metrics import PipelineMetrics
+from lsst.ctrl.mospipe.EventMultiplexer import EventMultiplexer
+from lsst.ctrl.mospipe.LogBatching import UnbatchingReceiver
+
+usage = """Usage: %prog [-vqsd] [-V int] [-p port] [-a address] [-t topic] [-e topic ...] [-l stage] [-W seconds] broker"""
+
+desc = """serve metrics aggregated from the pipeline's log and event topics
+over HTTP in the Prometheus text format, at /metrics.  These include the
+event rate per topic, visits triggered and completed, stage durations,
+database write latency and the readiness of each pipeline.
+"""
+
+cl = optparse.OptionParser(usage=usage, description=desc)
+run.addAllVerbosityOptions(cl, "V")
+cl.add_option("-p", "--port", action="store", type="int", default=9108,
+              dest="port", metavar="port",
+              help="the HTTP port to serve on (def: 9108)")
+cl.add_option("-a", "--address", action="store", type="str", default="",
+              dest="address", metavar="address",
+              help="the address to bind to (def: all interfaces)")
+cl.add_option("-t", "--topic", action="store", type="str",
+              default="triggerImageprocEvent", dest="topic", metavar="topic",
+              help="the visit trigger event topic (def: triggerImageprocEvent)")
+cl.add_option("-e", "--extra-topic", action="append", type="str",
+              default=[], dest="extratopics", metavar="topic",
+              help="also count events from this topic (repeatable)")
+cl.add_option("-l", "--last-stage", action="store", type="int", default=None,
+              dest="laststage", metavar="index",
+              help="the position of the last stage in the pipeline")
+cl.add_option("-W", "--window", action="store", type="int", default=300,
+              dest="window", metavar="seconds",
+              help="the span of the rolling windows (def: 300)")
+
+logger = Log(Log.getDefaultLog(), "mospipeMetrics")
+VERB = logger.INFO-2
+
+def main():
+    """execute the mospipeMetrics script"""
+
+    try:
+        (cl.opts, cl.args) = cl.parse_args()
+        Log.getDefaultLog().setThreshold(
+            run.verbosity2threshold(cl.opts.verbosity, 0))
+        if len(cl.args) < 1:
+            raise run.UsageError("Missing broker host")
+
+        metrics = PipelineMetrics(cl.opts.topic, cl.opts.laststage,
+                                  cl.opts.window)
+        server = startServer(metrics, cl.opts.address, cl.opts.port)
+        serveMetrics(metrics, cl.args[0], [cl.opts.topic]+cl.opts.extratopics)
+        server.server_close()
+
+    except run.UsageError, e:
+        print >> sys.stderr, "%s: %s" % (cl.get_prog_name(), e)
+        sys.exit(1)
+    except Exception, e:
+        logger.log(Log.FATAL, str(e))
+        traceback.print_exc(file=sys.stderr)
+        sys.exit(2)
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    answer GET /metrics with the rendered metrics
+    """
+    metrics = None
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.metrics.render()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.log(Log.DEBUG, format % args)
+
+def startServer(metrics, address, port):
+    """
+    serve the metrics from a background thread
+    """
+    handler = type("Handler", (MetricsHandler,), { "metrics": metrics })
+    server = BaseHTTPServer.HTTPServer((address, port), handler)
+    t = threading.Thread(target=server.serve_forever, name="metrics-http")
+    t.setDaemon(True)
+    t.start()
+    logger.log(VERB, "Serving metrics on port %d" % port)
+    return server
+
+def serveMetrics(metrics, broker, topics):
+    """
+    feed events from the logging topic and the given topics into the
+    metrics until interrupted
+    """
+    import lsst.ctrl.events as events
+
+    topics = [events.EventLog.getLoggingTopic()] + list(topics)
+    mux = EventMultiplexer([UnbatchingReceiver(events.EventReceiver(broker, t))
+                            for t in topics])
+    mux.start()
+    try:
+        try:
+            while True:
+                for topic, ts, event in mux.get(1.0):
+                    metrics.add(topic, ts, event)
+        except KeyboardInterrupt:
+            logger.log(VERB, "KeyboardInterrupt: stopping metrics server")
+    finally:
+        mux.stop(False)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+#! /usr/bin/env python
+
+# 
+# LSST Data Management System
+# Copyright 2008, 2009, 2010 LSST Corporation.
+# 
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the LSST License Statement and 
+# the GNU General Public License along with this program.  If not, 
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+#
+#
+import sys, os
+import optparse, traceback
+import lsst.pex.harness.run as run
+from lsst.pex.logging import Log
+from lsst.ctrl.mospipe.PolicyCache import loadPolicy
+from lsst.ctrl.mospipe.CapacityPlanner import CostModel, Simulator, \
+     pipelineStages, sliceCount, platformNodes
+
+usage = """Usage: %prog [-vqs] [-V int] [-p platform] [-m costmodel] [-d archive [-r runid]] [-c cores ...] [-N nodes] [-i instances] [-n visits] [-R rate] [-S seed] [-B] pipeline_policy"""
+
+desc = """predict the visit rate a pipeline can sustain on a cluster, the
+peak memory used on each node and the stage that limits it, by simulating
+the flow of visits through the pipeline's stages.  The stages and the
+number of slices are read from the pipeline policy (e.g. IP.paf), the
+nodes and their cores from the platform policy, and the per-stage costs
+from a cost model policy and/or from the stage timings recorded in a log
+archive.  Give -c several times to compare different numbers of cores per
+node.
+"""
+
+cl = optparse.OptionParser(usage=usage, description=desc)
+run.addAllVerbosityOptions(cl, "V")
+cl.add_option("-p", "--platform-policy", action="store", type="str",
+              default=None, dest="platform", metavar="policy_file",
+              help="the platform policy (default: platform/newfield.paf next to the pipeline policy)")
+cl.add_option("-m", "--cost-model", action="store", type="str",
+              default=None, dest="costmodel", metavar="policy_file",
+              help="the stage cost model (default: costModel.paf next to the pipeline policy)")
+cl.add_option("-d", "--archive-dir", action="store", type="str",
+              default=None, dest="archive", metavar="dir",
+              help="take stage times from the timings in this log archive")
+cl.add_option("-r", "--runid", action="store", type="str", default=None,
+              dest="runid", metavar="runid",
+              help="restrict archived timings to given run ID")
+cl.add_option("-c", "--cores", action="append", type="int", default=[],
+              dest="cores", metavar="n",
+              help="simulate n cores per node (may be repeated)")
+cl.add_option("-N", "--nodes", action="store", type="int", default=None,
+              dest="nodes", metavar="n",
+              help="simulate n nodes like the first one of the platform")
+cl.add_option("-i", "--instances", action="store", type="int", default=1,
+              dest="instances", metavar="n",
+              help="run n instances of the pipeline side by side")
+cl.add_option("-n", "--visits", action="store", type="int", default=100,
+              dest="visits", metavar="n",
+              help="the number of visits to simulate")
+cl.add_option("-R", "--rate", action="store", type="float", default=None,
+              dest="rate", metavar="visits_per_hour",
+              help="also simulate visits arriving at this rate")
+cl.add_option("-S", "--seed", action="store", type="int", default=1,
+              dest="seed", metavar="n", help="the random seed")
+cl.add_option("-B", "--breakdown", action="store_true", default=False,
+              dest="breakdown", help="print the per-stage times of each configuration")
+
+logger = Log(Log.getDefaultLog(), "planCapacity")
+VERB = logger.INFO-2
+
+def main():
+    """execute the planCapacity script"""
+
+    try:
+        (cl.opts, cl.args) = cl.parse_args()
+        Log.getDefaultLog().setThreshold(
+            run.verbosity2threshold(cl.opts.verbosity, 0))
+        if len(cl.args) != 1:
+            raise run.UsageError("Missing pipeline policy file")
+
+        pipePolicyFile = cl.args[0]
+        policyDir = os.path.dirname(os.path.abspath(pipePolicyFile))
+        pipePolicy = loadPolicy(pipePolicyFile, policyDir)
+        stages = pipelineStages(pipePolicy)
+        nSlices = sliceCount(pipePolicy)
+
+        platFile = cl.opts.platform
+        if platFile is None:
+            platFile = os.path.join(policyDir, "platform", "newfield.paf")
+        nodes, ram = platformNodes(loadPolicy(platFile))
+
+        costs = CostModel()
+        modelFile = cl.opts.costmodel
+        if modelFile is None and \
+           os.path.exists(os.path.join(policyDir, "costModel.paf")):
+            modelFile = os.path.join(policyDir, "costModel.paf")
+        if modelFile is not None:
+            costs = CostModel.fromPolicy(loadPolicy(modelFile))
+        if cl.opts.archive:
+            costs.addMeasured(archivedTimings(cl.opts.archive,
+                                              cl.opts.runid))
+        logger.log(VERB, "%d stages, %d slices; measured costs for %d stages"
+                   % (len(stages), nSlices, len(costs.measured)))
+
+        for config in configurations(nodes, cl.opts.cores, cl.opts.nodes):
+            sim = Simulator(stages, costs, nSlices, config,
+                            cl.opts.instances, cl.opts.seed)
+            capacity = sim.run(cl.opts.visits)
+            loaded = None
+            if cl.opts.rate:
+                loaded = sim.run(cl.opts.visits, cl.opts.rate)
+            printResult(sim, config, capacity, loaded, ram, cl.opts.rate)
+            if cl.opts.breakdown:
+                printBreakdown(capacity)
+            print
+
+    except run.UsageError, e:
+        print >> sys.stderr, "%s: %s" % (cl.get_prog_name(), e)
+        sys.exit(1)
+    except Exception, e:
+        logger.log(Log.FATAL, str(e))
+        traceback.print_exc(file=sys.stderr)
+        sys.exit(2)
+
+def configurations(nodes, cores=None, nNodes=None):
+    """
+    return the node lists to simulate
+    @param nodes    the (host, cores) of the platform's nodes
+    @param cores    the list of cores per node to try, if any
+    @param nNodes   if given, use this many nodes like the first one
+    """
+    if nNodes is not None:
+        host = nodes[0][0]
+        nodes = [("%s%d" % (host, i + 1), nodes[0][1])
+                 for i in xrange(nNodes)]
+    if not cores:
+        return [nodes]
+    return [[(host, n) for host, dummy in nodes] for n in cores]
+
+def archivedTimings(archive, runid=None):
+    """
+    return a StageTimingAggregator of the timings recorded in a log archive
+    """
+    from lsst.ctrl.mospipe.StageTiming import TIMING_LOG, \
+         StageTimingAggregator, timingFromRecord
+    from lsst.ctrl.mospipe.LogArchive import LogArchiveReader
+
+    agg = StageTimingAggregator()
+    reader = LogArchiveReader(archive)
+    for rec in reader.query(runId=runid, lognames=[TIMING_LOG]):
+        timing = timingFromRecord(rec)
+        if timing is not None and timing.get("status", "ok") == "ok":
+            agg.add(timing)
+    return agg
+
+def printResult(sim, nodes, capacity, loaded=None, ram=None, rate=None,
+                dest=sys.stdout):
+    """
+    print the outcome of the simulations of one configuration
+    @param sim       the Simulator
+    @param nodes     the (host, cores) of the simulated nodes
+    @param capacity  the SimulationResult with all visits waiting
+    @param loaded    the SimulationResult at the given arrival rate
+    @param ram       the RAM per node in GB, if known
+    """
+    cores = sum([n for h, n in nodes])
+    times = sorted(capacity.visitTimes)
+    print >> dest, "%d node(s), %d cores, %d pipeline(s) of %d slices" % \
+          (len(nodes), cores, capacity.instances, sim.nSlices)
+    print >> dest, "  sustainable rate:  %.1f visits/hour" % \
+          capacity.throughput()
+    print >> dest, "  visit time:        mean %.1f s, p95 %.1f s" % \
+          (sum(times) / len(times), times[int(0.95 * (len(times) - 1))])
+    worst = capacity.bottleneck()
+    print >> dest, "  bottleneck stage:  %d %s (%.1f s/visit, %.1f s barrier wait)" % \
+          (worst.index, worst.name, worst.mean(), worst.meanWait())
+
+    placement = sim.placement()
+    util = capacity.utilization()
+    for host, n in nodes:
+        mem = capacity.nodeMemory.get(host, 0.0) / 1024.0
+        flag = ""
+        if ram is not None and mem > ram:
+            flag = "  ** exceeds %.1f GB **" % ram
+        print >> dest, "  %-18s %3d procs on %3d cores, %5.1f%% busy, peak memory %.1f GB%s" % \
+              (host, placement.get(host, 0), n, 100 * util.get(host, 0.0),
+               mem, flag)
+
+    if loaded is not None:
+        lat = sorted(loaded.latencies)
+        state = "sustainable"
+        if capacity.throughput() < rate:
+            state = "NOT sustainable; visits queue up"
+        print >> dest, "  at %.1f visits/hour: %s; latency mean %.1f s, max %.1f s, queue up to %d" % \
+              (rate, state, sum(lat) / len(lat), lat[-1], loaded.maxQueue)
+
+def printBreakdown(result, dest=sys.stdout):
+    """
+    print the simulated per-stage times
+    """
+    total = sum([s.total for s in result.stages]) or 1.0e-9
+    print >> dest, "  %3s %-32s %9s %9s %6s" % \
+          ("idx", "stage", "mean", "wait", "%time")
+    for s in result.stages:
+        print >> dest, "  %3d %-32s %9.3f %9.3f %6.1f" % \
+              (s.index, s.name[:32], s.mean(), s.meanWait(),
+               100.0 * s.total / total)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+#! /usr/bin/env python
+
+# 
+# LSST Data Management System
+# Copyright 2008, 2009, 2010 LSST Corporation.
+# 
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the LSST License Statement and 
+# the GNU General Public License along with this program.  If not, 
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+#
+import sys, os, time, datetime, calendar
+import optparse, traceback
+import lsst.pex.harness.run as run
+from lsst.pex.logging import Log
+from lsst.ctrl.mospipe.LogArchive import LogArchiveReader
+
+usage = """Usage: %prog [-vqsd] [-V int] [-r runid] [-S id] [-H hostlist] [-m lev] [-M lev] [-a time] [-b time] [-p] [-c] archive [logname ...]"""
+
+desc = """print log messages recorded by recordLogs.py.
+
+If no lognames are given on the command-line, messages with any log name
+are printed.  A logname that ends with the a '*' character will match any
+logname that begins with the string preceding the '*'.  Times are given
+in UTC as YYYY-MM-DDTHH:MM:SS or as seconds since the epoch.
+"""
+
+cl = optparse.OptionParser(usage=usage, description=desc)
+run.addAllVerbosityOptions(cl, "V")
+cl.add_option("-r", "--runid", action="store", type="str", default=None,
+              dest="runid", metavar="runid",
+              help="restrict to given run ID")
+cl.add_option("-S", "--slice", action="store", type="int", default=None,
+              dest="slice", metavar="id",
+              help="restrict to given slice ID")
+cl.add_option("-H", "--include-hosts", action="store", type="str",
+              default=None, dest="inclhosts", metavar="hostlist",
+              help="restrict to given hosts as comma-separated list")
+cl.add_option("-m", "--min-importance", action="store", type="int",
+              default=None, dest="minimport", metavar="importance",
+              help="restrict to messages with this importance level or higher (e.g. FATAL=20, DEBUG < 0)")
+cl.add_option("-M", "--max-importance", action="store", type="int",
+              default=None, dest="maximport", metavar="importance",
+              help="restrict to messages with this importance level or lower (e.g. FATAL=20, DEBUG < 0)")
+cl.add_option("-a", "--after", action="store", type="str", default=None,
+              dest="since", metavar="time",
+              help="restrict to messages at or after this time")
+cl.add_option("-b", "--before", action="store", type="str", default=None,
+              dest="until", metavar="time",
+              help="restrict to messages at or before this time")
+cl.add_option("-p", "--show-properties", action="store_true", default=False,
+              dest="showprops",
+              help="print the additional properties of each message")
+cl.add_option("-c", "--count", action="store_true", default=False,
+              dest="countOnly",
+              help="only print the number of matching messages")
+
+logger = Log(Log.getDefaultLog(), "queryLogs")
+VERB = logger.INFO-2
+
+def main():
+    """execute the queryLogs script"""
+
+    try:
+        (cl.opts, cl.args) = cl.parse_args()
+        Log.getDefaultLog().setThreshold(
+            run.verbosity2threshold(cl.opts.verbosity, 0))
+        if len(cl.args) < 1:
+            raise run.UsageError("Missing archive directory")
+        hosts = None
+        if cl.opts.inclhosts:
+            hosts = cl.opts.inclhosts.split(',')
+
+        queryLogs(cl.args[0], cl.args[1:], cl.opts.runid, cl.opts.slice, hosts,
+                  cl.opts.minimport, cl.opts.maximport,
+                  parseTime(cl.opts.since), parseTime(cl.opts.until),
+                  cl.opts.showprops, cl.opts.countOnly)
+
+    except run.UsageError, e:
+        print >> sys.stderr, "%s: %s" % (cl.get_prog_name(), e)
+        sys.exit(1)
+    except Exception, e:
+        logger.log(Log.FATAL, str(e))
+        traceback.print_exc(file=sys.stderr)
+        sys.exit(2)
+
+def parseTime(value):
+    """
+    convert a command-line time into seconds since the epoch
+    """
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return calendar.timegm(time.strptime(value, "%Y-%m-%dT%H:%M:%S"))
+    except ValueError:
+        raise run.UsageError("Unrecognized time format: " + value)
+
+def queryLogs(archive, lognames, runid=None, sliceid=None, hosts=None,
+              minimport=None, maximport=None, since=None, until=None,
+              showprops=False, countOnly=False, dest=sys.stdout):
+    """
+    print the archived log messages matching the given criteria
+    @param archive    the archive directory
+    @param lognames   a list of log names to restrict to
+    @param runid      restrict to the given run ID
+    @param sliceid    restrict to the given slice ID
+    @param hosts      restrict to the given list of host origins
+    @param minimport  restrict to messages with this importance or higher
+    @param maximport  restrict to messages with this importance or lower
+    @param since      restrict to messages at or after this time
+    @param until      restrict to messages at or before this time
+    @param showprops  if True, print each message's additional properties
+    @param countOnly  if True, only print the number of matching messages
+    @param dest       the file stream to print to
+    @return int   the number of matching messages
+    """
+    reader = LogArchiveReader(archive)
+    count = 0
+    for rec in reader.query(runid, sliceid, hosts, minimport, maximport,
+                            lognames, since, until):
+        count += 1
+        if countOnly:
+            continue
+
+        level = rec["LEVEL"]
+        lev = ""
+        if level >= logger.FATAL:
+            lev = "FATAL "
+        elif level >= logger.WARN:
+            lev = "WARN "
+        elif level < logger.INFO:
+            lev = "DEBUG "
+        date = str(datetime.datetime.utcfromtimestamp(rec["ts"]))
+        where = "%s/%s/%s" % (rec["runId"], rec["sliceId"], rec["hostId"])
+        for comm in rec["COMMENT"] or [""]:
+            print >> dest, "%s %s %s%s: %s" % \
+                  (date, where, lev, rec["LOG"], comm)
+        if showprops and rec["PROPS"]:
+            props = rec["PROPS"].items()
+            props.sort()
+            print >> dest, "    " + \
+                  ", ".join(["%s=%s" % (k, v) for k, v in props])
+
+    if countOnly:
+        print >> dest, count
+    logger.log(VERB, "%d matching messages from %d segments" %
+               (count, reader.segmentsRead))
+    return count
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+#! /usr/bin/env python
+
+# 
+# LSST Data Management System
+# Copyright 2008, 2009, 2010 LSST Corporation.
+# 
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the LSST License Statement and 
+# the GNU General Public License along with this program.  If not, 
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+#
+import sys, os, time
+import optparse, traceback
+import lsst.pex.harness.run as run
+from lsst.pex.logging import Log
+import lsst.ctrl.events as events
+from lsst.ctrl.mospipe.LogArchive import LogArchiveWriter, recordFromEvent
+from lsst.ctrl.mospipe.EventMultiplexer import EventMultiplexer
+from lsst.ctrl.mospipe.LogBatching import UnbatchingReceiver
+
+usage = """Usage: %prog [-vqsd] [-V int] [-d dir] [-p seconds] [-n count] [-T seconds] [-e topic ...] broker"""
+
+desc = """record all log messages sent to the logging topic into a
+time-partitioned, compressed log archive that can be searched with
+queryLogs.py.  Events from additional topics (e.g. the visit trigger events)
+can be recorded alongside them; these are archived under a log name equal
+to their topic name.
+"""
+
+cl = optparse.OptionParser(usage=usage, description=desc)
+run.addAllVerbosityOptions(cl, "V")
+cl.add_option("-d", "--archive-dir", action="store", type="str",
+              default="logarchive", dest="archive", metavar="dir",
+              help="the archive directory (def: logarchive)")
+cl.add_option("-p", "--partition-time", action="store", type="int",
+              default=3600, dest="partsecs", metavar="seconds",
+              help="time span of each archive partition for a new archive (def: 3600)")
+cl.add_option("-n", "--segment-size", action="store", type="int",
+              default=5000, dest="maxrecs", metavar="count",
+              help="maximum number of messages per segment (def: 5000)")
+cl.add_option("-T", "--flush-time", action="store", type="int",
+              default=10, dest="flushsecs", metavar="seconds",
+              help="maximum seconds to hold messages before writing (def: 10)")
+cl.add_option("-t", "--log-topic", action="store", type="str",
+              default=events.EventLog.getLoggingTopic(),
+              dest="logtopic", metavar="topic",
+              help="event topic name (def: 'LSSTLogging')")
+cl.add_option("-e", "--extra-topic", action="append", type="str",
+              default=[], dest="extratopics", metavar="topic",
+              help="also record events from this topic (repeatable)")
+
+logger = Log(Log.getDefaultLog(), "recordLogs")
+VERB = logger.INFO-2
+
+def main():
+    """execute the recordLogs script"""
+
+    try:
+        (cl.opts, cl.args) = cl.parse_args()
+        Log.getDefaultLog().setThreshold(
+            run.verbosity2threshold(cl.opts.verbosity, 0))
+        if len(cl.args) < 1:
+            raise run.UsageError("Missing broker host")
+
+        recordLogs(cl.args[0], cl.opts.archive, cl.opts.logtopic,
+                   cl.opts.partsecs, cl.opts.maxrecs, cl.opts.flushsecs,
+                   cl.opts.extratopics)
+
+    except run.UsageError, e:
+        print >> sys.stderr, "%s: %s" % (cl.get_prog_name(), e)
+        sys.exit(1)
+    except Exception, e:
+        logger.log(Log.FATAL, str(e))
+        traceback.print_exc(file=sys.stderr)
+        sys.exit(2)
+
+def recordLogs(broker, archive, topic="LSSTLogging", partsecs=3600,
+               maxrecs=5000, flushsecs=10, extratopics=None):
+    """
+    record log messages into an archive until interrupted
+    @param broker     the host where the event broker is running
+    @param archive    the archive directory
+    @param topic      the logging event topic
+    @param partsecs   the time span of each partition of a new archive
+    @param maxrecs    the maximum number of messages per segment
+    @param flushsecs  the maximum seconds to hold messages before writing
+    @param extratopics  other event topics to record
+    """
+    writer = LogArchiveWriter(archive, partsecs, maxrecs, flushsecs)
+    topics = [topic] + list(extratopics or [])
+    mux = EventMultiplexer([UnbatchingReceiver(events.EventReceiver(broker, t))
+                            for t in topics])
+    logger.log(VERB, "Recording %s messages into %s" %
+               (", ".join(topics), archive))
+
+    mux.start()
+    try:
+        try:
+            while True:
+                for etopic, ts, event in mux.get(flushsecs):
+                    rec = recordFromEvent(event, ts)
+                    if not rec["LOG"]:
+                        rec["LOG"] = etopic
+                    writer.add(rec)
+                writer.flushIfDue()
+        except KeyboardInterrupt:
+            logger.log(VERB, "KeyboardInterrupt: stopping log recording")
+    finally:
+        mux.stop(False)
+        writer.close()
+        logger.log(VERB, "Recorded %d messages" % writer.written)
+
+if __name__ == "__main__":
+    main()
@@ -27,12 +27,25 @@ run_dc3_pipelines.py
 
 Checkout the IPSD, MOPS and DC3 pipeline description/policy files form SVN, edit
 the DC3 policy to use our local files and start a run.
+
+Policy files and directories are staged through a content-addressed cache:
+each source is stored once under the SHA-1 of its contents and hardlinked
+into the current directory, so that unchanged policies are not copied again
+from one run to the next. Only the master and node policies, which get
+patched, are real copies. The hash of the resulting set of policies is
+recorded together with the run ID in policy_snapshots.log.
 """
 import os
 import sets
 import shutil
 import sys
+import tempfile
+import time
 import traceback
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
 
 import lsst.pex.policy as policy
 
@@ -54,10 +67,16 @@ NODES                = ['lsst5:8', 'lsst6:8', 'lsst7:8',
 PIPELINES          = {'imageSubtractionDetection': 'IPSD',
                       'mops':                      'nightmops'}
 SVN_MODES          = ('co', 'checkout', 'export')
+POLICY_CACHE_DIR   = os.environ.get('DC3PIPE_POLICY_CACHE',
+                                    os.path.join(os.path.expanduser('~'),
+                                                 '.dc3pipe_policy_cache'))
+STAGED_INDEX       = '.policy_staged'
+SNAPSHOT_LOG       = 'policy_snapshots.log'
 
 
 def run_dc3pipes(run_id, pipelines=[], nodes=[], master_policy=None,
-                 setup_script=None, use_trunk=False, verbose=False):
+                 setup_script=None, use_trunk=False, verbose=False,
+                 cache_dir=POLICY_CACHE_DIR):
     """
     Main work horse: set everything up and start a run.
     
@@ -68,11 +87,13 @@ def run_dc3pipes(run_id, pipelines=[], nodes=[], master_policy=None,
     @param setup_script: use custom ORCA setup script.
     @param use_trunk: boolean - use policy files from trunk.
     @param verbose: verbosity flag. Default is False.
+    @param cache_dir: the policy cache directory.
     
     @return 0 for success, otherwise error code.
     """
     try:
-        setup_policy_files(pipelines, nodes, master_policy, use_trunk, verbose)
+        setup_policy_files(pipelines, nodes, master_policy, use_trunk, verbose,
+                           run_id, cache_dir)
     except:
         sys.stderr.write('Error in setup_policy_files():\n')
         traceback.print_exc(file=sys.stdout)
@@ -158,7 +179,8 @@ def _valid_nodes(nodes):
 
     
 def setup_policy_files(pipelines, nodes, master_policy, 
-                       use_trunk=False, verbose=False):
+                       use_trunk=False, verbose=False, run_id=None,
+                       cache_dir=POLICY_CACHE_DIR):
     """
     Checkout ctrl_dc3pipe and ctrl_orca policy files from SVN and, if pipelines
     and/or nodes and not empty, patch the files to reflect user's input.
@@ -169,25 +191,35 @@ def setup_policy_files(pipelines, nodes, master_policy,
            downloading a fresh copy from SVN.
     @param use_trunk: boolean - use policy files from trunk.
     @param verbose: verbosity flag. Default is False.
+    @param run_id: the run ID to record the policy snapshot under.
+    @param cache_dir: the policy cache directory.
     
-    @return None
+    @return the hash identifying the staged set of policy files.
     @throw Exception in case of error. The type of exception reflect the error.
     """    
     if(not pipelines or not nodes):
         raise(Exception('No pipelines to run and/or no nodes to use. Exiting.'))
     
+    staged = {}
+    
     # Retrieve the top level policy file and patch it of needed.
     if(not master_policy):
         master_policy = os.path.abspath(os.path.basename(ORCA_PIPECFG_SVN_URL))
-        _retrieve(ORCA_PIPECFG_SVN_URL, 'export', use_trunk, verbose)
+        _retrieve(ORCA_PIPECFG_SVN_URL, 'export', use_trunk, verbose,
+                  cache_dir, copy=True)
     _patch_master_policy(master_policy, pipelines, verbose)
+    staged[os.path.basename(master_policy)] = _hash_path(master_policy)
     
     # Get the node list and patch it if needed.
-    _retrieve(ORCA_NODECFG_SVN_URL, 'export', use_trunk, verbose)
-    _patch_node_policy(os.path.basename(ORCA_NODECFG_SVN_URL), nodes, verbose)
+    node_paf = _retrieve(ORCA_NODECFG_SVN_URL, 'export', use_trunk, verbose,
+                         cache_dir, copy=True)[0]
+    _patch_node_policy(node_paf, nodes, verbose)
+    staged[node_paf] = _hash_path(node_paf)
     
     # Get the DB config file.
-    _retrieve(ORCA_DBCFG_SVN_URL, 'export', use_trunk, verbose)
+    name, digest = _retrieve(ORCA_DBCFG_SVN_URL, 'export', use_trunk, verbose,
+                             cache_dir)
+    staged[name] = digest
     
     # Now we are ready to fetch the pipeline policy files.
     for pipe in PIPELINES.keys():
@@ -195,19 +227,230 @@ def setup_policy_files(pipelines, nodes, master_policy,
         policy_url = os.path.join(DC3PIPE_SVN_URL, DC3PIPE_POLICY_DIR)
         
         # Export the main policy file.
-        _retrieve(os.path.join(policy_url, '%s.paf' %(root_name)), 
-                      'export', 
-                      use_trunk,
-                      verbose)
+        name, digest = _retrieve(os.path.join(policy_url, '%s.paf' %(root_name)), 
+                                 'export', 
+                                 use_trunk,
+                                 verbose,
+                                 cache_dir)
+        staged[name] = digest
         
         # Checkout the stage policy files.
-        _retrieve(os.path.join(policy_url, root_name), 'co', use_trunk, verbose)
+        name, digest = _retrieve(os.path.join(policy_url, root_name), 'co',
+                                 use_trunk, verbose, cache_dir)
+        staged[name] = digest
+    
+    return(_record_snapshot(staged, run_id, cache_dir, verbose))
+
+
+def _hash_path(path):
+    """
+    Compute the SHA-1 of a file's contents or of a directory tree (its
+    relative file names and contents, ignoring .svn directories).
+    
+    @param path: the file or directory to hash.
+    
+    @return the hex digest.
+    """
+    digest = sha1()
+    if(not os.path.isdir(path)):
+        _hash_file(path, digest)
+        return(digest.hexdigest())
+    
+    for root, dirs, files in os.walk(path):
+        if('.svn' in dirs):
+            dirs.remove('.svn')
+        dirs.sort()
+        files.sort()
+        for f in files:
+            full = os.path.join(root, f)
+            digest.update(full[len(path):] + '\0')
+            _hash_file(full, digest)
+    return(digest.hexdigest())
+
+
+def _hash_file(path, digest):
+    f = open(path, 'rb')
+    try:
+        data = f.read(65536)
+        while(data):
+            digest.update(data)
+            data = f.read(65536)
+    finally:
+        f.close()
+    return
+
+
+def _cache_path(path, cache_dir, verbose=False):
+    """
+    Store a file or directory tree in the policy cache under the hash of its
+    contents, unless it is already there.
+    
+    @param path: the file or directory to store.
+    @param cache_dir: the policy cache directory.
+    
+    @return (path of the cached copy, hex digest)
+    """
+    digest = _hash_path(path)
+    name = os.path.basename(path)
+    entry = os.path.join(cache_dir, 'objects', digest)
+    cached = os.path.join(entry, name)
+    if(os.path.exists(cached)):
+        return(cached, digest)
+    
+    # Build the entry in a temporary directory and move it into place in
+    # one step so that concurrent launches never see a partial copy.
+    objects = os.path.dirname(entry)
+    if(not os.path.isdir(objects)):
+        os.makedirs(objects)
+    tmp = tempfile.mkdtemp(dir=objects)
+    try:
+        if(os.path.isdir(path)):
+            shutil.copytree(path, os.path.join(tmp, name))
+        else:
+            shutil.copy2(path, os.path.join(tmp, name))
+        # Staged copies are hardlinks: make the cached files read-only so
+        # that editing one in a run directory cannot alter the cache.
+        for root, dirs, files in os.walk(tmp):
+            for f in files:
+                os.chmod(os.path.join(root, f), 0444)
+        try:
+            os.rename(tmp, entry)
+        except OSError:
+            if(not os.path.exists(cached)):
+                raise
+    finally:
+        if(os.path.exists(tmp)):
+            shutil.rmtree(tmp)
+    if(verbose):
+        print('Cached %s as %s' %(path, digest))
+    return(cached, digest)
+
+
+def _link_path(src, dest):
+    """
+    Recreate the file or directory tree src at dest using hardlinks, falling
+    back to copies where hardlinks are not possible.
+    """
+    if(not os.path.isdir(src)):
+        try:
+            os.link(src, dest)
+        except OSError:
+            shutil.copy2(src, dest)
+        return
+    
+    for root, dirs, files in os.walk(src):
+        target = os.path.join(dest, root[len(src):].lstrip(os.sep))
+        os.mkdir(target)
+        for f in files:
+            try:
+                os.link(os.path.join(root, f), os.path.join(target, f))
+            except OSError:
+                shutil.copy2(os.path.join(root, f), os.path.join(target, f))
+    return
+
+
+def _read_staged_index():
+    index = {}
+    if(os.path.exists(STAGED_INDEX)):
+        for line in open(STAGED_INDEX):
+            fields = line.split()
+            if(len(fields) == 2):
+                index[fields[0]] = fields[1]
+    return(index)
+
+
+def _write_staged_index(index):
+    f = open(STAGED_INDEX, 'w')
+    try:
+        names = index.keys()
+        names.sort()
+        for name in names:
+            f.write('%s %s\n' %(name, index[name]))
+    finally:
+        f.close()
     return
 
 
-def _retrieve(url, mode='checkout', use_trunk=False, verbose=False):
+def _stage(path, cache_dir, copy=False, verbose=False):
+    """
+    Place the file or directory tree path in the current directory via the
+    policy cache. An existing copy with the same contents is left alone;
+    anything else by that name is replaced.
+    
+    @param path: the file or directory to stage.
+    @param cache_dir: the policy cache directory.
+    @param copy: if True, make a real (writable) copy instead of hardlinks.
+    
+    @return (name of the staged file or directory, hex digest)
+    """
+    cached, digest = _cache_path(path, cache_dir, verbose)
+    name = os.path.basename(cached)
+    index = _read_staged_index()
+    
+    if(not copy and index.get(name) == digest and os.path.exists(name)):
+        if(verbose):
+            print('%s unchanged (%s)' %(name, digest))
+        return(name, digest)
+    
+    if(os.path.isdir(name) and not os.path.islink(name)):
+        shutil.rmtree(name)
+    elif(os.path.lexists(name)):
+        os.unlink(name)
+    
+    if(copy):
+        print('cp %s %s' %(cached, name))
+        shutil.copyfile(cached, name)
+        if(index.has_key(name)):
+            del index[name]
+    else:
+        print('ln %s %s' %(cached, name))
+        _link_path(cached, name)
+        index[name] = digest
+    _write_staged_index(index)
+    return(name, digest)
+
+
+def _record_snapshot(staged, run_id, cache_dir, verbose=False):
+    """
+    Compute the hash of the whole set of staged policy files and record it,
+    with the hash of each file, under the run ID in SNAPSHOT_LOG in the
+    current directory and in the cache directory.
+    
+    @param staged: dictionary of staged name -> hex digest.
+    
+    @return the snapshot hash.
+    """
+    names = staged.keys()
+    names.sort()
+    digest = sha1()
+    for name in names:
+        digest.update('%s %s\n' %(name, staged[name]))
+    snapshot = digest.hexdigest()
+    
+    line = '%s %s %s %s\n' %(run_id or '-', 
+                             time.strftime('%Y-%m-%dT%H:%M:%S'),
+                             snapshot,
+                             ' '.join(['%s=%s' %(n, staged[n]) for n in names]))
+    for log_dir in ('.', cache_dir):
+        f = open(os.path.join(log_dir, SNAPSHOT_LOG), 'a')
+        try:
+            f.write(line)
+        finally:
+            f.close()
+    if(verbose):
+        print('Policy snapshot %s' %(snapshot))
+    return(snapshot)
+
+
+def _retrieve(url, mode='checkout', use_trunk=False, verbose=False,
+              cache_dir=POLICY_CACHE_DIR, copy=False):
+    """
+    Fetch a policy file or directory and stage it in the current directory.
+    
+    @return (name of the staged file or directory, hex digest)
+    """
     if(use_trunk):
-        return(_svn_retrieve(url, mode, verbose))
+        return(_svn_retrieve(url, mode, verbose, cache_dir, copy))
 
     # In what follows we assume that the SVN URLs are using trunk. If you 
     # changed them to use tickets or tags and did not change what follows you
@@ -222,28 +465,32 @@ def _retrieve(url, mode='checkout', use_trunk=False, verbose=False):
     else:
         raise(Exception('Fatal Error: I do not know what to do with %s' %(url)))
     
-    if(mode == 'export'):
-        print('cp %s %s' %(path, os.path.join('.', os.path.basename(path))))
-        shutil.copyfile(path, os.path.join('.', os.path.basename(path)))
-    else:
-        if(path.endswith('/')):
-            path = path[:-1]
-        print('cp -r %s %s' %(path, os.path.join('.', os.path.basename(path))))
-        shutil.copytree(path, os.path.join('.', os.path.basename(path)))
-    return
+    if(path.endswith('/')):
+        path = path[:-1]
+    return(_stage(path, cache_dir, copy, verbose))
 
 
-def _svn_retrieve(url, mode='checkout', verbose=False):
+def _svn_retrieve(url, mode='checkout', verbose=False,
+                  cache_dir=POLICY_CACHE_DIR, copy=False):
     if(mode not in SVN_MODES):
         raise(Exception('Unknown SVN retrieve mode %s' %(mode)))
     
-    cmd = 'svn %s %s' %(mode, url)
-    if(verbose):
-        print(cmd)
-    err = os.system(cmd)
-    if(err):
-        raise(IOError('%s: no such file or directory' %(url)))
-    return
+    # Whatever the mode, export into a scratch area so that the result can
+    # be hashed and cached like any other policy source.
+    if(url.endswith('/')):
+        url = url[:-1]
+    tmp = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp, os.path.basename(url))
+        cmd = 'svn export -q %s %s' %(url, path)
+        if(verbose):
+            print(cmd)
+        err = os.system(cmd)
+        if(err):
+            raise(IOError('%s: no such file or directory' %(url)))
+        return(_stage(path, cache_dir, copy, verbose))
+    finally:
+        shutil.rmtree(tmp)
 
 
 def _patch_master_policy(file_name, pipelines, verbose=False):
@@ -339,6 +586,9 @@ Pipeline Options
                            default: use %s
 
 General Options
+    -c,--cache        DIR: keep the content-addressed policy cache in DIR.
+                           default: $DC3PIPE_POLICY_CACHE or 
+                           ~/.dc3pipe_policy_cache
     -s,--setup     SCRIPT: use SCRIPT to setup the pipeline execution 
                            environment. SCRIPT will be passd directly to ORCA.
                            default: use the standard ORCA script.
@@ -386,6 +636,11 @@ Example Usage
                       action='store_true',
                       dest='use_trunk',
                       default=False)
+    parser.add_option('-c', '--cache',
+                      dest='cache_dir',
+                      type='str',
+                      default=POLICY_CACHE_DIR,
+                      help='specify the policy cache directory.')
     # Verbose flag
     parser.add_option('-v',
                       action='store_true',
@@ -442,5 +697,6 @@ Example Usage
     
     # Everything is fine: let's rock!
     sys.exit(run_dc3pipes(run_id, pipelines, nodes, master_policy,
-                          setup_script, options.use_trunk, options.verbose))
+                          setup_script, options.use_trunk, options.verbose,
+                          os.path.abspath(options.cache_dir)))
 
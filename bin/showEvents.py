@@ -26,11 +26,15 @@
 from __future__ import with_statement
 import sys, os, time, datetime
 import optparse, traceback
+from lsst.ctrl.mospipe.LazyImport import lazyModule
 import lsst.pex.harness.run as run
 from lsst.pex.logging import Log, LogRec
 from lsst.pex.exceptions import LsstException
 from lsst.daf.base import PropertySet
-import lsst.ctrl.events as events
+from lsst.ctrl.mospipe.EventMultiplexer import EventMultiplexer
+from lsst.ctrl.mospipe.LogBatching import UnbatchingReceiver
+
+events = lazyModule("lsst.ctrl.events")
 
 usage = """Usage: %prog [-vqsd] [-V int] [-w seconds] broker topic ..."""
 
@@ -40,7 +44,7 @@ cl = optparse.OptionParser(usage=usage, description=desc)
 run.addAllVerbosityOptions(cl, "V")
 cl.add_option("-w", "--wait-time", action="store", type="int", default=10, 
               dest="sleep", metavar="seconds",
-              help="seconds to sleep when no events available (def: 10)")
+              help="seconds to wait for events before checking again (def: 10)")
 
 logger = Log(Log.getDefaultLog(), "showEvents")
 VERB = logger.INFO-2
@@ -70,7 +74,7 @@ def showEvents(broker, topics, sleep=10):
     @param broker   the host where the event broker is running
     @param topics   a list (or space-delimited string) of event topics to
                        listen for
-    @parma sleep    seconds to sleep when no events are available
+    @parma sleep    seconds to wait for events before checking again
     """
     if not isinstance(topics, list):
         topics = topics.split()
@@ -84,47 +88,54 @@ def makeReceivers(broker, topics):
 
     out = []
     for topic in topics:
-        out.append(events.EventReceiver(broker, topic))
+        out.append(UnbatchingReceiver(events.EventReceiver(broker, topic)))
     return out
 
 def listen(receivers, sleep):
+    mux = EventMultiplexer(receivers)
+    mux.start()
     try:
         while True:
-            if checkTopics(receivers) == 0:
-                time.sleep(sleep)
+            checkTopics(mux, sleep)
     except KeyboardInterrupt:
         logger.log(VERB, "KeyboardInterrupt: stopping event monitoring")
+    mux.stop(False)
 
 
-def checkTopics(receivers):
+def checkTopics(mux, wait=0):
+    """
+    wait for events on any topic and print all that have arrived
+    @param mux     the EventMultiplexer listening to the topics
+    @param wait    seconds to wait for the first event
+    @return int   the number of events printed
+    """
     thresh = logger.getThreshold()
     quiet = thresh >= logger.WARN
     loud = thresh <= VERB
     silent = thresh > logger.FATAL
     count = 0
 
-    for rcvr in receivers:
-        logger.log(logger.DEBUG, "looking for " + rcvr.getTopicName())
-        event = rcvr.receive(0)
-        if event:
-            ts = time.time()
+    for topic, ts, event in mux.get(wait):
+        logger.log(logger.DEBUG, "received event from " + topic)
+        date = str(datetime.datetime.utcfromtimestamp(ts))
+        ts -= timeoffset
+        if event.exists("TIMESTAMP"):
+            ts = event.get("TIMESTAMP") / 1.0e9
             date = str(datetime.datetime.utcfromtimestamp(ts))
             ts -= timeoffset
-            if event.exists("TIMESTAMP"):
-                ts = event.get("TIMESTAMP") / 1.0e9
-                date = str(datetime.datetime.utcfromtimestamp(ts))
-                ts -= timeoffset
-            if event.exists("DATE"):
-                date = event.get("DATE")
-            count += 1
-
-            if silent:
-                continue
-            print "%s: DATE=%s, TIMESTAMP=%f" % (rcvr.getTopicName(), date, ts)
+        if event.exists("DATE"):
+            date = event.get("DATE")
+        count += 1
+
+        if silent:
+            continue
+        print "%s: DATE=%s, TIMESTAMP=%f" % (topic, date, ts)
                                                  
-            if not quiet:
-                print event.toString()
+        if not quiet:
+            print event.toString()
 
+    if count > 0:
+        sys.stdout.flush()
     return count
 
 if __name__ == "__main__":
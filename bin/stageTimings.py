@@ -0,0 +1,183 @@
+#! /usr/bin/env python
+
+# 
+# LSST Data Management System
+# Copyright 2008, 2009, 2010 LSST Corporation.
+# 
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the LSST License Statement and 
+# the GNU General Public License along with this program.  If not, 
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+#
+import sys, os, time
+import optparse, traceback
+import lsst.pex.harness.run as run
+from lsst.pex.logging import Log
+from lsst.ctrl.mospipe.StageTiming import TIMING_LOG, StageTimingAggregator, \
+     timingFromRecord
+from lsst.ctrl.mospipe.LogArchive import LogArchiveReader, recordFromEvent
+from lsst.ctrl.mospipe.LogBatching import UnbatchingReceiver
+
+usage = """Usage: %prog [-vqsd] [-V int] [-r runid] [-S id] [-m method] [-D seconds] [-H] {-b broker | -d archive}"""
+
+desc = """summarize the per-stage timings reported by instrumented pipeline
+stages, either by listening to the logging topic on an event broker (until
+interrupted or for a given duration) or by reading a log archive written by
+recordLogs.py.  For each stage, the call count and the distribution of wall
+and CPU times are printed in pipeline order.
+"""
+
+cl = optparse.OptionParser(usage=usage, description=desc)
+run.addAllVerbosityOptions(cl, "V")
+cl.add_option("-b", "--broker", action="store", type="str", default=None,
+              dest="broker", metavar="host",
+              help="listen for timings on this event broker")
+cl.add_option("-d", "--archive-dir", action="store", type="str",
+              default=None, dest="archive", metavar="dir",
+              help="read timings from this log archive")
+cl.add_option("-r", "--runid", action="store", type="str", default=None,
+              dest="runid", metavar="runid",
+              help="restrict to given run ID")
+cl.add_option("-S", "--slice", action="store", type="int", default=None,
+              dest="slice", metavar="id",
+              help="restrict to given slice ID")
+cl.add_option("-m", "--method", action="store", type="str", default=None,
+              dest="method", metavar="name",
+              help="restrict to preprocess, process or postprocess")
+cl.add_option("-D", "--duration", action="store", type="int", default=None,
+              dest="duration", metavar="seconds",
+              help="when listening, stop after this many seconds")
+cl.add_option("-H", "--histograms", action="store_true", default=False,
+              dest="histograms", help="print a wall-time histogram per stage")
+
+logger = Log(Log.getDefaultLog(), "stageTimings")
+VERB = logger.INFO-2
+
+def main():
+    """execute the stageTimings script"""
+
+    try:
+        (cl.opts, cl.args) = cl.parse_args()
+        Log.getDefaultLog().setThreshold(
+            run.verbosity2threshold(cl.opts.verbosity, 0))
+        if bool(cl.opts.broker) == bool(cl.opts.archive):
+            raise run.UsageError("Specify exactly one of -b or -d")
+
+        def accept(timing):
+            if cl.opts.runid is not None and timing["runId"] != cl.opts.runid:
+                return False
+            if cl.opts.slice is not None and timing["sliceId"] != cl.opts.slice:
+                return False
+            if cl.opts.method is not None and \
+               timing.get("method") != cl.opts.method:
+                return False
+            return True
+
+        if cl.opts.archive:
+            timings = archivedTimings(cl.opts.archive, cl.opts.runid,
+                                      cl.opts.slice)
+        else:
+            timings = liveTimings(cl.opts.broker, cl.opts.duration)
+
+        agg = StageTimingAggregator()
+        try:
+            for timing in timings:
+                if accept(timing):
+                    agg.add(timing)
+        except KeyboardInterrupt:
+            logger.log(VERB, "KeyboardInterrupt: stopping timing collection")
+
+        printSummary(agg, cl.opts.histograms)
+
+    except run.UsageError, e:
+        print >> sys.stderr, "%s: %s" % (cl.get_prog_name(), e)
+        sys.exit(1)
+    except Exception, e:
+        logger.log(Log.FATAL, str(e))
+        traceback.print_exc(file=sys.stderr)
+        sys.exit(2)
+
+def archivedTimings(archive, runid=None, sliceid=None):
+    """
+    return an iterator over the timings recorded in a log archive
+    """
+    reader = LogArchiveReader(archive)
+    for rec in reader.query(runId=runid, sliceId=sliceid,
+                            lognames=[TIMING_LOG]):
+        timing = timingFromRecord(rec)
+        if timing is not None:
+            yield timing
+
+def liveTimings(broker, duration=None):
+    """
+    return an iterator over the timings arriving on the logging topic
+    """
+    import lsst.ctrl.events as events
+    rcvr = UnbatchingReceiver(
+        events.EventReceiver(broker, events.EventLog.getLoggingTopic()))
+    stop = None
+    if duration is not None:
+        stop = time.time() + duration
+    while stop is None or time.time() < stop:
+        wait = 1000
+        if stop is not None:
+            wait = max(0, min(wait, int(1000 * (stop - time.time()))))
+        event = rcvr.receive(wait)
+        if event is None or event.getString("LOG", "") != TIMING_LOG:
+            continue
+        timing = timingFromRecord(recordFromEvent(event))
+        if timing is not None:
+            yield timing
+
+def printSummary(agg, histograms=False, dest=sys.stdout):
+    """
+    print the per-stage timing summary
+    @param agg         the StageTimingAggregator holding the timings
+    @param histograms  if True, also print a wall-time histogram per stage
+    @param dest        the file stream to print to
+    """
+    keys = agg.keys()
+    if not keys:
+        print >> dest, "No stage timings found"
+        return
+
+    grand = sum([agg.wall[k].total for k in keys]) or 1.0e-9
+    print >> dest, "%3s %-28s %-11s %6s %9s %9s %9s %9s %9s %6s %5s" % \
+          ("idx", "stage", "method", "calls", "mean", "p50", "p95", "max",
+           "cpu", "%wall", "fail")
+    for key in keys:
+        wall, cpu = agg.wall[key], agg.cpu[key]
+        print >> dest, \
+              "%3d %-28s %-11s %6d %9.3f %9.3f %9.3f %9.3f %9.3f %6.1f %5d" % \
+              (key[0], key[1][:28], key[2], wall.count, wall.mean(),
+               wall.quantile(0.5), wall.quantile(0.95), wall.max, cpu.mean(),
+               100.0 * wall.total / grand, agg.failed[key])
+
+    if histograms:
+        for key in keys:
+            wall = agg.wall[key]
+            print >> dest
+            print >> dest, "%d %s.%s wall time (s):" % key
+            peak = max(wall.bins.values())
+            for b in sorted(wall.bins.keys()):
+                lo, hi = wall.binEdges(b)
+                n = wall.bins[b]
+                print >> dest, "  %9.4f - %9.4f %6d %s" % \
+                      (lo, hi, n, "#" * max(1, int(50.0 * n / peak)))
+
+if __name__ == "__main__":
+    main()
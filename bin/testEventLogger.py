@@ -24,7 +24,7 @@
 
 #
 from __future__ import with_statement
-import sys, os, time, datetime
+import sys, os, time, datetime, socket, threading
 import optparse, traceback
 import lsst.pex.harness.run as run
 import lsst.pex.logging as logging
@@ -32,10 +32,20 @@ from lsst.pex.logging import Log, LogRec
 from lsst.pex.exceptions import LsstException
 from lsst.daf.base import PropertySet
 import lsst.ctrl.events as events
+from lsst.ctrl.mospipe.StageTiming import TimingHistogram
+from lsst.ctrl.mospipe.LogMatchers import LogMessageFilter
+from lsst.ctrl.mospipe.LogBatching import LogBatcher, UnbatchingReceiver
+from lsst.ctrl.mospipe.LogSampling import samplingTransmitterFromPolicy, \
+                                         SUMMARY_LOG
 
-usage = """Usage: %prog [-vqsd] [-V int] [broker]"""
+usage = """Usage: %prog [-vqsd] [-V int] [-n slices [-m stages] [-R rate ...] [-z bytes] [-D seconds] [-w seconds] [-B count [-b ms]] [-P policy] [-k]] [broker]"""
 
-desc = """send log messages as events to a log broker."""
+desc = """send log messages as events to a log broker.  With -n, act as a
+load generator:  simulate the log traffic of the given number of slices
+running the given number of stages at one or more total message rates, and
+report, for each rate, the sustained throughput and the delivery latency
+seen by a watchLogs-style listener.
+"""
 
 cl = optparse.OptionParser(usage=usage, description=desc)
 run.addAllVerbosityOptions(cl, "V")
@@ -60,6 +70,36 @@ cl.add_option("-T", "--log-topic", action="store", type="str",
               help="event topic name (def: 'LSSTLogging')")
 cl.add_option("-i", "--read-stdin", action="store_true", default=False,
               dest="stdin", help="read messages from standard input")
+cl.add_option("-n", "--slices", action="store", type="int", default=0,
+              dest="nslices", metavar="count",
+              help="generate load from this many simulated slices")
+cl.add_option("-m", "--stages", action="store", type="int", default=10,
+              dest="nstages", metavar="count",
+              help="number of simulated stages per slice (def: 10)")
+cl.add_option("-R", "--rate", action="append", type="float", default=None,
+              dest="rates", metavar="msgs/s",
+              help="total message rate; repeat to step through rates (def: 1000)")
+cl.add_option("-z", "--size", action="store", type="int", default=100,
+              dest="size", metavar="bytes",
+              help="length of each message text (def: 100)")
+cl.add_option("-D", "--duration", action="store", type="int", default=10,
+              dest="duration", metavar="seconds",
+              help="seconds to send at each rate (def: 10)")
+cl.add_option("-w", "--wait-time", action="store", type="int", default=5,
+              dest="wait", metavar="seconds",
+              help="seconds to wait for stragglers at each rate (def: 5)")
+cl.add_option("-B", "--batch", action="store", type="int", default=0,
+              dest="batch", metavar="count",
+              help="send messages in batches of up to this many per slice")
+cl.add_option("-b", "--batch-delay", action="store", type="int", default=500,
+              dest="batchdelay", metavar="ms",
+              help="maximum time to hold a batch (def: 500)")
+cl.add_option("-P", "--sampling-policy", action="store", type="str",
+              default=None, dest="sampling", metavar="file",
+              help="apply this log sampling policy (e.g. logSampling.paf)")
+cl.add_option("-k", "--local", action="store_true", default=False,
+              dest="local",
+              help="send through the in-process LocalEventBroker")
 
 logger = Log(Log.getDefaultLog(), "showEvents")
 VERB = logger.INFO-2
@@ -81,6 +121,24 @@ def main():
         broker = None
         if len(cl.args) > 0:
             broker = cl.args[0]
+
+        if cl.opts.nslices > 0:
+            if broker is None and not cl.opts.local:
+                raise run.UsageError("Load generation needs a broker or -k")
+            sampling = None
+            if cl.opts.sampling:
+                from lsst.pex.policy import Policy
+                sampling = Policy.createPolicy(cl.opts.sampling)
+            results = generateLoad(broker, cl.opts.runid, cl.opts.nslices,
+                                   cl.opts.nstages, cl.opts.rates or [1000],
+                                   cl.opts.size, cl.opts.duration,
+                                   cl.opts.pipeline or "IP",
+                                   cl.opts.logname, cl.opts.logtopic,
+                                   cl.opts.wait, cl.opts.batch,
+                                   cl.opts.batchdelay, sampling)
+            printLoadResults(results)
+            return
+
         input = None
         if cl.opts.stdin:
             input = sys.stdin
@@ -154,6 +212,171 @@ def setEventLogger(broker, runid, sliceid, verbose=False, topic="LSSTLogging"):
     frmtr = logging.IndentedFormatter(verbose)
     deflog.addDestination(logging.cout, Log.DEBUG, frmtr)
 
+def makeLogEvent(runid, pipeline, sliceid, stageid, logname, level, text):
+    """
+    create an event carrying the properties that an EventLog attaches to
+    a message from a pipeline slice
+    """
+    event = PropertySet()
+    event.setString("LOG", logname)
+    event.setInt("LEVEL", level)
+    event.setString("COMMENT", text)
+    event.setString("runId", runid)
+    event.setInt("sliceId", sliceid)
+    event.setInt("stageId", stageid)
+    event.setString("pipeline", pipeline)
+    event.setString("hostId", socket.gethostname())
+    return event
+
+def generateLoad(broker, runid, nslices, nstages, rates, size=100,
+                 duration=10, pipeline="IP", logname=None,
+                 logtopic="LSSTLogging", wait=5, batch=0, batchdelay=500,
+                 sampling=None):
+    """
+    send simulated pipeline log traffic at each of the given rates in turn
+    while a listener measures what arrives.
+    @param broker    the host running the event broker, or None to use the
+                        in-process LocalEventBroker
+    @param runid     the run ID to attach to messages; each rate sends with
+                        its own run ID, runid-r<n>, so that messages left
+                        over from one rate are not counted in the next
+    @param nslices   the number of slices to simulate
+    @param nstages   the number of stages per slice to simulate
+    @param rates     a list of total message rates (messages/s)
+    @param size      the length of each message text
+    @param duration  the seconds to send at each rate
+    @param pipeline  the pipeline name to attach to messages
+    @param logname   the log name to send to; by default, each message goes
+                        to a per-stage name like the harness uses
+    @param logtopic  the event topic to use
+    @param wait      seconds to wait for outstanding messages at each rate
+    @param batch     if greater than 1, send through a LogBatcher holding up
+                        to this many messages per slice
+    @param batchdelay  the maximum milliseconds the LogBatcher holds a batch
+    @param sampling  if not None, a log sampling policy to apply before
+                        sending
+    @return list   a dictionary of results for each rate
+    """
+    if broker is None:
+        import lsst.ctrl.mospipe.LocalEventBroker as evsys
+        host = "localhost"
+    else:
+        evsys = events
+        host = broker
+
+    rcvr = UnbatchingReceiver(evsys.EventReceiver(host, logtopic))
+    msgfilter = LogMessageFilter()
+    text = "x" * max(0, size - 9)
+
+    results = []
+    for step, rate in enumerate(rates):
+        logger.log(VERB, "Sending %.0f messages/s from %d slices x %d stages" %
+                   (rate, nslices, nstages))
+        steprunid = "%s-r%d" % (runid, step)
+        # a new transmitter chain for each rate, so that batches and
+        # sampling summaries carry this rate's run ID
+        trx = evsys.EventTransmitter(host, logtopic)
+        batcher = None
+        if batch > 1:
+            trx = batcher = LogBatcher(trx, batch, batchdelay)
+        if sampling is not None:
+            trx = samplingTransmitterFromPolicy(trx, sampling)
+
+        stats = { "rate": rate, "sent": 0, "received": 0, "dropped": 0,
+                  "first": None,
+                  "last": None, "latency": TimingHistogram() }
+        sending = threading.Event()
+        sending.set()
+        stopping = threading.Event()
+
+        def receiveAll(stats, sending, stopping):
+            while not stopping.isSet():
+                event = rcvr.receive(500)
+                if event is None:
+                    if not sending.isSet() and \
+                       (stats["received"] + stats["dropped"] >=
+                        stats["sent"] or
+                        time.time() > stats["sendEnd"] + wait):
+                        break
+                    continue
+                now = time.time()
+                if not msgfilter.accepts(event) or \
+                   event.getString("runId", "") != steprunid:
+                    continue
+                if event.getString("LOG", "") == SUMMARY_LOG:
+                    stats["dropped"] += event.getInt("dropped", 0)
+                    continue
+                stats["received"] += 1
+                if stats["first"] is None:
+                    stats["first"] = now
+                stats["last"] = now
+                stats["latency"].add(now - event.getDouble("sendTime"))
+
+        listener = threading.Thread(target=receiveAll,
+                                    args=(stats, sending, stopping))
+        listener.setDaemon(True)
+        listener.start()
+
+        seq = 0
+        tick = 0.01
+        start = time.time()
+        stats["sendStart"] = start
+        stats["sendEnd"] = start + duration
+        while True:
+            now = time.time()
+            if now - start >= duration:
+                break
+            due = int((now - start + tick) * rate)
+            while seq < due:
+                sliceid = seq % nslices
+                stageid = (seq // nslices) % nstages
+                name = logname or "harness.slice.visit.stage%d.process" % \
+                                  stageid
+                event = makeLogEvent(steprunid, pipeline, sliceid, stageid, name,
+                                     Log.DEBUG, "%08d %s" % (seq, text))
+                event.setDouble("sendTime", time.time())
+                trx.publish(event)
+                seq += 1
+            pause = start + float(seq) / rate - time.time()
+            if pause > 0:
+                time.sleep(pause)
+        if batch > 1 or sampling is not None:
+            trx.flush()
+        if batcher is not None:
+            # the last partial batch is published before the listener
+            # starts counting what has not arrived as lost
+            batcher.close()
+        stats["sent"] = seq
+        stats["sendEnd"] = time.time()
+        sending.clear()
+        # the listener waits up to "wait" seconds for delivery
+        listener.join(wait + 1)
+        # stop the listener before the next rate shares its receiver
+        stopping.set()
+        listener.join()
+        results.append(stats)
+
+    return results
+
+def printLoadResults(results, dest=sys.stdout):
+    print >> dest, "%10s %10s %10s %8s %8s %9s %9s %9s" % \
+          ("target/s", "sent/s", "recv/s", "dropped", "lost", "p50(ms)",
+           "p95(ms)", "p99(ms)")
+    for stats in results:
+        sendtime = (stats["sendEnd"] - stats["sendStart"]) or 1.0e-9
+        recvrate = 0.0
+        if stats["first"] is not None:
+            recvrate = stats["received"] / \
+                       max(stats["last"] - stats["sendStart"], 1.0e-9)
+        lat = stats["latency"]
+        print >> dest, "%10.0f %10.1f %10.1f %8d %8d %9.2f %9.2f %9.2f" % \
+              (stats["rate"], stats["sent"] / sendtime, recvrate,
+               stats["dropped"],
+               stats["sent"] - stats["received"] - stats["dropped"],
+               1000 * lat.quantile(0.5),
+               1000 * lat.quantile(0.95), 1000 * lat.quantile(0.99))
+    dest.flush()
+
 if __name__ == "__main__":
     main()
         
@@ -0,0 +1,196 @@
+#! /usr/bin/env python
+
+# 
+# LSST Data Management System
+# Copyright 2008, 2009, 2010 LSST Corporation.
+# 
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the LSST License Statement and 
+# the GNU General Public License along with this program.  If not, 
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+#
+import sys, os, time
+import optparse, traceback
+import lsst.pex.harness.run as run
+from lsst.pex.logging import Log
+from lsst.ctrl.mospipe.StageTiming import TIMING_LOG, timingFromRecord
+from lsst.ctrl.mospipe.LogArchive import LogArchiveReader, recordFromEvent
+from lsst.ctrl.mospipe.LogBatching import UnbatchingReceiver
+from lsst.ctrl.mospipe.VisitLatency import VisitLatencyTracker
+
+usage = """Usage: %prog [-vqsd] [-V int] [-r runid] [-t topic] [-n slices] [-l stage] [-w seconds] {-b broker | -d archive}"""
+
+desc = """measure the end-to-end latency of each exposure, from the
+publication of its trigger event to the end of the last pipeline stage on
+the slowest slice, and summarize the p50/p95/p99 latencies and the time
+each stage adds.  Either listen to an event broker (printing each visit as
+it completes and the summary when interrupted) or read a log archive
+written by recordLogs.py with the trigger topic recorded via -e.
+"""
+
+cl = optparse.OptionParser(usage=usage, description=desc)
+run.addAllVerbosityOptions(cl, "V")
+cl.add_option("-b", "--broker", action="store", type="str", default=None,
+              dest="broker", metavar="host",
+              help="listen for events on this event broker")
+cl.add_option("-d", "--archive-dir", action="store", type="str",
+              default=None, dest="archive", metavar="dir",
+              help="read events from this log archive")
+cl.add_option("-r", "--runid", action="store", type="str", default=None,
+              dest="runid", metavar="runid",
+              help="restrict to given run ID")
+cl.add_option("-t", "--topic", action="store", type="str",
+              default="triggerImageprocEvent", dest="topic", metavar="topic",
+              help="the visit trigger event topic (def: triggerImageprocEvent)")
+cl.add_option("-n", "--slices", action="store", type="int", default=None,
+              dest="nslices", metavar="count",
+              help="the number of slices in the pipeline")
+cl.add_option("-l", "--last-stage", action="store", type="int", default=None,
+              dest="laststage", metavar="index",
+              help="the position of the last stage in the pipeline")
+cl.add_option("-w", "--settle-time", action="store", type="int", default=60,
+              dest="settle", metavar="seconds",
+              help="consider a visit done after this long without news (def: 60)")
+cl.add_option("-e", "--trigger-age", action="store", type="int",
+              default=3600, dest="triggerage", metavar="seconds",
+              help="forget a trigger with no timing after this long (def: 3600)")
+cl.add_option("-m", "--max-triggers", action="store", type="int",
+              default=1000, dest="maxtriggers", metavar="count",
+              help="the most triggers with no timing to keep (def: 1000)")
+
+logger = Log(Log.getDefaultLog(), "visitLatency")
+VERB = logger.INFO-2
+
+def main():
+    """execute the visitLatency script"""
+
+    try:
+        (cl.opts, cl.args) = cl.parse_args()
+        Log.getDefaultLog().setThreshold(
+            run.verbosity2threshold(cl.opts.verbosity, 0))
+        if bool(cl.opts.broker) == bool(cl.opts.archive):
+            raise run.UsageError("Specify exactly one of -b or -d")
+
+        tracker = VisitLatencyTracker(cl.opts.nslices, cl.opts.laststage,
+                                      cl.opts.settle, cl.opts.triggerage,
+                                      cl.opts.maxtriggers)
+        if cl.opts.archive:
+            trackArchive(tracker, cl.opts.archive, cl.opts.topic,
+                         cl.opts.runid)
+        else:
+            trackLive(tracker, cl.opts.broker, cl.opts.topic, cl.opts.runid)
+        printSummary(tracker.summary())
+
+    except run.UsageError, e:
+        print >> sys.stderr, "%s: %s" % (cl.get_prog_name(), e)
+        sys.exit(1)
+    except Exception, e:
+        logger.log(Log.FATAL, str(e))
+        traceback.print_exc(file=sys.stderr)
+        sys.exit(2)
+
+def addRecord(tracker, rec, topic, runid=None, now=None):
+    """
+    feed an archive-style record to the tracker
+    """
+    if rec["LOG"] == topic:
+        props = rec["PROPS"]
+        if props.has_key("exposureId"):
+            tracker.addTrigger(props["exposureId"],
+                               props.get("publishTime", rec["ts"]), now)
+        return
+    timing = timingFromRecord(rec)
+    if timing is not None and (runid is None or timing["runId"] == runid):
+        tracker.addTiming(timing, now)
+
+def trackArchive(tracker, archive, topic, runid=None):
+    """
+    compute latencies from a log archive
+    """
+    reader = LogArchiveReader(archive)
+    for rec in reader.query(lognames=[TIMING_LOG, topic]):
+        addRecord(tracker, rec, topic, runid, rec["ts"])
+    tracker.collect(flush=True)
+
+def trackLive(tracker, broker, topic, runid=None):
+    """
+    compute latencies from events as they arrive, until interrupted
+    """
+    import lsst.ctrl.events as events
+    from lsst.ctrl.mospipe.EventMultiplexer import EventMultiplexer
+
+    mux = EventMultiplexer(
+        [UnbatchingReceiver(events.EventReceiver(broker,
+                                       events.EventLog.getLoggingTopic())),
+         events.EventReceiver(broker, topic)])
+    mux.start()
+    logger.log(VERB, "Tracking visits triggered on %s" % topic)
+    try:
+        try:
+            while True:
+                for etopic, ts, event in mux.get(1.0):
+                    if etopic == topic:
+                        if event.exists("exposureId"):
+                            pubtime = ts
+                            if event.exists("publishTime"):
+                                pubtime = event.getDouble("publishTime")
+                            tracker.addTrigger(event.get("exposureId"),
+                                               pubtime, ts)
+                    elif event.getString("LOG", "") == TIMING_LOG:
+                        addRecord(tracker, recordFromEvent(event, ts), topic,
+                                  runid, ts)
+                for visit in tracker.collect():
+                    printVisit(visit)
+        except KeyboardInterrupt:
+            logger.log(VERB, "KeyboardInterrupt: stopping visit tracking")
+    finally:
+        mux.stop(False)
+    for visit in tracker.collect(flush=True):
+        printVisit(visit)
+
+def printVisit(visit, dest=sys.stdout):
+    latency = visit.latency()
+    if latency is None:
+        latency = "?"
+    else:
+        latency = "%.2f" % latency
+    print >> dest, "exposure %s: latency=%s s, processing=%.2f s" % \
+          (visit.exposureId, latency, visit.processingTime())
+    dest.flush()
+
+def printSummary(summary, dest=sys.stdout):
+    print >> dest, "%d visits completed" % summary["count"]
+    if summary["expired"]:
+        print >> dest, "%d triggers without stage timings dropped" % \
+              summary["expired"]
+    for key in ("latency", "processing"):
+        stats = summary[key]
+        if stats is None:
+            continue
+        print >> dest, \
+              "%-10s (s): p50=%.2f p95=%.2f p99=%.2f mean=%.2f max=%.2f" % \
+              (key, stats["p50"], stats["p95"], stats["p99"], stats["mean"],
+               stats["max"])
+    if summary["stages"]:
+        print >> dest, "%3s %-28s %10s %10s %10s" % \
+              ("idx", "stage", "barrier", "p95", "wall")
+        for idx, name, barrier, p95, wall in summary["stages"]:
+            print >> dest, "%3d %-28s %10.3f %10.3f %10.3f" % \
+                  (idx, name[:28], barrier, p95, wall)
+
+if __name__ == "__main__":
+    main()
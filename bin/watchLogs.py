@@ -26,11 +26,15 @@
 from __future__ import with_statement
 import sys, os, time, datetime
 import optparse, traceback
+from lsst.ctrl.mospipe.LazyImport import lazyModule
 import lsst.pex.harness.run as run
 from lsst.pex.logging import Log, LogRec
 from lsst.pex.exceptions import LsstException
 from lsst.daf.base import PropertySet
-import lsst.ctrl.events as events
+from lsst.ctrl.mospipe.LogMatchers import LogMessageFilter
+from lsst.ctrl.mospipe.LogBatching import UnbatchingReceiver
+
+events = lazyModule("lsst.ctrl.events")
 
 usage = """Usage: %prog [-vqsd] [-V int] [-w seconds] [-S id] [-X hostlist|-H hostlist] broker [logname ...]"""
 
@@ -45,7 +49,7 @@ cl = optparse.OptionParser(usage=usage, description=desc)
 run.addAllVerbosityOptions(cl, "V")
 cl.add_option("-w", "--wait-time", action="store", type="int", default=10, 
               dest="sleep", metavar="seconds",
-              help="seconds to sleep when no events available (def: 10)")
+              help="seconds to wait for a message before checking again (def: 10)")
 cl.add_option("-S", "--slice", action="store", type="int", default=None, 
               dest="slice", metavar="id",
               help="restrict to given slice ID")
@@ -107,7 +111,7 @@ def watchLogs(broker, lognames, sleep=10, sliceid=None,
     @param broker    the host where the event broker is running
     @param lognames  a list (or space-delimited string) of log names to
                        listen for
-    @parma sleep     seconds to sleep when no events are available
+    @parma sleep     seconds to wait for a message before checking again
     @param sliceid   restrict to the given sliceid.  If none, print all slices
     @param hosts     restrict to the given list of host origins
     @param hostexclude  if True, the hosts lists are hosts to ignore 
@@ -122,58 +126,46 @@ def watchLogs(broker, lognames, sleep=10, sliceid=None,
 
     logger.log(VERB, "Watching for log names: " + ", ".join(lognames))
 
-    rcvr = events.EventReceiver(broker, "LSSTLogging")
+    rcvr = UnbatchingReceiver(events.EventReceiver(broker, "LSSTLogging"))
     listen(rcvr, sys.stdout, lognames, sleep, sliceid, hosts, hostexclude,
            minimport, maximport)
 
 def listen(receiver, dest, lognames, sleep, sliceid=None, hosts=None,
            hostexclude=False, minimport=None, maximport=None):
            
+    msgfilter = LogMessageFilter(lognames, sliceid, hosts, hostexclude,
+                                 minimport, maximport)
     try:
         while True:
-            if checkMessages(receiver, dest, lognames, sliceid,
-                             hosts, hostexclude, minimport, maximport) == 0:
-                time.sleep(sleep)
+            checkMessages(receiver, dest, msgfilter, 1000 * sleep)
     except KeyboardInterrupt:
         logger.log(VERB, "KeyboardInterrupt: stopping event monitoring")
 
-def checkMessages(receiver, dest, lognames, sliceid=None,
-                  hosts=None, hostexclude=False,
-                  minimport=None, maximport=None):
+def checkMessages(receiver, dest, msgfilter, timeout=0):
+    """
+    wait for a message to arrive and print it along with any others
+    already waiting that pass the given filter.
+    @param receiver   the event receiver to read messages from
+    @param dest       the file stream to print messages to
+    @param msgfilter  a LogMessageFilter selecting the messages to print
+    @param timeout    milliseconds to wait for the first message
+    @return int   the number of messages that passed the filter
+    """
     thresh = logger.getThreshold()
     quiet = thresh >= logger.WARN
     loud = thresh <= VERB
     silent = thresh > logger.FATAL
     count = 0
 
-    likenames = map(lambda x: x[:-1],
-                   filter(lambda y: y.endswith('*'), lognames))
-    names = filter(lambda y: not y.endswith('*'), lognames)
-
-    while True:
-        event = receiver.receive(0)
-        if not event:
-            break
+    event = receiver.receive(timeout)
+    while event:
         ts = time.time()
-        name = event.getString("LOG", "")
-        if lognames and name not in names and \
-           not bool(filter(lambda x: name.startswith(x), likenames)):
+        if not msgfilter.accepts(event):
+            event = receiver.receive(0)
             continue
-        if lognames and sliceid and event.getInt("sliceId", -2) != sliceid:
-            continue
-        if hosts:
-            host = event.getString('hostId', "")
-            if hostexclude:
-                if bool(filter(lambda x: host.startswith(x), hosts)):
-                    continue
-            else:
-                if not bool(filter(lambda x: host.startswith(x), hosts)):
-                    continue
 
+        name = event.getString("LOG", "")
         level = event.getInt("LEVEL", 0)
-        if minimport is not None and level < minimport:  continue
-        if maximport is not None and level > maximport:  continue
-        
         date = str(datetime.datetime.utcfromtimestamp(ts))
         ts -= timeoffset
         if event.exists("TIMESTAMP"):
@@ -192,13 +184,16 @@ def checkMessages(receiver, dest, lognames, sliceid=None,
             lev = "DEBUG "
         count += 1
         
-        if silent:
-            continue
-        for comm in event.getArrayString("COMMENT"):
-            print "%s%s (%f): %s" % (lev, name, ts, comm)
-        if not quiet:
-            print event.toString()
+        if not silent:
+            for comm in event.getArrayString("COMMENT"):
+                print >> dest, "%s%s (%f): %s" % (lev, name, ts, comm)
+            if not quiet:
+                print >> dest, event.toString()
+
+        event = receiver.receive(0)
 
+    if count > 0:
+        dest.flush()
     return count
 
 if __name__ == "__main__":
@@ -0,0 +1,266 @@
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+
+"""
+Dynamic assignment of amplifiers to slices.
+
+Normally SliceInfoStage binds each slice to exactly one amplifier, so a
+camera with N amplifiers needs N slices.  AmpWorkQueueStage instead runs a
+chain of child stages (the rest of the per-amp pipeline) inside each slice,
+once for every amplifier the slice takes from a per-visit work queue.
+Slices that finish an amplifier early simply take another, so the load
+balances itself and any number of slices can process the whole mosaic.
+
+The work queue is a directory on a filesystem shared by all slices (by
+default "ampqueue" under the pipeline's working directory).  The master
+creates one subdirectory per visit in preprocess(), first removing any
+left there by an earlier run with the same run ID (whose claims would
+otherwise leave every amplifier taken); a slice claims work
+item i by creating the file "i" there with O_EXCL, and the master removes
+the directory in postprocess(), after every slice is done.
+
+Work item i stands for the amplifier the i-th slice would process under
+SliceInfoStage:  the ccdIdFormula, ampIdFormula and hduIdFormula of the
+stage policy are evaluated with sliceId set to i.  Each amplifier is
+processed on a fresh clipboard holding the items of the incoming one plus
+ccdId, ampId and hduId; the incoming clipboard is passed on with an
+"ampsProcessed" item listing the work items this slice did.
+
+Stages that need the results of every amplifier of a CCD (such as loading
+the sources of the whole CCD) cannot run in the same chain, since other
+slices may still be working on its other amplifiers.  For these, split the
+chain between two AmpWorkQueueStages:  the first, with keepAmps set, puts
+its per-amplifier clipboards on the slice's clipboard as "ampClipboards";
+the second, with reuseAmps set, claims nothing and continues the chain on
+the amplifiers this slice processed in the first, after the barrier
+between the two stages.
+
+The child stages are listed in the stage policy as childStage entries
+with the same stageName and stagePolicy parameters as appStage entries of
+a pipeline policy.  Their process() methods are run in the slices, once
+per amplifier.  On the master, their preprocess() methods are run, each
+on the incoming clipboard, in this stage's preprocess(), and their
+postprocess() methods in this stage's postprocess(), after every slice is
+done with the chain (so that, for instance, a CcdWcsBroadcastStage removes
+its work directory).  Child i (counting from 1) is given the stageId
+100 * (this stage's stageId) + i so that their timings can be told apart.
+"""
+
+import os, errno, shutil
+
+from lsst.pex.harness.Stage import Stage
+from lsst.pex.harness.Clipboard import Clipboard
+import lsst.pex.logging as pexLog
+from lsst.ctrl.mospipe.StageTiming import timed, exposureIdOf
+from lsst.ctrl.mospipe.LogBatching import getLog
+
+def loadStageClass(name):
+    """
+    return the Stage class with the given fully qualified name
+    """
+    module, cls = name.rsplit(".", 1)
+    return getattr(__import__(module, {}, {}, [cls]), cls)
+
+class ListQueue(object):
+    """
+    a minimal in-process stand-in for the harness's clipboard Queue
+    """
+    def __init__(self):
+        self.items = []
+
+    def addDataset(self, clipboard):
+        self.items.append(clipboard)
+
+    def getNextDataset(self):
+        return self.items.pop(0)
+
+    def size(self):
+        return len(self.items)
+
+class AmpWorkQueueStage(Stage):
+    '''Run a chain of child stages once for each amplifier a slice takes
+    from a per-visit work queue.'''
+
+    def __init__(self, stageId=-1, stagePolicy=None):
+        Stage.__init__(self, stageId, stagePolicy)
+        self.log = getLog("mospipe.AmpWorkQueueStage")
+        self.visits = 0
+        self.children = []
+        if stagePolicy is not None and stagePolicy.exists("childStage"):
+            for i, child in enumerate(stagePolicy.getArray("childStage")):
+                cls = loadStageClass(child.getString("stageName"))
+                childPolicy = None
+                if child.exists("stagePolicy"):
+                    childPolicy = child.getPolicy("stagePolicy")
+                self.children.append(cls(100 * stageId + i + 1, childPolicy))
+        self.queues = [ListQueue() for i in xrange(len(self.children) + 1)]
+
+    def _forward(self, name, *args):
+        """
+        call the named setter on this stage and its children
+        """
+        method = getattr(Stage, name, None)
+        if method is not None:
+            method(self, *args)
+        for child in self.children:
+            if hasattr(child, name):
+                getattr(child, name)(*args)
+
+    def setRank(self, rank):
+        self._forward("setRank", rank)
+
+    def setUniverseSize(self, size):
+        self._forward("setUniverseSize", size)
+
+    def setRun(self, run):
+        self._forward("setRun", run)
+
+    def setLookup(self, lookup):
+        self._forward("setLookup", lookup)
+
+    def setEventBrokerHost(self, host):
+        self._forward("setEventBrokerHost", host)
+
+    def initialize(self, outQueue, inQueue):
+        Stage.initialize(self, outQueue, inQueue)
+        for i, child in enumerate(self.children):
+            child.initialize(self.queues[i + 1], self.queues[i])
+
+    def _queueDir(self, clipboard):
+        # every process sees the same sequence of visits, so a count of
+        # them identifies the visit even without an exposureId
+        self.visits += 1
+        root = "ampqueue"
+        if self._policy.exists("queueDir"):
+            root = self._policy.getString("queueDir")
+        return os.path.join(root, "%s-%d" % (exposureIdOf(clipboard),
+                                             self.visits))
+
+    def _makeDir(self, dir):
+        try:
+            os.makedirs(dir)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def _flag(self, name):
+        return self._policy.exists(name) and self._policy.getBool(name)
+
+    @timed
+    def preprocess(self):
+        self.activeClipboard = self.inputQueue.getNextDataset()
+        self.activeDir = None
+        if not self._flag("reuseAmps"):
+            self.activeDir = self._queueDir(self.activeClipboard)
+            # the slices only claim work after the master's preprocess
+            if os.path.exists(self.activeDir):
+                self.log.log(pexLog.Log.WARN,
+                             "removing stale work queue %s" % self.activeDir)
+                shutil.rmtree(self.activeDir)
+            self._makeDir(self.activeDir)
+        for i, child in enumerate(self.children):
+            self.queues[i].addDataset(self.activeClipboard)
+            child.preprocess()
+
+    @timed
+    def postprocess(self):
+        for child in self.children:
+            child.postprocess()
+        # the children pass on the clipboard they were given, which is
+        # this stage's
+        for queue in self.queues:
+            while queue.size() > 0:
+                queue.getNextDataset()
+        if self.activeDir is not None:
+            shutil.rmtree(self.activeDir, True)
+        self.outputQueue.addDataset(self.activeClipboard)
+
+    def _claim(self, dir, item):
+        """
+        return True if this slice is the first to claim the work item
+        """
+        try:
+            fd = os.open(os.path.join(dir, str(item)),
+                         os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError, e:
+            if e.errno == errno.EEXIST:
+                return False
+            raise
+        os.write(fd, "%d\n" % self.getRank())
+        os.close(fd)
+        return True
+
+    def _claimedAmps(self, clipboard):
+        """
+        return a list of (work item, clipboard) for the amplifiers this
+        slice claims from the visit's work queue
+        """
+        dir = self._queueDir(clipboard)
+        self._makeDir(dir)
+
+        nAmps = self._policy.get("nAmps")
+        nCcds = self._policy.get("nCcds")
+        ccdFormula = self._policy.get("ccdIdFormula")
+        ampFormula = self._policy.get("ampIdFormula")
+        hduFormula = self._policy.get("hduIdFormula")
+
+        for sliceId in xrange(nAmps * nCcds):
+            if not self._claim(dir, sliceId):
+                continue
+            amp = Clipboard()
+            for key in clipboard.getKeys():
+                if key != "ampClipboards":
+                    amp.put(key, clipboard.get(key))
+            amp.put("ccdId", eval(ccdFormula))
+            amp.put("ampId", eval(ampFormula))
+            amp.put("hduId", eval(hduFormula))
+            yield sliceId, amp
+
+    @timed
+    def process(self):
+        clipboard = self.inputQueue.getNextDataset()
+        if self._flag("reuseAmps"):
+            kept = clipboard.get("ampClipboards") or {}
+            items = kept.keys()
+            items.sort()
+            amps = [(item, kept[item]) for item in items]
+        else:
+            amps = self._claimedAmps(clipboard)
+
+        done = {}
+        for item, amp in amps:
+            self.queues[0].addDataset(amp)
+            for child in self.children:
+                child.process()
+            done[item] = self.queues[-1].getNextDataset()
+
+        items = done.keys()
+        items.sort()
+        self.log.log(pexLog.Log.INFO, "slice %d processed %d amplifiers" %
+                     (self.getRank(), len(items)))
+        clipboard.put("ampsProcessed", items)
+        if self._flag("keepAmps"):
+            clipboard.put("ampClipboards", done)
+        else:
+            clipboard.put("ampClipboards", {})
+        self.outputQueue.addDataset(clipboard)
@@ -0,0 +1,400 @@
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+
+"""
+A node-level store of calibration frames.
+
+Each slice used to read the bias and flat HDUs of its amplifier from the
+shared file system on every visit, although they rarely change.  The
+CalibrationStore keeps each calibration HDU a node needs as a stand-alone
+FITS file in shared memory (/dev/shm by default):  the first slice that
+needs it copies it out of the calibration file, the other slices on the
+node read it from memory.  An entry is named after the source file, HDU,
+size and modification time, so a changed calibration file gets a new
+entry.
+
+Slices attached to an entry hold a shared flock on its ".ref" file,
+which serves as its reference count:  an entry whose source has changed (or which has not
+been used for maxAge seconds) is removed, along with its ".json", ".ref"
+and ".lock" files, once no slice holds it.
+
+CalibrationInputStage reads the calibration items of its policy, which
+has the form of an InputStage policy, through the store.  It keeps the
+images the last visit used and hands them out again for as long as their
+calibration files do not change, so that on most visits nothing is read
+at all; TransformCalibrationImageStage likewise reuses the Exposure it
+made from an unchanged image, handing out a copy of it on every visit.
+The stage also puts the name of each item's store entry on the clipboard
+as "calibrationIds" (item key -> entry name), so that later stages can
+tell an unchanged calibration from a new one without comparing images.
+
+With a "prefetch" policy (see PrefetchStages), the stage has the slice's
+InputPrefetcher warm the store for each upcoming visit as soon as its
+trigger event is published:  the calibration HDUs the visit will need
+are extracted into the store ahead of time (if they are not there
+already), so that a visit with new calibrations does not wait for them
+to be read from the shared file system.
+
+The store saves the reads from the shared file system, not memory:  each
+slice still decodes its own copy of the images it uses, so a node holds
+the shared memory entries plus one copy of its images per slice.
+"""
+
+import os, time, errno
+try:
+    import json
+except ImportError:
+    import simplejson as json
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+
+import lsst.pex.logging as pexLog
+from lsst.pex.harness.Stage import Stage
+from lsst.ctrl.mospipe.StageTiming import timed, exposureIdOf
+from lsst.ctrl.mospipe.StageUtils import FileLock, additionalData
+from lsst.ctrl.mospipe.FitsUtils import hduExtent, headerCards, \
+     primaryHeader, padHeader, formatCard, splitLocation, readRange
+from lsst.ctrl.mospipe.LogBatching import getLog
+
+DEFAULT_STORE = "/dev/shm/mospipe-calib"
+CALIBRATION_IDS = "calibrationIds"
+
+class CalibrationStore(object):
+    """
+    the node-level store of calibration HDUs
+    """
+
+    def __init__(self, storeDir=DEFAULT_STORE, maxAge=86400):
+        """
+        @param storeDir  the store directory; it should be in memory
+        @param maxAge    the seconds after which an unused entry is removed
+        """
+        self.storeDir = storeDir
+        self.maxAge = maxAge
+        self.extracted = 0
+        self.attached = 0
+        self.removed = 0
+        # entry path -> FileLock held while attached
+        self._held = {}
+        if not os.path.isdir(storeDir):
+            try:
+                os.makedirs(storeDir)
+            except OSError:
+                if not os.path.isdir(storeDir):
+                    raise
+
+    def entryName(self, filename, hdu, st=None):
+        """
+        return the name of the entry for an HDU of the current version of
+        a file
+        """
+        if st is None:
+            st = os.stat(filename)
+        key = "%s#%s:%d:%d" % (os.path.abspath(filename), hdu, st.st_size,
+                               int(st.st_mtime))
+        return sha1(key).hexdigest()
+
+    def _fill(self, filename, hdu, st, path):
+        """
+        extract the HDU into its entry unless the entry is there already
+        @return True if it was extracted
+        """
+        lock = FileLock(path + ".lock")
+        try:
+            extracted = not os.path.exists(path)
+            if extracted:
+                self._extract(filename, hdu, st, path)
+                self.extracted += 1
+            os.utime(path, None)
+            return extracted
+        finally:
+            lock.release()
+
+    def warm(self, filename, hdu=None):
+        """
+        make sure the store holds the given HDU of a file, without holding
+        a reference to it
+        @return True if it had to be extracted
+        """
+        st = os.stat(filename)
+        path = os.path.join(self.storeDir,
+                            self.entryName(filename, hdu, st) + ".fits")
+        return self._fill(filename, hdu, st, path)
+
+    def attach(self, filename, hdu=None):
+        """
+        make sure the store holds the given HDU of a file and hold a
+        reference to it
+        @return the path of the entry, a FITS file holding the HDU alone
+        """
+        st = os.stat(filename)
+        path = os.path.join(self.storeDir,
+                            self.entryName(filename, hdu, st) + ".fits")
+        if self._held.has_key(path):
+            return path
+
+        if not self._fill(filename, hdu, st, path):
+            self.attached += 1
+        # there is a window between the release and the shared lock in
+        # which purge() could remove the entry; check it is still there
+        held = FileLock(path + ".ref", shared=True)
+        if not os.path.exists(path):
+            held.release()
+            return self.attach(filename, hdu)
+        self._held[path] = held
+        return path
+
+    def _extract(self, filename, hdu, st, path):
+        tmp = "%s.tmp%d" % (path, os.getpid())
+        out = open(tmp, "wb")
+        try:
+            if hdu is None or hdu <= 1:
+                readRange(filename, 0, st.st_size, sink=out.write)
+            else:
+                extent = hduExtent(filename, hdu)
+                cards = headerCards(filename, extent)
+                if cards[0].startswith("XTENSION") and "IMAGE" in cards[0]:
+                    out.write(primaryHeader(cards))
+                else:
+                    # e.g. a tile-compressed image stays an extension
+                    out.write(padHeader([formatCard("SIMPLE", True),
+                                         formatCard("BITPIX", 8),
+                                         formatCard("NAXIS", 0),
+                                         formatCard("EXTEND", True)]))
+                    readRange(filename, extent.offset, extent.headerSize,
+                              sink=out.write)
+                readRange(filename, extent.dataOffset(), extent.dataSize,
+                          sink=out.write)
+        finally:
+            out.close()
+        info = open(path + ".json.tmp%d" % os.getpid(), "w")
+        try:
+            json.dump({ "source": os.path.abspath(filename), "hdu": hdu,
+                        "size": st.st_size, "mtime": int(st.st_mtime) },
+                      info)
+        finally:
+            info.close()
+        os.rename(info.name, path + ".json")
+        os.rename(tmp, path)
+
+    def release(self, path):
+        """
+        drop the reference to an entry
+        """
+        held = self._held.pop(path, None)
+        if held is not None:
+            held.release()
+
+    def _isStale(self, path, now):
+        try:
+            f = open(path + ".json")
+            try:
+                info = json.load(f)
+            finally:
+                f.close()
+            st = os.stat(info["source"])
+            if st.st_size != info["size"] or \
+               int(st.st_mtime) != info["mtime"]:
+                return True
+            return now - os.path.getmtime(path) > self.maxAge
+        except (IOError, OSError, ValueError):
+            return True
+
+    def purge(self):
+        """
+        remove the stale entries no one holds
+        @return the number of entries removed
+        """
+        now = time.time()
+        count = 0
+        for name in os.listdir(self.storeDir):
+            if not name.endswith(".fits"):
+                continue
+            path = os.path.join(self.storeDir, name)
+            if self._held.has_key(path) or not self._isStale(path, now):
+                continue
+            try:
+                lock = FileLock(path + ".lock", False)
+            except IOError:
+                # being extracted or attached
+                continue
+            try:
+                try:
+                    ref = FileLock(path + ".ref", False)
+                except IOError:
+                    # still referenced
+                    continue
+                try:
+                    # the entry goes first:  a slice that locks a ".ref" or
+                    # ".lock" file just removed finds it gone and starts over
+                    for suffix in ("", ".json", ".ref", ".lock"):
+                        try:
+                            os.remove(path + suffix)
+                        except OSError, e:
+                            if e.errno != errno.ENOENT:
+                                raise
+                    count += 1
+                finally:
+                    ref.release()
+            finally:
+                lock.release()
+        self.removed += count
+        return count
+
+def _importClass(name):
+    module, cls = name.rsplit(".", 1)
+    return getattr(__import__(module, {}, {}, [cls]), cls)
+
+class CalibrationInputStage(Stage):
+    '''Read calibration images through the node's CalibrationStore.
+
+    The policy has the form of an InputStage policy (InputItems with
+    FitsStorage locations, and AdditionalData), plus an optional storeDir
+    and maxAge for the store and an optional prefetch policy.  The images
+    kept are those used since the start of the last visit.'''
+
+    def __init__(self, stageId=-1, stagePolicy=None):
+        Stage.__init__(self, stageId, stagePolicy)
+        self.log = getLog("mospipe.CalibrationStore")
+        self.store = None
+        # store entry path -> image
+        self.images = {}
+        # (file, HDU) -> the store entry path of its current version
+        self.sources = {}
+        # the visit being processed and the entry paths it used
+        self.visit = None
+        self.used = set()
+        self.reused = 0
+        self.prefetcher = None
+
+    def _newStore(self):
+        storeDir, maxAge = DEFAULT_STORE, 86400
+        if self._policy.exists("storeDir"):
+            storeDir = self._policy.getString("storeDir")
+        if self._policy.exists("maxAge"):
+            maxAge = self._policy.get("maxAge")
+        return CalibrationStore(storeDir, maxAge)
+
+    def _getStore(self):
+        if self.store is None:
+            self.store = self._newStore()
+        return self.store
+
+    def initialize(self, outQueue, inQueue):
+        Stage.initialize(self, outQueue, inQueue)
+        if self._policy is None or not self._policy.exists("prefetch"):
+            return
+        from lsst.ctrl.mospipe.PrefetchStages import getPrefetcher, \
+             prefetchItems
+        prefetch = self._policy.getPolicy("prefetch")
+        def param(name, default):
+            if prefetch.exists(name):
+                return prefetch.get(name)
+            return default
+        broker = param("eventBrokerHost", None)
+        if broker is None:
+            # set by the harness through setEventBrokerHost()
+            broker = getattr(self, "_evbroker", None)
+        self.prefetcher = getPrefetcher(broker,
+                                        param("triggerTopic",
+                                              "triggerImageprocEvent"),
+                                        param("maxAhead", 2),
+                                        param("receiveTimeout", 1.0))
+        # the prefetcher's thread gets a store of its own
+        self.prefetcher.addStore(self._newStore(),
+                                 prefetchItems(self._policy))
+        self.prefetcher.start()
+
+    def _prefetched(self, clipboard, exposureId):
+        """
+        let the prefetcher know which visit is being processed
+        """
+        if not self.prefetcher.ready:
+            sliceData = {}
+            for key in ("ccdId", "ampId", "hduId"):
+                if clipboard.get(key) is not None:
+                    sliceData[key] = clipboard.get(key)
+            self.prefetcher.setSliceData(sliceData)
+        self.prefetcher.visit(exposureId)
+
+    @timed
+    def process(self):
+        """
+        Put the calibration images of this visit on the clipboard.
+        """
+        import lsst.daf.persistence as dafPersist
+
+        clipboard = self.inputQueue.getNextDataset()
+        data = additionalData(self._policy, clipboard)
+        store = self._getStore()
+
+        exposureId = exposureIdOf(clipboard)
+        if exposureId is None or exposureId != self.visit:
+            # a new visit (a slice may see several amplifiers of one under
+            # an AmpWorkQueueStage):  let go of the images the last visit
+            # did not use
+            for path in self.images.keys():
+                if path not in self.used:
+                    del self.images[path]
+                    store.release(path)
+            self.visit = exposureId
+            self.used = set()
+            if self.prefetcher is not None:
+                self._prefetched(clipboard, exposureId)
+
+        ids = {}
+        items = self._policy.getPolicy("InputItems")
+        for key in items.names(True):
+            item = items.getPolicy(key)
+            storage = item.getPolicy("StoragePolicy")
+            location = dafPersist.LogicalLocation(
+                storage.getString("Location"), data).locString()
+            filename, hdu = splitLocation(location)
+            path = store.attach(filename, hdu)
+            stale = self.sources.get((filename, hdu))
+            if stale is not None and stale != path and \
+               self.images.has_key(stale):
+                # the calibration file changed
+                del self.images[stale]
+                self.used.discard(stale)
+                store.release(stale)
+            self.sources[(filename, hdu)] = path
+
+            if self.images.has_key(path):
+                self.reused += 1
+            else:
+                cls = _importClass(item.getString("PythonType"))
+                self.images[path] = cls(path)
+            self.used.add(path)
+            clipboard.put(key, self.images[path])
+            ids[key] = os.path.basename(path)[:-len(".fits")]
+        clipboard.put(CALIBRATION_IDS, ids)
+
+        store.purge()
+        self.log.log(pexLog.Log.DEBUG,
+                     "%d images reused, %d extracted, %d attached, %d removed"
+                     % (self.reused, store.extracted, store.attached,
+                        store.removed))
+        self.outputQueue.addDataset(clipboard)
@@ -0,0 +1,551 @@
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+
+"""
+Simulation of visit flow through the stages of a pipeline, for sizing the
+cluster a production needs.
+
+The harness runs each stage as a master preprocess(), a process() on every
+slice in parallel, a barrier, and a master postprocess(); a visit passes
+through the stages one after another.  The simulator replays this for a
+stream of visits on a given set of nodes and cores:
+
+  - each slice's process() does some non-CPU work (I/O) and then some CPU
+    work; both are scaled by a random factor (log-normal, with a per-stage
+    spread) to reproduce the spread of slice times behind a barrier;
+  - processes placed on the same node share its cores, so a node running
+    more slices than it has cores stretches their CPU work;
+  - several pipeline instances may be placed on the cluster; each takes
+    the next waiting visit when it finishes the previous one.
+
+Per-stage costs come from a CostModel, built from a cost model policy (see
+pipeline/costModel.paf), from measured stage timings (see StageTiming), or
+both.  Peak memory per node is computed from the per-stage memory figures
+of the model and the placement of processes on nodes.
+
+Stages are numbered from 1 in pipeline order.
+"""
+
+import heapq, math, random
+
+class StageCost(object):
+    """
+    the resources used by one stage
+    """
+    def __init__(self, cpu=0.0, io=0.0, pre=0.0, post=0.0, memory=0.0,
+                 scratch=0.0, jitter=0.0):
+        """
+        @param cpu      the CPU seconds of a slice's process()
+        @param io       the non-CPU seconds of a slice's process()
+        @param pre      the seconds of the master's preprocess()
+        @param post     the seconds of the master's postprocess()
+        @param memory   the MB a slice adds to its clipboard, kept until the
+                          end of the visit
+        @param scratch  the MB a slice uses only while in this stage
+        @param jitter   the log-normal spread of a slice's process() time
+        """
+        self.cpu = cpu
+        self.io = io
+        self.pre = pre
+        self.post = post
+        self.memory = memory
+        self.scratch = scratch
+        self.jitter = jitter
+
+    def copy(self):
+        return StageCost(self.cpu, self.io, self.pre, self.post, self.memory,
+                         self.scratch, self.jitter)
+
+_FIELDS = ("cpu", "io", "pre", "post", "memory", "scratch", "jitter")
+
+def _costFromPolicy(policy, base):
+    cost = base.copy()
+    for name in _FIELDS:
+        if policy.exists(name):
+            setattr(cost, name, float(policy.get(name)))
+    return cost
+
+class CostModel(object):
+    """
+    the costs of the stages of a pipeline, looked up by stage class name
+    and occurrence
+    """
+
+    def __init__(self, default=None, masterMemory=200.0, sliceMemory=300.0):
+        """
+        @param default       the StageCost of stages not otherwise known
+        @param masterMemory  the resident MB of the master process
+        @param sliceMemory   the resident MB of a slice process before it
+                               holds any data
+        """
+        if default is None:
+            default = StageCost()
+        self.default = default
+        self.masterMemory = masterMemory
+        self.sliceMemory = sliceMemory
+        # stage name -> {occurrence (0 for all): StageCost}
+        self.costs = {}
+        self.measured = set()
+
+    def set(self, name, cost, occurrence=0):
+        self.costs.setdefault(name, {})[occurrence] = cost
+
+    def costFor(self, name, occurrence=1):
+        """
+        return the StageCost of the given occurrence (counting from 1) of
+        a stage class in the pipeline
+        """
+        byOcc = self.costs.get(name, {})
+        if byOcc.has_key(occurrence):
+            return byOcc[occurrence]
+        if byOcc.has_key(0):
+            return byOcc[0]
+        return self.default
+
+    def fromPolicy(cls, policy):
+        """
+        create a cost model from a policy (see pipeline/costModel.paf)
+        """
+        default = StageCost()
+        if policy.exists("default"):
+            default = _costFromPolicy(policy.getPolicy("default"), default)
+        model = cls(default)
+        if policy.exists("masterMemory"):
+            model.masterMemory = float(policy.get("masterMemory"))
+        if policy.exists("sliceMemory"):
+            model.sliceMemory = float(policy.get("sliceMemory"))
+        if policy.exists("stage"):
+            for sp in policy.getArray("stage"):
+                occurrence = 0
+                if sp.exists("occurrence"):
+                    occurrence = sp.getInt("occurrence")
+                model.set(sp.getString("name"),
+                          _costFromPolicy(sp, default), occurrence)
+        return model
+    fromPolicy = classmethod(fromPolicy)
+
+    def addMeasured(self, agg):
+        """
+        replace the time figures of the model with mean measured ones
+        @param agg   a StageTiming.StageTimingAggregator holding timings
+        """
+        # (stage name) -> measured stageIndexes in order
+        byName = {}
+        for index, name, method in agg.keys():
+            if index not in byName.setdefault(name, []):
+                byName[name].append(index)
+        for name, indexes in byName.items():
+            indexes.sort()
+            for occ, index in enumerate(indexes):
+                cost = self.costFor(name, occ + 1).copy()
+                proc = (index, name, "process")
+                if agg.wall.has_key(proc):
+                    wall = agg.wall[proc]
+                    cpu = agg.cpu[proc].mean()
+                    cost.cpu = min(cpu, wall.mean())
+                    cost.io = max(0.0, wall.mean() - cost.cpu)
+                    # the spread of the measured times, as a log-normal
+                    # sigma estimated from the median and 95th percentile
+                    p50, p95 = wall.quantile(0.5), wall.quantile(0.95)
+                    if p50 > 0 and p95 > p50:
+                        cost.jitter = math.log(p95 / p50) / 1.645
+                for method, attr in (("preprocess", "pre"),
+                                     ("postprocess", "post")):
+                    if agg.wall.has_key((index, name, method)):
+                        setattr(cost, attr,
+                                agg.wall[(index, name, method)].mean())
+                self.set(name, cost, occ + 1)
+                self.measured.add((name, occ + 1))
+
+def pipelineStages(policy):
+    """
+    return the short class names of the stages of a pipeline policy (such
+    as IP.paf, with its includes loaded) in order
+    """
+    execute = policy
+    if policy.exists("execute"):
+        execute = policy.getPolicy("execute")
+    return [sp.getString("stageName").split(".")[-1]
+            for sp in execute.getArray("appStage")]
+
+def sliceCount(policy, default=1):
+    """
+    return the number of slices of a pipeline policy, from the nAmps and
+    nCcds parameters of its SliceInfoStage, or the default if it has none
+    (as in work-queue mode)
+    """
+    execute = policy
+    if policy.exists("execute"):
+        execute = policy.getPolicy("execute")
+    for sp in execute.getArray("appStage"):
+        if sp.getString("stageName").endswith("SliceInfoStage") and \
+           sp.exists("stagePolicy"):
+            info = sp.getPolicy("stagePolicy")
+            if info.exists("nAmps") and info.exists("nCcds"):
+                return info.getInt("nAmps") * info.getInt("nCcds")
+    return default
+
+def platformNodes(policy):
+    """
+    return the (host, cores) of the nodes of a platform policy, and the
+    RAM per node in GB (or None)
+    """
+    cores = None
+    if policy.exists("hw.maxCoresPerNode"):
+        cores = policy.getInt("hw.maxCoresPerNode")
+    elif policy.exists("hw.minCoresPerNode"):
+        cores = policy.getInt("hw.minCoresPerNode")
+    ram = None
+    if policy.exists("hw.maxRamPerNode"):
+        ram = float(policy.get("hw.maxRamPerNode"))
+
+    nodes = []
+    for node in policy.getArray("deploy.nodes"):
+        host, n = node, cores
+        if ":" in node:
+            host, n = node.split(":", 1)
+            n = int(n)
+        nodes.append((host.strip(), n or 1))
+    return nodes, ram
+
+class _Node(object):
+    """
+    a node whose cores are shared equally by the CPU work running on it
+    """
+    def __init__(self, name, cores):
+        self.name = name
+        self.cores = cores
+        self.tasks = {}
+        self.last = 0.0
+        self.version = 0
+        self.busy = 0.0
+
+    def rate(self):
+        if not self.tasks:
+            return 1.0
+        return min(1.0, float(self.cores) / len(self.tasks))
+
+    def advance(self, now):
+        elapsed = now - self.last
+        if self.tasks and elapsed > 0:
+            done = elapsed * self.rate()
+            for task in self.tasks:
+                self.tasks[task] -= done
+            self.busy += elapsed * min(self.cores, len(self.tasks))
+        self.last = now
+
+class _Instance(object):
+    """
+    one pipeline instance:  a master and its slices placed on nodes
+    """
+    def __init__(self, number, master, slices):
+        self.number = number
+        self.master = master
+        self.slices = slices
+        self.visit = None
+        self.stage = 0
+        self.pending = 0
+        self.ends = []
+        self.started = 0.0
+
+class StageStats(object):
+    """
+    the simulated times of one stage
+    """
+    def __init__(self, index, name):
+        self.index = index
+        self.name = name
+        self.count = 0
+        self.total = 0.0
+        self.barrierWait = 0.0
+
+    def mean(self):
+        return self.count and self.total / self.count or 0.0
+
+    def meanWait(self):
+        return self.count and self.barrierWait / self.count or 0.0
+
+class SimulationResult(object):
+    """
+    the outcome of a simulation
+    """
+    def __init__(self, stages, nodes, instances, arrivalRate):
+        self.stages = stages
+        self.nodes = nodes
+        self.instances = instances
+        self.arrivalRate = arrivalRate
+        self.visitTimes = []
+        self.latencies = []
+        self.maxQueue = 0
+        self.makespan = 0.0
+        self.nodeMemory = {}
+
+    def throughput(self):
+        """
+        return the visits completed per hour
+        """
+        if self.makespan <= 0:
+            return 0.0
+        return 3600.0 * len(self.visitTimes) / self.makespan
+
+    def bottleneck(self):
+        """
+        return the StageStats of the stage taking the most time
+        """
+        worst = None
+        for stats in self.stages:
+            if worst is None or stats.mean() > worst.mean():
+                worst = stats
+        return worst
+
+    def utilization(self):
+        """
+        return a dictionary of node name -> fraction of its cores kept busy
+        """
+        out = {}
+        for node in self.nodes:
+            if self.makespan > 0:
+                out[node.name] = node.busy / (node.cores * self.makespan)
+            else:
+                out[node.name] = 0.0
+        return out
+
+class Simulator(object):
+    """
+    a discrete-event simulation of visits flowing through the stages of
+    one or more pipeline instances
+    """
+
+    def __init__(self, stages, costs, nSlices, nodes, instances=1,
+                 seed=None):
+        """
+        @param stages     the stage class names in pipeline order
+        @param costs      the CostModel
+        @param nSlices    the number of slices of each pipeline
+        @param nodes      the (host, cores) of the nodes; processes are
+                            placed on them in order, filling each node's
+                            cores before the next, and round-robin once
+                            all cores are taken
+        @param instances  the number of pipeline instances
+        @param seed       the random seed
+        """
+        self.stageNames = stages
+        self.nSlices = nSlices
+        self.costs = []
+        seen = {}
+        for name in stages:
+            seen[name] = seen.get(name, 0) + 1
+            self.costs.append(costs.costFor(name, seen[name]))
+        self.model = costs
+        self.nodes = [_Node(host, cores) for host, cores in nodes]
+        self.random = random.Random(seed)
+
+        slots = []
+        for node in self.nodes:
+            slots.extend([node] * node.cores)
+        self.instances = []
+        place = 0
+        for i in xrange(instances):
+            procs = []
+            for p in xrange(nSlices + 1):
+                if place < len(slots):
+                    procs.append(slots[place])
+                else:
+                    procs.append(self.nodes[place % len(self.nodes)])
+                place += 1
+            self.instances.append(_Instance(i, procs[0], procs[1:]))
+
+    def placement(self):
+        """
+        return a dictionary of node name -> number of processes on it
+        """
+        out = {}
+        for inst in self.instances:
+            for node in [inst.master] + inst.slices:
+                out[node.name] = out.get(node.name, 0) + 1
+        return out
+
+    def sliceMemory(self):
+        """
+        return the peak MB used by a slice process during a visit
+        """
+        held, peak = 0.0, 0.0
+        for cost in self.costs:
+            peak = max(peak, held + cost.memory + cost.scratch)
+            held += cost.memory
+        return self.model.sliceMemory + peak
+
+    def nodeMemory(self):
+        """
+        return a dictionary of node name -> peak MB used on it
+        """
+        out = {}
+        slice = self.sliceMemory()
+        for inst in self.instances:
+            node = inst.master.name
+            out[node] = out.get(node, 0.0) + self.model.masterMemory
+            for node in inst.slices:
+                out[node.name] = out.get(node.name, 0.0) + slice
+        return out
+
+    def _factor(self, jitter):
+        if jitter <= 0:
+            return 1.0
+        return math.exp(self.random.gauss(0.0, jitter) - jitter * jitter / 2)
+
+    def _push(self, when, action, *args):
+        self._seq += 1
+        heapq.heappush(self._events, (when, self._seq, action, args))
+
+    def _schedule(self, node):
+        node.version += 1
+        if not node.tasks:
+            return
+        rate = node.rate()
+        shortest = min(node.tasks.values())
+        self._push(node.last + max(0.0, shortest) / rate, self._cpuDone,
+                   node, node.version)
+
+    def _cpu(self, node, work, done, *args):
+        """
+        run work CPU seconds on node, then call done(*args)
+        """
+        if work <= 0:
+            done(*args)
+            return
+        node.advance(self._now)
+        self._taskSeq += 1
+        node.tasks[(self._taskSeq, done, args)] = work
+        self._schedule(node)
+
+    def _cpuDone(self, node, version):
+        if version != node.version:
+            return
+        node.advance(self._now)
+        finished = [t for t, left in node.tasks.items() if left <= 1.0e-9]
+        for t in finished:
+            del node.tasks[t]
+        self._schedule(node)
+        finished.sort()
+        for seq, done, args in finished:
+            done(*args)
+
+    def _startVisit(self, inst, visit):
+        inst.visit = visit
+        inst.started = self._now
+        inst.stage = 0
+        self._startStage(inst)
+
+    def _startStage(self, inst):
+        cost = self.costs[inst.stage]
+        inst.stageStart = self._now
+        self._cpu(inst.master, cost.pre, self._startSlices, inst)
+
+    def _startSlices(self, inst):
+        cost = self.costs[inst.stage]
+        inst.pending = len(inst.slices)
+        inst.ends = []
+        for node in inst.slices:
+            factor = self._factor(cost.jitter)
+            self._push(self._now + cost.io * factor, self._cpu, node,
+                       cost.cpu * factor, self._sliceDone, inst)
+
+    def _sliceDone(self, inst):
+        inst.ends.append(self._now)
+        inst.pending -= 1
+        if inst.pending:
+            return
+        ends = inst.ends
+        ends.sort()
+        stats = self.stats[inst.stage]
+        stats.barrierWait += ends[-1] - ends[len(ends) // 2]
+        self._cpu(inst.master, self.costs[inst.stage].post,
+                  self._endStage, inst)
+
+    def _endStage(self, inst):
+        stats = self.stats[inst.stage]
+        stats.count += 1
+        stats.total += self._now - inst.stageStart
+        inst.stage += 1
+        if inst.stage < len(self.costs):
+            self._startStage(inst)
+            return
+
+        arrived = inst.visit
+        self.result.visitTimes.append(self._now - inst.started)
+        self.result.latencies.append(self._now - arrived)
+        self._lastDone = self._now
+        inst.visit = None
+        self._dispatch()
+
+    def _arrive(self):
+        self._queue.append(self._now)
+        self.result.maxQueue = max(self.result.maxQueue, len(self._queue))
+        self._dispatch()
+
+    def _dispatch(self):
+        for inst in self.instances:
+            if not self._queue:
+                return
+            if inst.visit is None:
+                self._startVisit(inst, self._queue.pop(0))
+
+    def run(self, nVisits=100, arrivalRate=None):
+        """
+        simulate the processing of a number of visits
+        @param nVisits      the number of visits
+        @param arrivalRate  the visits per hour arriving at regular
+                              intervals; if None, all visits are waiting
+                              at the start, which measures the highest
+                              sustainable rate
+        @return SimulationResult
+        """
+        self._events = []
+        self._seq = 0
+        self._taskSeq = 0
+        self._now = 0.0
+        self._queue = []
+        self._lastDone = 0.0
+        for node in self.nodes:
+            node.tasks = {}
+            node.last = 0.0
+            node.busy = 0.0
+        self.stats = [StageStats(i + 1, name)
+                      for i, name in enumerate(self.stageNames)]
+        self.result = SimulationResult(self.stats, self.nodes,
+                                       len(self.instances), arrivalRate)
+
+        interval = 0.0
+        if arrivalRate:
+            interval = 3600.0 / arrivalRate
+        for i in xrange(nVisits):
+            self._push(i * interval, self._arrive)
+
+        while self._events:
+            when, seq, action, args = heapq.heappop(self._events)
+            self._now = when
+            action(*args)
+
+        self.result.makespan = self._lastDone
+        self.result.nodeMemory = self.nodeMemory()
+        return self.result
@@ -0,0 +1,300 @@
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+
+
+"""
+Per-CCD multi-extension FITS output.
+
+CcdMefOutputStage is an OutputStage (more precisely, a
+CompressedOutputStage) that gathers the amplifier images of a CCD into a
+single multi-extension FITS file instead of writing one file per amplifier
+(or three, for the planes of an Exposure).  An item is written this way if
+it has an "Mef" policy:
+
+    Mef: {
+        location: "%(output)/sci/calobj%(exposureId)/c%03d(ccdId).fits"
+        nAmps: 8
+    }
+
+Each slice writes its amplifier to the local scratch directory as a
+CompressedOutputStage does, then, holding a lock on the CCD's file (the
+file name with ".lock" appended), appends its HDUs to the end of the file,
+named AMPnn_IMG, AMPnn_MSK and AMPnn_VAR (AMPnn for a plain image), each
+with a header of its actual size.  The slice that finds the file empty
+writes the primary header first.  No per-amplifier file is made on the
+shared file system, the extensions are packed one after the other, and the
+file is complete once all slices are past the stage; the extensions of
+the amplifiers come in the order the slices get there.
+
+If the item also has a Compression policy, the extensions are
+tile-compressed (as binary tables); a plane that does not compress to less
+than its uncompressed size is written uncompressed.
+
+Alongside the file, an index (the file name with ".index" in place of
+".fits") lists each extension's HDU number, amplifier, plane and byte
+offsets as JSON, so that per-CCD readers open one file and can find an
+amplifier without scanning the headers;  mefLocation() turns an index
+entry into a "file.fits#hdu" location for FitsStorage.  Each slice adds
+its extensions to the index while it holds the lock; the index is
+complete when it lists nAmps amplifiers.  An amplifier written again (by
+a rerun) replaces its entries in the index, though its earlier HDUs stay
+in the file.
+"""
+
+import os
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+import lsst.pex.logging as pexLog
+from lsst.ctrl.mospipe.CompressedOutputStage import CompressedOutputStage
+from lsst.ctrl.mospipe.StageUtils import additionalData, FileLock
+from lsst.ctrl.mospipe.FitsUtils import BLOCK, hduExtent, hduExtents, \
+     headerCards, extensionHeader, padHeader, formatCard, planeOf, readRange
+from lsst.ctrl.mospipe.LogBatching import getLog
+
+PLANE_NAMES = { "image": "IMG", "mask": "MSK", "variance": "VAR" }
+PLANE_ORDER = ("image", "mask", "variance")
+
+def indexPath(mefPath):
+    """
+    return the path of the index of a per-CCD file
+    """
+    base, ext = os.path.splitext(mefPath)
+    if ext != ".fits":
+        base = mefPath
+    return base + ".index"
+
+def readIndex(mefPath):
+    """
+    return the index of a per-CCD file
+    """
+    f = open(indexPath(mefPath))
+    try:
+        return json.load(f)
+    finally:
+        f.close()
+
+def mefLocation(mefPath, ampId, plane="image"):
+    """
+    return the "file.fits#hdu" location of an amplifier's plane in a
+    per-CCD file
+    """
+    for ext in readIndex(mefPath)["extensions"]:
+        if ext["ampId"] == ampId and ext["plane"] == plane:
+            return "%s#%d" % (mefPath, ext["hdu"])
+    raise KeyError("%s has no %s plane of amplifier %d" %
+                   (mefPath, plane, ampId))
+
+def extensionName(ampId, plane, nPlanes):
+    """
+    return the EXTNAME of an amplifier's plane in a per-CCD file
+    """
+    extname = "AMP%02d" % ampId
+    if nPlanes > 1:
+        extname += "_" + PLANE_NAMES[plane]
+    return extname
+
+def mefPrimaryHeader(ccdId=None):
+    """
+    return the primary header of a per-CCD file (one block)
+    """
+    cards = [formatCard("SIMPLE", True), formatCard("BITPIX", 8),
+             formatCard("NAXIS", 0), formatCard("EXTEND", True)]
+    if ccdId is not None:
+        cards.append(formatCard("CCDID", ccdId))
+    return padHeader(cards)
+
+def writeIndex(mefPath, index):
+    """
+    write the index of a per-CCD file
+    """
+    tmp = "%s.tmp%d" % (indexPath(mefPath), os.getpid())
+    f = open(tmp, "w")
+    try:
+        json.dump(index, f, indent=1)
+    finally:
+        f.close()
+    os.rename(tmp, indexPath(mefPath))
+
+def _writeAll(fd, data):
+    while data:
+        data = data[os.write(fd, data):]
+
+def appendExtensions(mefPath, ccdId, nAmps, ampId, hdus):
+    """
+    append the HDUs of an amplifier to a per-CCD file and list them in its
+    index, holding a lock on the file
+    @param mefPath  the per-CCD file
+    @param ccdId    the CCD
+    @param nAmps    the number of amplifiers of the CCD
+    @param ampId    the amplifier
+    @param hdus     (plane, FITS file, HduExtent) of each HDU to append,
+                      in order
+    @return the index entries of the extensions written
+    """
+    lock = FileLock(mefPath + ".lock")
+    try:
+        fd = os.open(mefPath, os.O_RDWR | os.O_CREAT, 0666)
+        try:
+            offset = os.fstat(fd).st_size
+            index = None
+            if offset == 0:
+                _writeAll(fd, mefPrimaryHeader(ccdId))
+                offset = BLOCK
+            elif os.path.exists(indexPath(mefPath)):
+                index = readIndex(mefPath)
+            if index is None:
+                index = { "file": os.path.basename(mefPath), "ccdId": ccdId,
+                          "nAmps": nAmps, "hduCount": 1, "extensions": [] }
+            if index["hduCount"] == 1 and offset > BLOCK:
+                # a file without its index:  count the HDUs
+                index["hduCount"] = len(hduExtents(mefPath))
+
+            written = []
+            os.lseek(fd, offset, 0)
+            for plane, path, extent in hdus:
+                extname = extensionName(ampId, plane, len(hdus))
+                header = extensionHeader(headerCards(path, extent), extname,
+                                         [formatCard("AMPID", ampId)])
+                _writeAll(fd, header)
+                readRange(path, extent.dataOffset(), extent.dataSize,
+                          sink=lambda data: _writeAll(fd, data))
+                index["hduCount"] += 1
+                written.append({ "hdu": index["hduCount"],
+                                 "extname": extname, "ampId": ampId,
+                                 "plane": plane, "offset": offset,
+                                 "headerSize": len(header),
+                                 "dataSize": extent.dataSize })
+                offset += len(header) + extent.dataSize
+        finally:
+            os.close(fd)
+
+        extensions = [ext for ext in index["extensions"]
+                          if ext["ampId"] != ampId] + written
+        extensions.sort(lambda a, b:
+                        cmp((a["ampId"], PLANE_ORDER.index(a["plane"])),
+                            (b["ampId"], PLANE_ORDER.index(b["plane"]))))
+        index["extensions"] = extensions
+        writeIndex(mefPath, index)
+    finally:
+        lock.release()
+    return written
+
+class CcdMefOutputStage(CompressedOutputStage):
+    '''An OutputStage that writes the amplifiers of each CCD into one
+    multi-extension FITS file.'''
+
+    def __init__(self, stageId=-1, stagePolicy=None):
+        CompressedOutputStage.__init__(self, stageId, stagePolicy)
+        self.log = getLog("mospipe.CcdMefOutputStage")
+        # item name -> (per-CCD file location, number of amplifiers)
+        self.mef = {}
+        if stagePolicy is None or not stagePolicy.exists("OutputItems"):
+            return
+        items = stagePolicy.getPolicy("OutputItems")
+        for key in items.names(True):
+            item = items.getPolicy(key)
+            if not item.exists("Mef"):
+                continue
+            mef = item.getPolicy("Mef")
+            self.mef[key] = (mef.getString("location"), mef.getInt("nAmps"))
+            if not self.locations.has_key(key):
+                # written to the scratch directory as well, uncompressed
+                locations = []
+                for storage in item.getPolicyArray("StoragePolicy"):
+                    if storage.getString("Storage") == "FitsStorage":
+                        locations.append((storage,
+                                          storage.getString("Location")))
+                self.locations[key] = locations
+                self.compression[key] = {}
+
+    def _compressItem(self, key, clipboard):
+        if not self.mef.has_key(key):
+            CompressedOutputStage._compressItem(self, key, clipboard)
+            return
+
+        import lsst.daf.persistence as dafPersist
+        location, nAmps = self.mef[key]
+        data = additionalData(self._policy, clipboard)
+        mefPath = dafPersist.LogicalLocation(location, data).locString()
+        ampId = clipboard.get("ampId")
+        ccdId = clipboard.get("ccdId")
+
+        planes = []
+        for local, dest in self._scratchFiles(key):
+            plane = planeOf(os.path.basename(local))
+            planes.append((PLANE_ORDER.index(plane), plane, local))
+        planes.sort()
+
+        dirname = os.path.dirname(mefPath)
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                if not os.path.isdir(dirname):
+                    raise
+        hdus = []
+        scratch = []
+        try:
+            for order, plane, local in planes:
+                path, extent = self._planeHdu(local,
+                                              self.compression[key].get(plane))
+                hdus.append((plane, path, extent))
+                scratch.append(local)
+                if path != local:
+                    scratch.append(path)
+            written = appendExtensions(mefPath, ccdId, nAmps, ampId, hdus)
+        finally:
+            for path in scratch:
+                os.remove(path)
+        self._removeScratch(key)
+        self.log.log(pexLog.Log.DEBUG, "wrote %d extensions into %s" %
+                     (len(written), mefPath))
+
+    def _planeHdu(self, local, args):
+        """
+        return the FITS file and HduExtent of the HDU to write for a plane:
+        its tile-compressed HDU if args are given and it is smaller than
+        the uncompressed one, otherwise the uncompressed one
+        """
+        extent = hduExtent(local, 1)
+        self.bytesIn += extent.size()
+        if args is not None:
+            compressed = local + ".fz"
+            self._fpack(local, compressed, args)
+            extents = hduExtents(compressed)
+            cextent = extents[0]
+            if cextent.dataSize == 0 and len(extents) > 1:
+                # the empty primary HDU of a compressed file
+                cextent = extents[1]
+            if cextent.size() < extent.size():
+                self.bytesOut += cextent.size()
+                return compressed, cextent
+            os.remove(compressed)
+            self.log.log(pexLog.Log.WARN,
+                         "%s does not compress; writing it uncompressed" %
+                         local)
+        self.bytesOut += extent.size()
+        return local, extent
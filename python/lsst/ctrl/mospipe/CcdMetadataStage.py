@@ -22,8 +22,12 @@
 
 from lsst.pex.harness.Stage import Stage
 from lsst.daf.persistence import LogicalLocation, DbStorage
+from lsst.ctrl.mospipe.StageTiming import timed
 
 class CcdMetadataStage(Stage):
+    writesDatabase = True
+
+    @timed
     def preprocess(self):
         self.activeClipboard = self.inputQueue.getNextDataset()
         fpaExposureId0 = self.activeClipboard.get('visit0').get('exposureId')
@@ -0,0 +1,219 @@
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+
+"""
+Determination of the WCS once per CCD.
+
+WcsDeterminationStage fits the WCS of a whole CCD from the CCD's sources
+(ccdWcsSources) and then shifts it to the amplifier, so with one slice per
+amplifier, the same fit is done once for every amplifier of the CCD.
+CcdWcsBroadcastStage runs the fit for only one of them:  the first slice
+to reach the stage for a CCD claims it (by creating a file in a per-visit
+work directory), runs the WcsDeterminationStage and writes the resulting
+CCD WCS, as FITS header keywords, to a file that the CCD's other slices
+wait for.  Each of those then puts the CCD WCS on its clipboard under the
+same key the WcsDeterminationStage uses and gives its exposures the WCS
+shifted by their amplifier's offset (ampBBox) within the CCD.
+
+If the slice that claimed a CCD fails, or does not finish within
+waitTimeout seconds, the waiting slices run the fit themselves, so the
+results are never worse than without the stage.  The master removes the
+visit's work directory in postprocess(), which an AmpWorkQueueStage runs
+for its child stages.
+
+The stage policy gives the solver and its policy, the work directory
+(a LogicalLocation template expanded with the AdditionalData, on a file
+system shared by all slices) and the wait timeout; see
+pipeline/IP/18-ccdWcsBroadcast_policy.paf.
+"""
+
+import os, time, errno, shutil
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+import lsst.afw.image as afwImage
+import lsst.daf.base as dafBase
+import lsst.pex.logging as pexLog
+from lsst.pex.harness.Stage import Stage
+from lsst.ctrl.mospipe.StageTiming import timed
+from lsst.ctrl.mospipe.AmpWorkQueueStage import loadStageClass, ListQueue
+from lsst.ctrl.mospipe.StageUtils import additionalData
+from lsst.ctrl.mospipe.LogBatching import getLog
+
+FAILED = "failed"
+
+def wcsToDict(wcs):
+    """
+    return the FITS header keywords of a Wcs as a dictionary
+    """
+    metadata = wcs.getFitsMetadata()
+    out = {}
+    for name in metadata.names():
+        out[name] = metadata.get(name)
+    return out
+
+def wcsFromDict(cards):
+    """
+    return a Wcs made from a dictionary of FITS header keywords
+    """
+    metadata = dafBase.PropertySet()
+    for name, value in cards.items():
+        if isinstance(value, unicode):
+            value = str(value)
+        metadata.set(str(name), value)
+    return afwImage.Wcs(metadata)
+
+class CcdWcsBroadcastStage(Stage):
+    '''Determine the WCS of each CCD in one slice and share it with the
+    CCD's other slices.'''
+
+    def __init__(self, stageId=-1, stagePolicy=None):
+        Stage.__init__(self, stageId, stagePolicy)
+        self.log = getLog("mospipe.CcdWcsBroadcastStage")
+        solverPolicy = stagePolicy.getPolicy("solverPolicy")
+        self.solverPolicy = solverPolicy
+        name = "lsst.meas.pipeline.WcsDeterminationStage"
+        if stagePolicy.exists("solverStage"):
+            name = stagePolicy.getString("solverStage")
+        self.solver = loadStageClass(name)(stageId, solverPolicy)
+        self.queues = (ListQueue(), ListQueue())
+        self.waitTimeout = 300.0
+        if stagePolicy.exists("waitTimeout"):
+            self.waitTimeout = stagePolicy.get("waitTimeout")
+        self.solved = 0
+        self.shared = 0
+
+    def setRank(self, rank):
+        Stage.setRank(self, rank)
+        self.solver.setRank(rank)
+
+    def _workDir(self, clipboard):
+        import lsst.daf.persistence as dafPersist
+        data = additionalData(self._policy, clipboard)
+        return dafPersist.LogicalLocation(self._policy.getString("workDir"),
+                                          data).locString()
+
+    def _solve(self, clipboard):
+        """
+        run the WcsDeterminationStage on the clipboard
+        """
+        inQueue, outQueue = self.queues
+        self.solver.initialize(outQueue, inQueue)
+        inQueue.addDataset(clipboard)
+        self.solver.process()
+        return outQueue.getNextDataset()
+
+    def _write(self, path, content):
+        tmp = "%s.tmp%d" % (path, os.getpid())
+        f = open(tmp, "w")
+        try:
+            json.dump(content, f)
+        finally:
+            f.close()
+        os.rename(tmp, path)
+
+    def _claim(self, path):
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError, e:
+            if e.errno == errno.EEXIST:
+                return False
+            raise
+        os.write(fd, "%d\n" % self.getRank())
+        os.close(fd)
+        return True
+
+    def _wait(self, path):
+        """
+        return the contents of the result file, or None if it does not
+        appear within the timeout
+        """
+        deadline = time.time() + self.waitTimeout
+        delay = 0.05
+        while True:
+            try:
+                f = open(path)
+                try:
+                    return json.load(f)
+                finally:
+                    f.close()
+            except IOError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+            if time.time() >= deadline:
+                return None
+            time.sleep(delay)
+            delay = min(2 * delay, 1.0)
+
+    def _apply(self, clipboard, cards):
+        """
+        put the CCD's WCS on the clipboard and give each exposure the WCS
+        of its amplifier
+        """
+        policy = self.solverPolicy
+        clipboard.put(policy.getString("outputCcdWcsKey"), wcsFromDict(cards))
+        ampBBox = clipboard.get(policy.getString("ampBBoxKey"))
+        for key in policy.getStringArray("exposureKeyList"):
+            wcs = wcsFromDict(cards)
+            wcs.shiftReferencePixel(-ampBBox.getX0(), -ampBBox.getY0())
+            clipboard.get(key).setWcs(wcs)
+
+    @timed
+    def process(self):
+        clipboard = self.inputQueue.getNextDataset()
+        workDir = self._workDir(clipboard)
+        try:
+            os.makedirs(workDir)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        ccd = os.path.join(workDir, "c%03d" % clipboard.get("ccdId"))
+
+        if self._claim(ccd + ".claim"):
+            try:
+                clipboard = self._solve(clipboard)
+            except:
+                self._write(ccd + ".json", FAILED)
+                raise
+            wcs = clipboard.get(self.solverPolicy.getString("outputCcdWcsKey"))
+            self._write(ccd + ".json", wcsToDict(wcs))
+            self.solved += 1
+        else:
+            cards = self._wait(ccd + ".json")
+            if cards is None or cards == FAILED:
+                self.log.log(pexLog.Log.WARN,
+                             "no WCS from the slice that claimed CCD %d; "
+                             "determining it here" % clipboard.get("ccdId"))
+                clipboard = self._solve(clipboard)
+                self.solved += 1
+            else:
+                self._apply(clipboard, cards)
+                self.shared += 1
+        self.outputQueue.addDataset(clipboard)
+
+    @timed
+    def postprocess(self):
+        shutil.rmtree(self._workDir(self.activeClipboard), True)
+        self.outputQueue.addDataset(self.activeClipboard)
@@ -0,0 +1,321 @@
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+
+"""
+An OutputStage that writes tile-compressed FITS files.
+
+The FitsStorage items of an OutputStage policy that have a "Compression"
+policy are written to a local scratch directory first, at the absolute
+path of the location the policy gives for the visit below a directory per
+item; each FITS file written for them (one per plane of an Exposure or
+MaskedImage) is then compressed with fpack straight into that location.
+The files keep their names, and cfitsio decompresses them transparently on
+reading, so the existing input stages read them as before.  An item with
+a Compression policy for which no file was written is an error.
+
+The Compression policy of an item gives, for each plane, the fpack
+compression algorithm ("rice", "gzip", "hcompress" or "plio") and, for
+floating point planes, the quantization level (see the fpack
+documentation; noise / level is the quantization step):
+
+    Compression: {
+        image:    { algorithm: "rice"  quantize: 16 }
+        mask:     { algorithm: "rice" }
+        variance: { algorithm: "rice"  quantize: 16 }
+    }
+
+A plane not listed is copied uncompressed.  Files other than the planes of
+an Exposure use the "image" entry.  If fpack cannot be found, the stage
+behaves like a plain OutputStage.  The stage policy may also give the
+scratch directory (scratchDir, by default /tmp/mospipe-output) and the
+fpack command (fpack).
+
+fpack puts each compressed image in an extension after an empty primary
+HDU, which a reader of the first HDU would take for an empty image.  So
+the first time each item is compressed, the stage reads it back from its
+final location as its PythonType, the way the input stages do, and checks
+that its dimensions are those of the item on the clipboard; if not, it
+warns and writes that item uncompressed from then on.  Setting verify to
+false in the stage policy skips the check.
+"""
+
+import os, shutil, subprocess
+
+from lsst.pex.harness.IOStage import OutputStage
+import lsst.pex.logging as pexLog
+from lsst.ctrl.mospipe.StageTiming import timed
+from lsst.ctrl.mospipe.FitsUtils import planeOf
+from lsst.ctrl.mospipe.LogBatching import getLog
+from lsst.ctrl.mospipe.StageUtils import additionalData, PushbackQueue
+
+ALGORITHMS = { "rice": "-r", "gzip": "-g", "hcompress": "-h", "plio": "-p" }
+
+def findExecutable(name):
+    """
+    return the path of the named executable, or None if it is not on the
+    PATH
+    """
+    if os.path.dirname(name):
+        if os.access(name, os.X_OK):
+            return name
+        return None
+    for dirname in os.environ.get("PATH", "").split(os.pathsep):
+        path = os.path.join(dirname, name)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
+def fpackArgs(policy):
+    """
+    return the fpack options for the compression of one plane
+    """
+    args = []
+    if policy.exists("algorithm"):
+        algorithm = policy.getString("algorithm")
+        if not ALGORITHMS.has_key(algorithm):
+            raise RuntimeError("unknown compression algorithm: %s" %
+                               algorithm)
+        args.append(ALGORITHMS[algorithm])
+    if policy.exists("quantize"):
+        args += ["-q", str(policy.get("quantize"))]
+    return args
+
+def dimensions(item):
+    """
+    return the (width, height) of an image, MaskedImage or Exposure
+    """
+    if hasattr(item, "getMaskedImage"):
+        item = item.getMaskedImage()
+    return (item.getWidth(), item.getHeight())
+
+class CompressedOutputStage(OutputStage):
+    '''An OutputStage that compresses the FITS files of selected items
+    with fpack.'''
+
+    def __init__(self, stageId=-1, stagePolicy=None):
+        OutputStage.__init__(self, stageId, stagePolicy)
+        self.log = getLog("mospipe.CompressedOutputStage")
+        self.bytesIn = 0
+        self.bytesOut = 0
+        # item name -> { plane: fpack options }
+        self.compression = {}
+        # item name -> [(FitsStorage policy, its Location template)]
+        self.locations = {}
+        # item name -> the final locations of the current visit
+        self.expanded = {}
+        # item name -> the PythonType the item is read back as
+        self.pythonTypes = {}
+        # the items whose compressed files have been read back
+        self.verified = {}
+        if stagePolicy is None or not stagePolicy.exists("OutputItems"):
+            return
+
+        if stagePolicy.exists("verify") and not stagePolicy.getBool("verify"):
+            self.verified = None
+
+        fpack = "fpack"
+        if stagePolicy.exists("fpack"):
+            fpack = stagePolicy.getString("fpack")
+        self.fpack = findExecutable(fpack)
+        scratchDir = "/tmp/mospipe-output"
+        if stagePolicy.exists("scratchDir"):
+            scratchDir = stagePolicy.getString("scratchDir")
+        self.scratchDir = os.path.join(scratchDir, str(os.getpid()))
+
+        items = stagePolicy.getPolicy("OutputItems")
+        for key in items.names(True):
+            item = items.getPolicy(key)
+            if not item.exists("Compression"):
+                continue
+            if self.fpack is None:
+                self.log.log(pexLog.Log.WARN,
+                             "%s not found; writing %s uncompressed" %
+                             (fpack, key))
+                continue
+            compression = item.getPolicy("Compression")
+            planes = {}
+            for plane in compression.names(True):
+                planes[plane] = fpackArgs(compression.getPolicy(plane))
+            locations = []
+            for storage in item.getPolicyArray("StoragePolicy"):
+                if storage.getString("Storage") == "FitsStorage":
+                    locations.append((storage,
+                                      storage.getString("Location")))
+            self.compression[key] = planes
+            self.locations[key] = locations
+            if item.exists("PythonType"):
+                self.pythonTypes[key] = item.getString("PythonType")
+
+    def _compress(self, local, dest, args, keep=False):
+        """
+        compress (or, with no fpack options, copy) a scratch file into its
+        final location
+        @param keep   if True, leave the scratch file in place
+        """
+        dirname = os.path.dirname(dest)
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                if not os.path.isdir(dirname):
+                    raise
+        tmp = "%s.tmp%d" % (dest, os.getpid())
+        if args is None:
+            shutil.copyfile(local, tmp)
+        else:
+            self._fpack(local, tmp, args)
+        os.rename(tmp, dest)
+        if not keep:
+            self._count(local, dest)
+            os.remove(local)
+
+    def _count(self, local, dest):
+        self.bytesIn += os.path.getsize(local)
+        self.bytesOut += os.path.getsize(dest)
+
+    def _fpack(self, local, compressed, args):
+        """
+        compress a FITS file into another with fpack
+        """
+        out = open(compressed, "wb")
+        try:
+            status = subprocess.call([self.fpack] + args + ["-S", local],
+                                     stdout=out)
+        finally:
+            out.close()
+        if status != 0:
+            os.remove(compressed)
+            raise RuntimeError("%s failed on %s (status %d)" %
+                               (self.fpack, local, status))
+
+    @timed
+    def process(self):
+        clipboard = self.inputQueue.getNextDataset()
+        self._setLocations(clipboard)
+        queue = self.inputQueue
+        self.inputQueue = PushbackQueue(queue, clipboard)
+        try:
+            OutputStage.process(self)
+        finally:
+            self.inputQueue = queue
+        for key in self.locations.keys():
+            self._compressItem(key, clipboard)
+        if self.bytesOut:
+            self.log.log(pexLog.Log.DEBUG,
+                         "compressed %d bytes to %d (%.1f:1)" %
+                         (self.bytesIn, self.bytesOut,
+                          float(self.bytesIn) / self.bytesOut))
+
+    def _setLocations(self, clipboard):
+        """
+        point the FitsStorage locations of the compressed items at the
+        scratch directory, below each item's directory at the absolute
+        path the file is finally compressed to
+        """
+        import lsst.daf.persistence as dafPersist
+        data = additionalData(self._policy, clipboard)
+        for key, locations in self.locations.items():
+            root = os.path.join(self.scratchDir, key)
+            self.expanded[key] = []
+            for storage, template in locations:
+                expanded = dafPersist.LogicalLocation(template,
+                                                      data).locString()
+                self.expanded[key].append(expanded)
+                storage.set("Location",
+                            os.path.join(root, os.path.abspath(
+                                expanded).lstrip(os.sep)))
+
+    def _scratchFiles(self, key):
+        """
+        return the (path, final path) of the files written for an item to
+        the scratch directory
+        """
+        root = os.path.join(self.scratchDir, key)
+        out = []
+        for dirpath, dirnames, filenames in os.walk(root):
+            for name in filenames:
+                local = os.path.join(dirpath, name)
+                out.append((local, os.sep + os.path.relpath(local, root)))
+        if not out:
+            raise RuntimeError("no FITS file was written for %s" % key)
+        out.sort()
+        return out
+
+    def _removeScratch(self, key):
+        root = os.path.join(self.scratchDir, key)
+        for dirpath, dirnames, filenames in os.walk(root, False):
+            if dirpath != root:
+                try:
+                    os.rmdir(dirpath)
+                except OSError:
+                    pass
+
+    def _compressItem(self, key, clipboard):
+        """
+        compress the files written for an item to the scratch directory
+        into their final locations
+        """
+        planes = self.compression[key]
+        files = self._scratchFiles(key)
+        verify = self.verified is not None and \
+                 not self.verified.has_key(key) and \
+                 self.pythonTypes.has_key(key)
+        for local, dest in files:
+            self._compress(local, dest,
+                           planes.get(planeOf(os.path.basename(local))),
+                           verify)
+        if verify:
+            self.verified[key] = True
+            problem = self._readBackProblem(key, clipboard)
+            if problem is not None:
+                self.log.log(pexLog.Log.WARN,
+                             "compressed %s does not read back (%s); writing it uncompressed" %
+                             (key, problem))
+                self.compression[key] = {}
+                for local, dest in files:
+                    self._compress(local, dest, None)
+            else:
+                for local, dest in files:
+                    self._count(local, dest)
+                    os.remove(local)
+        self._removeScratch(key)
+
+    def _readBackProblem(self, key, clipboard):
+        """
+        read the compressed files of an item back from their final
+        locations as the item's PythonType and return what is wrong with
+        them, or None if they have the dimensions of the item on the
+        clipboard
+        """
+        module, name = self.pythonTypes[key].rsplit(".", 1)
+        cls = getattr(__import__(module, {}, {}, [name]), name)
+        expected = dimensions(clipboard.get(key))
+        for location in self.expanded[key]:
+            try:
+                found = dimensions(cls(location))
+            except Exception, e:
+                return str(e).strip().split("\n")[0]
+            if found != expected:
+                return "%dx%d instead of %dx%d at %s" % \
+                       (found + expected + (location,))
+        return None
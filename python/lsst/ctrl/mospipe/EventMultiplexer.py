@@ -0,0 +1,109 @@
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+"""
+Listen to several event topics at once.
+"""
+
+import threading, time, Queue
+
+class EventMultiplexer(object):
+    """
+    a listener that reads from any number of event receivers, one thread
+    per receiver, and funnels what it receives into a single queue.  Each
+    event is stamped with the time it was taken off its receiver.
+    """
+
+    def __init__(self, receivers, pollTime=500, maxQueued=0):
+        """
+        @param receivers  a list of EventReceiver instances
+        @param pollTime   the maximum milliseconds a listener thread blocks
+                            in receive() before checking whether it should
+                            stop
+        @param maxQueued  the maximum number of events to hold before
+                            listener threads block; 0 means no limit
+        """
+        self.receivers = list(receivers)
+        self.pollTime = pollTime
+        self._queue = Queue.Queue(maxQueued)
+        self._stopping = threading.Event()
+        self._threads = []
+
+    def start(self):
+        """
+        start a listener thread for each receiver
+        """
+        self._stopping.clear()
+        for rcvr in self.receivers:
+            t = threading.Thread(target=self._listen, args=(rcvr,),
+                                 name="listen-" + rcvr.getTopicName())
+            t.setDaemon(True)
+            t.start()
+            self._threads.append(t)
+
+    def stop(self, wait=True):
+        """
+        ask all listener threads to stop
+        @param wait   if True, wait until they have done so
+        """
+        self._stopping.set()
+        if wait:
+            for t in self._threads:
+                t.join()
+        self._threads = []
+
+    def _listen(self, rcvr):
+        topic = rcvr.getTopicName()
+        while not self._stopping.isSet():
+            event = rcvr.receive(self.pollTime)
+            if event is not None:
+                self._queue.put((topic, time.time(), event))
+
+    def get(self, timeout=None):
+        """
+        wait for events to arrive, and return all that are available.
+        @param timeout   the maximum seconds to wait for the first event;
+                           None means wait indefinitely.
+        @return list   a list of (topic, receipt time, event) tuples in the
+                         order received; empty if none arrived in time.
+        """
+        out = []
+        try:
+            if timeout is None:
+                # a blocking get() without a timeout cannot be interrupted
+                # by KeyboardInterrupt
+                while not out:
+                    try:
+                        out.append(self._queue.get(True, 3600))
+                    except Queue.Empty:
+                        pass
+            else:
+                out.append(self._queue.get(True, timeout))
+        except Queue.Empty:
+            return out
+
+        while True:
+            try:
+                out.append(self._queue.get_nowait())
+            except Queue.Empty:
+                break
+        return out
@@ -24,8 +24,10 @@ from lsst.pex.harness.Stage import Stage
 from lsst.daf.persistence import LogicalLocation
 from lsst.daf.base import PropertySet, DateTime
 import lsst.afw.image as afwImage
+from lsst.ctrl.mospipe.StageTiming import timed
 
 class VisitMetadataStage(Stage):
+    @timed
     def preprocess(self):
         self.activeClipboard = self.inputQueue.getNextDataset()
 
@@ -56,6 +58,7 @@ class VisitMetadataStage(Stage):
 
         # rely on default postprocess() to move self.activeClipboard to output queue
 
+    @timed
     def process(self):
         clipboard = self.inputQueue.getNextDataset()
 
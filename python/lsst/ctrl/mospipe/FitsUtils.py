@@ -0,0 +1,290 @@
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+
+"""
+Low-level access to the layout of FITS files.
+
+These functions read only the headers of a FITS file to find where each
+HDU (header and data unit) lies in it, so that the bytes of one HDU can be
+read, copied or cached without decoding the file.  HDUs are numbered as
+cfitsio and the "file.fits#hdu" locations of the persistence framework
+number them: 1 is the primary HDU, 2 the first extension, and so on (0 is
+taken to mean the primary HDU).
+"""
+
+import os
+
+BLOCK = 2880
+CARD = 80
+
+# the file name suffixes of the planes of a persisted Exposure or
+# MaskedImage
+PLANES = (("_img.fits", "image"), ("_msk.fits", "mask"),
+          ("_var.fits", "variance"))
+
+class HduExtent(object):
+    """
+    the position of one HDU within a FITS file
+    """
+    def __init__(self, hdu, offset, headerSize, dataSize, cards):
+        """
+        @param hdu         the HDU number
+        @param offset      the byte offset of its header
+        @param headerSize  the size of its header in bytes (a multiple of
+                             2880)
+        @param dataSize    the size of its data in bytes, including the
+                             padding to a multiple of 2880
+        @param cards       a dictionary of the header keywords used to
+                             compute the data size (and EXTNAME, if present)
+        """
+        self.hdu = hdu
+        self.offset = offset
+        self.headerSize = headerSize
+        self.dataSize = dataSize
+        self.cards = cards
+
+    def dataOffset(self):
+        return self.offset + self.headerSize
+
+    def end(self):
+        return self.offset + self.headerSize + self.dataSize
+
+    def size(self):
+        return self.headerSize + self.dataSize
+
+def _value(card):
+    value = card[10:].split("/", 1)[0].strip()
+    if value.startswith("'"):
+        return value.strip("'").strip()
+    try:
+        return int(value)
+    except ValueError:
+        return value
+
+def _readHeader(f):
+    """
+    read one header from the current position of f
+    @return (header size in bytes, dictionary of the structural keywords),
+            or None at the end of the file
+    """
+    cards = {}
+    size = 0
+    while True:
+        block = f.read(BLOCK)
+        if not block:
+            if size == 0:
+                return None
+            raise IOError("truncated FITS header")
+        if len(block) < BLOCK:
+            raise IOError("truncated FITS header")
+        size += BLOCK
+        for i in xrange(0, BLOCK, CARD):
+            card = block[i:i + CARD]
+            key = card[:8].strip()
+            if key == "END":
+                return size, cards
+            if card[8:10] == "= " and (key in ("BITPIX", "NAXIS", "PCOUNT",
+                                               "GCOUNT", "EXTNAME") or
+                                       key.startswith("NAXIS")):
+                cards[key] = _value(card)
+
+def _dataSize(cards):
+    naxis = cards.get("NAXIS", 0)
+    if not naxis:
+        return 0
+    count = 1
+    for i in xrange(1, naxis + 1):
+        count *= cards.get("NAXIS%d" % i, 0)
+    bits = abs(cards.get("BITPIX", 8))
+    size = bits // 8 * cards.get("GCOUNT", 1) * \
+           (cards.get("PCOUNT", 0) + count)
+    return (size + BLOCK - 1) // BLOCK * BLOCK
+
+_extentCache = {}
+
+def hduExtents(filename):
+    """
+    return the HduExtents of all HDUs of a FITS file.  The result is
+    cached until the file's modification time or size changes.
+    """
+    st = os.stat(filename)
+    key = os.path.abspath(filename)
+    cached = _extentCache.get(key)
+    if cached is not None and cached[0] == (st.st_mtime, st.st_size):
+        return cached[1]
+
+    extents = []
+    f = open(filename, "rb")
+    try:
+        offset = 0
+        while offset < st.st_size:
+            f.seek(offset)
+            header = _readHeader(f)
+            if header is None:
+                break
+            headerSize, cards = header
+            extent = HduExtent(len(extents) + 1, offset, headerSize,
+                               _dataSize(cards), cards)
+            extents.append(extent)
+            offset = extent.end()
+    finally:
+        f.close()
+    _extentCache[key] = ((st.st_mtime, st.st_size), extents)
+    return extents
+
+def hduExtent(filename, hdu):
+    """
+    return the HduExtent of the given HDU of a FITS file
+    """
+    extents = hduExtents(filename)
+    index = max(hdu, 1) - 1
+    if index >= len(extents):
+        raise IndexError("%s has no HDU %d" % (filename, hdu))
+    return extents[index]
+
+def splitLocation(location):
+    """
+    split a "file.fits#hdu" location into the file name and the HDU
+    number (None if not given)
+    """
+    if "#" not in location:
+        return location, None
+    filename, hdu = location.rsplit("#", 1)
+    return filename, int(hdu)
+
+def readRange(filename, offset, size, chunk=1 << 20, sink=None):
+    """
+    read size bytes of a file starting at offset, in chunks
+    @param sink   if given, a function called with each chunk; otherwise
+                    the chunks are discarded (which still leaves them in
+                    the operating system's page cache)
+    @return the number of bytes read
+    """
+    done = 0
+    f = open(filename, "rb")
+    try:
+        f.seek(offset)
+        while done < size:
+            data = f.read(min(chunk, size - done))
+            if not data:
+                break
+            done += len(data)
+            if sink is not None:
+                sink(data)
+    finally:
+        f.close()
+    return done
+
+def planeOf(filename):
+    """
+    return the plane ("image", "mask" or "variance") a FITS file written
+    for an Exposure or MaskedImage holds; other files are taken to hold an
+    image
+    """
+    for suffix, plane in PLANES:
+        if filename.endswith(suffix):
+            return plane
+    return "image"
+
+def formatCard(key, value, comment=None):
+    """
+    return a fixed-format header card
+    """
+    if isinstance(value, bool):
+        value = "%20s" % (value and "T" or "F")
+    elif isinstance(value, (int, long, float)):
+        value = "%20s" % value
+    else:
+        value = "'%-8s'" % str(value).replace("'", "''")
+    card = "%-8s= %s" % (key, value)
+    if comment:
+        card += " / " + comment
+    return card[:CARD].ljust(CARD)
+
+def headerCards(filename, extent):
+    """
+    return the cards of the header of an HDU, without the END card
+    """
+    f = open(filename, "rb")
+    try:
+        f.seek(extent.offset)
+        header = f.read(extent.headerSize)
+    finally:
+        f.close()
+    cards = []
+    for i in xrange(0, len(header), CARD):
+        card = header[i:i + CARD]
+        if card[:8].strip() == "END":
+            break
+        cards.append(card)
+    return cards
+
+def padHeader(cards):
+    """
+    return a header made of the given cards and an END card, padded to a
+    multiple of 2880 bytes
+    """
+    header = "".join(cards) + "END".ljust(CARD)
+    return header + " " * (-len(header) % BLOCK)
+
+def extensionHeader(cards, extname, extra=()):
+    """
+    return the header of an HDU turned into an extension named extname;
+    a primary HDU becomes an IMAGE extension
+    @param cards  the cards of the HDU's header (see headerCards)
+    @param extra  cards to add after EXTNAME
+    """
+    out = []
+    for card in cards:
+        key = card[:8].strip()
+        if key in ("EXTEND", "EXTNAME", "PCOUNT", "GCOUNT"):
+            continue
+        if key == "SIMPLE":
+            out.append(formatCard("XTENSION", "IMAGE", "image extension"))
+        else:
+            out.append(card)
+    # the mandatory keywords come first, in order
+    naxis = 0
+    for card in out:
+        if card[:8].strip() == "NAXIS":
+            naxis = _value(card)
+    position = 3 + naxis
+    # an extension (e.g. a tile-compressed image) keeps its PCOUNT and GCOUNT
+    mandatory = [c for c in cards if c[:8].strip() in ("PCOUNT", "GCOUNT")]
+    if not mandatory:
+        mandatory = [formatCard("PCOUNT", 0), formatCard("GCOUNT", 1)]
+    out[position:position] = mandatory + [formatCard("EXTNAME", extname)] + \
+                             list(extra)
+    return padHeader(out)
+
+def primaryHeader(cards):
+    """
+    return the header of an IMAGE extension turned into a primary HDU
+    @param cards  the cards of the extension's header (see headerCards)
+    """
+    out = [formatCard("SIMPLE", True, "conforms to FITS standard")]
+    for card in cards[1:]:
+        if card[:8].strip() in ("PCOUNT", "GCOUNT"):
+            continue
+        out.append(card)
+    return padHeader(out)
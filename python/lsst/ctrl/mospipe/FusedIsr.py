@@ -0,0 +1,169 @@
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+
+"""
+Instrument signature removal of one amplifier in a single pass.
+
+fusedIsr() applies the corrections that the CTIO and CFHT ISR policies turn
+on (saturation, overscan, trim, bias and flat) to the pixels of a raw
+amplifier as NumPy array operations on the trimmed region, writing the
+image, mask and variance directly into the given output arrays instead of
+making an intermediate image for each correction.  See FusedIsrStage for
+the stage that uses it.
+
+Sections are given as in FITS headers, "[x1:x2,y1:y2]" with 1-based
+inclusive pixel ranges; parseSection() turns them into the (rows, columns)
+slices of a NumPy array.
+"""
+
+import re
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+FIT_TYPES = ("MEAN", "MEDIAN", "POLYNOMIAL")
+
+def parseSection(section):
+    """
+    return the (row slice, column slice) of a "[x1:x2,y1:y2]" section
+    """
+    match = re.match(r"\s*\[\s*(\d+)\s*:\s*(\d+)\s*,\s*(\d+)\s*:\s*(\d+)\s*\]",
+                     section)
+    if match is None:
+        raise ValueError("bad section: %s" % section)
+    x1, x2, y1, y2 = [int(v) for v in match.groups()]
+    return (slice(min(y1, y2) - 1, max(y1, y2)),
+            slice(min(x1, x2) - 1, max(x1, x2)))
+
+def overscanModel(raw, overscan, trim, fitType="MEDIAN", polyOrder=1):
+    """
+    return the overscan level to subtract from the trimmed region: a
+    number, or for a POLYNOMIAL fit, a column (serial overscan) or row
+    (parallel overscan) of values broadcastable over the trimmed region
+    @param raw       the raw amplifier pixels
+    @param overscan  the (rows, columns) slices of the overscan region
+    @param trim      the (rows, columns) slices of the data region
+    """
+    pixels = raw[overscan]
+    if fitType == "MEAN":
+        return float(pixels.mean())
+    if fitType == "MEDIAN":
+        return float(numpy.median(pixels))
+    if fitType != "POLYNOMIAL":
+        raise ValueError("unknown overscan fit type: %s" % fitType)
+
+    # a serial overscan spans the rows of the data region and is fitted
+    # along them; a parallel one is fitted along the columns
+    oy, ox = [s.indices(n) for s, n in zip(overscan, raw.shape)]
+    ty, tx = [s.indices(n) for s, n in zip(trim, raw.shape)]
+    serial = oy[0] <= ty[0] and oy[1] >= ty[1]
+    if serial:
+        levels = numpy.median(pixels, axis=1)
+        first, wanted = oy[0], ty
+    else:
+        levels = numpy.median(pixels, axis=0)
+        first, wanted = ox[0], tx
+    positions = numpy.arange(first, first + len(levels))
+    fit = numpy.polyval(numpy.polyfit(positions, levels, polyOrder),
+                        numpy.arange(wanted[0], wanted[1]))
+    if serial:
+        return fit[:, numpy.newaxis]
+    return fit[numpy.newaxis, :]
+
+def trimmed(calib, raw, trim):
+    """
+    return the part of a calibration frame matching the trimmed region
+    """
+    if calib.shape == raw.shape:
+        return calib[trim]
+    shape = tuple([s.indices(n)[1] - s.indices(n)[0]
+                   for s, n in zip(trim, raw.shape)])
+    if calib.shape != shape:
+        raise ValueError("calibration frame is %s, expected %s or %s" %
+                         (calib.shape, raw.shape, shape))
+    return calib
+
+def growMask(flags, grow):
+    """
+    return the boolean array flags with each set pixel grown by grow pixels
+    in each direction
+    """
+    if grow <= 0 or not flags.any():
+        return flags
+    out = flags.copy()
+    ny, nx = flags.shape
+    for dy in xrange(-grow, grow + 1):
+        for dx in xrange(-grow, grow + 1):
+            if dy == 0 and dx == 0:
+                continue
+            out[max(dy, 0):ny + min(dy, 0), max(dx, 0):nx + min(dx, 0)] |= \
+                flags[max(-dy, 0):ny + min(-dy, 0), max(-dx, 0):nx + min(-dx, 0)]
+    return out
+
+def fusedIsr(raw, trim, image, mask=None, variance=None, overscan=None,
+             fitType="MEDIAN", polyOrder=1, bias=None, flat=None,
+             flatScale=1.0, saturation=None, grow=0, satBit=0, gain=1.0):
+    """
+    remove the instrument signature of a raw amplifier
+    @param raw         the raw pixels, including the overscan
+    @param trim        the (rows, columns) slices of the data region
+    @param image       the output image, the shape of the data region
+    @param mask        the output mask, or None
+    @param variance    the output variance, or None
+    @param overscan    the (rows, columns) slices of the overscan region, or
+                         None for no overscan correction
+    @param bias        the bias frame, raw-sized or trimmed, or None
+    @param flat        the flat field, raw-sized or trimmed, or None
+    @param flatScale   the level of the flat field, which it is divided by
+    @param saturation  the saturation level, or None
+    @param grow        the pixels to grow the saturated areas by
+    @param satBit      the mask bit of saturated pixels
+    @param gain        the gain in electrons per count, for the variance
+    """
+    data = raw[trim]
+    if overscan is not None:
+        numpy.subtract(data, overscanModel(raw, overscan, trim, fitType,
+                                           polyOrder), image)
+    else:
+        image[...] = data
+    if variance is not None:
+        # Poisson noise of the signal before bias and flat correction
+        numpy.maximum(image, 0, variance)
+        variance /= gain
+    if bias is not None:
+        image -= trimmed(bias, raw, trim)
+    if flat is not None:
+        flat = trimmed(flat, raw, trim)
+        image /= flat
+        image *= flatScale
+        if variance is not None:
+            variance /= flat
+            variance /= flat
+            variance *= flatScale * flatScale
+    if mask is not None:
+        mask[...] = 0
+        if saturation is not None:
+            mask[growMask(data >= saturation, grow)] |= satBit
+    return image
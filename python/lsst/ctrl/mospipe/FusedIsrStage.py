@@ -0,0 +1,245 @@
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+
+"""
+An ISR stage that corrects each amplifier in a single pass (see FusedIsr).
+
+FusedIsrStage takes the same policy as the ip_isr IsrStage (see
+pipeline/IP/10-isr_policy.paf) and the same clipboard items:  the raw
+DecoratedImage (inputImageKey), and the bias and flat Exposures made by
+TransformCalibrationImageStage (biasExposure and flatExposure unless the
+policy names others as biasKey and flatKey).  It puts the calibrated
+Exposure, trimmed, with a mask of the saturated pixels and a variance
+plane, under calibratedExposureKey.  Of the corrections in the ISR policy
+it supports saturation, overscan, trim, bias and flat; it refuses to run
+with any other one turned on.
+
+With "compare: true", the stage also runs the IsrStage it replaces on each
+amplifier and logs how far apart the results are to the
+"mospipe.FusedIsrStage" log, with a warning when the largest difference
+relative to the reference image exceeds "tolerance" (1e-4 by default) or
+the saturation masks differ; "keep" selects the result that goes on
+("reference", the default, or "fused").
+
+The stage needs NumPy and an afw whose images expose their pixels as
+arrays (getArray()).
+"""
+
+import lsst.afw.image as afwImage
+import lsst.daf.base as dafBase
+import lsst.pex.logging as pexLog
+from lsst.pex.harness.Stage import Stage
+from lsst.ctrl.mospipe.StageTiming import timed
+from lsst.ctrl.mospipe.AmpWorkQueueStage import loadStageClass, ListQueue
+from lsst.ctrl.mospipe import FusedIsr
+from lsst.ctrl.mospipe.FusedIsr import fusedIsr, parseSection, trimmed
+from lsst.ctrl.mospipe.LogBatching import getLog
+from lsst.ctrl.mospipe.CalibrationStore import CALIBRATION_IDS
+
+SUPPORTED = ("saturationCorrection", "overscanCorrection", "trim",
+             "biasCorrection", "flatCorrection")
+UNSUPPORTED = ("linearize", "darkCorrection", "fringeCorrection",
+               "maskBadPixels", "cosmicRayCorrection", "crossTalkCorrection")
+
+def _get(policy, name, default):
+    if policy is not None and policy.exists(name):
+        return policy.get(name)
+    return default
+
+class FusedIsrStage(Stage):
+    '''Remove the instrument signature of each amplifier in one pass.'''
+
+    def __init__(self, stageId=-1, stagePolicy=None):
+        Stage.__init__(self, stageId, stagePolicy)
+        if FusedIsr.numpy is None:
+            raise RuntimeError("FusedIsrStage needs numpy")
+        if not hasattr(afwImage.ImageF, "getArray"):
+            raise RuntimeError("FusedIsrStage needs afw images with getArray()")
+        self.log = getLog("mospipe.FusedIsrStage")
+
+        isr = stagePolicy.getPolicy("isrPolicy")
+        for name in UNSUPPORTED:
+            if _get(isr, name, False):
+                raise RuntimeError("FusedIsrStage does not support %s" % name)
+        self.steps = {}
+        for name in SUPPORTED:
+            self.steps[name] = bool(_get(isr, name, False))
+        self.isr = isr
+
+        self.compare = bool(_get(stagePolicy, "compare", False))
+        self.tolerance = _get(stagePolicy, "tolerance", 1.0e-4)
+        self.keep = _get(stagePolicy, "keep", "reference")
+        self.reference = None
+        if self.compare:
+            name = _get(stagePolicy, "referenceStage", "lsst.ip.isr.IsrStage")
+            self.reference = loadStageClass(name)(stageId, stagePolicy)
+            self.queues = (ListQueue(), ListQueue())
+        # (calibration id of the flat, its level); the id stays the same
+        # while the flat is unchanged (see CalibrationStore)
+        self.flatScale = (None, None)
+
+    def setRank(self, rank):
+        Stage.setRank(self, rank)
+        if self.reference is not None:
+            self.reference.setRank(rank)
+
+    def _policyValue(self, sub, name, default):
+        if not self.isr.exists(sub):
+            return default
+        return _get(self.isr.getPolicy(sub), name, default)
+
+    def _metadataValue(self, metadata, keyword, default=None):
+        if keyword and metadata.exists(keyword):
+            return metadata.get(keyword)
+        return default
+
+    def _flatScale(self, calibId, flat, array, raw, trim):
+        if calibId is not None and self.flatScale[0] == calibId:
+            return self.flatScale[1]
+        scale = self._metadataValue(flat.getMetadata(),
+                                    self._policyValue("flatPolicy",
+                                                      "flatScaleKeyword", None))
+        if scale is None:
+            pixels = trimmed(array, raw, trim)
+            fitType = self._policyValue("flatPolicy", "flatScaleFitType",
+                                        "MEDIAN")
+            if fitType == "MEAN":
+                scale = float(pixels.mean())
+            else:
+                scale = float(FusedIsr.numpy.median(pixels))
+        self.flatScale = (calibId, scale)
+        return scale
+
+    def _fused(self, clipboard):
+        dImage = clipboard.get(self._policy.getString("inputImageKey"))
+        metadata = dImage.getMetadata()
+        raw = dImage.getImage().getArray()
+
+        trim = (slice(None), slice(None))
+        if self.steps["trim"]:
+            keyword = self._policyValue("trimPolicy", "trimsecKeyword",
+                                        "TRIMSEC")
+            trim = parseSection(metadata.getString(keyword))
+        overscan = None
+        if self.steps["overscanCorrection"]:
+            keyword = self._policyValue("overscanPolicy", "overscanKeyword",
+                                        "BIASSEC")
+            overscan = parseSection(metadata.getString(keyword))
+
+        bias, flat, flatScale = None, None, 1.0
+        if self.steps["biasCorrection"]:
+            exposure = clipboard.get(_get(self._policy, "biasKey",
+                                          "biasExposure"))
+            bias = exposure.getMaskedImage().getImage().getArray()
+        if self.steps["flatCorrection"]:
+            flatKey = _get(self._policy, "flatKey", "flatExposure")
+            exposure = clipboard.get(flatKey)
+            flat = exposure.getMaskedImage().getImage().getArray()
+            ids = clipboard.get(CALIBRATION_IDS) or {}
+            flatScale = self._flatScale(ids.get(flatKey), exposure, flat,
+                                        raw, trim)
+
+        saturation, grow = None, 0
+        if self.steps["saturationCorrection"]:
+            saturation = self._metadataValue(
+                metadata,
+                self._policyValue("saturationPolicy", "saturationKeyword",
+                                  "SATURATE"),
+                self._policyValue("saturationPolicy", "defaultSaturation",
+                                  None))
+            grow = self._policyValue("saturationPolicy", "growSaturated", 0)
+        gainKeyword = self._policyValue("exposurePolicy", "gainKeyword",
+                                        _get(self.isr, "defaultGainKeyword",
+                                             "GAIN"))
+        gain = self._metadataValue(metadata, gainKeyword, 1.0)
+
+        rows, cols = raw[trim].shape
+        maskedImage = afwImage.MaskedImageF(cols, rows)
+        fusedIsr(raw, trim, maskedImage.getImage().getArray(),
+                 maskedImage.getMask().getArray(),
+                 maskedImage.getVariance().getArray(), overscan,
+                 self._policyValue("overscanPolicy", "overscanFitType",
+                                   "MEDIAN"),
+                 self._policyValue("overscanPolicy", "polyOrder", 1),
+                 bias, flat, flatScale, saturation, grow,
+                 afwImage.MaskU.getPlaneBitMask("SAT"), gain)
+
+        # the trimmed image starts at the first pixel of the data region
+        outMetadata = metadata.deepCopy()
+        y0, x0 = trim[0].indices(raw.shape[0])[0], \
+                 trim[1].indices(raw.shape[1])[0]
+        for name, offset in (("CRPIX1", x0), ("CRPIX2", y0)):
+            if outMetadata.exists(name):
+                outMetadata.setDouble(name, outMetadata.getDouble(name) - offset)
+        exposure = afwImage.makeExposure(maskedImage)
+        if outMetadata.exists("CRPIX1"):
+            exposure.setWcs(afwImage.Wcs(outMetadata))
+        exposure.setMetadata(outMetadata)
+        return exposure
+
+    def _compare(self, fused, reference):
+        numpy = FusedIsr.numpy
+        a = fused.getMaskedImage().getImage().getArray()
+        b = reference.getMaskedImage().getImage().getArray()
+        props = dafBase.PropertySet()
+        if a.shape != b.shape:
+            self.log.log(pexLog.Log.WARN,
+                         "fused ISR image is %s, reference is %s" %
+                         (a.shape, b.shape))
+            return
+        diff = numpy.abs(a - b)
+        scale = max(float(numpy.abs(b).max()), 1.0e-30)
+        sat = afwImage.MaskU.getPlaneBitMask("SAT")
+        satA = fused.getMaskedImage().getMask().getArray() & sat
+        satB = reference.getMaskedImage().getMask().getArray() & sat
+        maskDiffs = int((satA != satB).sum())
+        props.setDouble("maxDiff", float(diff.max()))
+        props.setDouble("rmsDiff", float(numpy.sqrt((diff * diff).mean())))
+        props.setDouble("maxRelDiff", float(diff.max()) / scale)
+        props.setInt("saturationMaskDiffs", maskDiffs)
+        level = pexLog.Log.INFO
+        if float(diff.max()) / scale > self.tolerance or maskDiffs:
+            level = pexLog.Log.WARN
+        self.log.log(level, "fused ISR differs from reference by %g (max), "
+                     "%d saturation mask pixels" %
+                     (float(diff.max()), maskDiffs), props)
+
+    @timed
+    def process(self):
+        clipboard = self.inputQueue.getNextDataset()
+        outputKey = self._policy.getString("calibratedExposureKey")
+        fused = self._fused(clipboard)
+
+        if self.reference is not None:
+            inQueue, outQueue = self.queues
+            self.reference.initialize(outQueue, inQueue)
+            inQueue.addDataset(clipboard)
+            self.reference.process()
+            clipboard = outQueue.getNextDataset()
+            self._compare(fused, clipboard.get(outputKey))
+            if self.keep != "fused":
+                fused = None
+
+        if fused is not None:
+            clipboard.put(outputKey, fused)
+        self.outputQueue.addDataset(clipboard)
@@ -0,0 +1,143 @@
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+
+"""
+Deferred imports for command-line tools.
+
+Importing the LSST stack (afw in particular) takes seconds, which the
+event generators and monitors pay even when they are only asked for
+--help or when the code path that needs a module is never taken.
+lazyModule() returns a stand-in that imports the real module the first
+time one of its attributes is used:
+
+    afwImage = lazyModule("lsst.afw.image")
+    ...
+    metadata = afwImage.readMetadata(filename)    # imported here
+
+If the environment variable MOSPIPE_IMPORT_REPORT is set when this module
+is first imported, every import from then on is timed and a report of the
+slowest ones is written to standard error when the process exits.
+Lazily loaded modules appear in the report under "(lazy)".
+"""
+
+import os, sys, time, atexit
+import __builtin__
+
+class LazyModule(object):
+    """
+    a stand-in for a module that is imported upon first use
+    """
+    def __init__(self, name):
+        self.__dict__["_name"] = name
+        self.__dict__["_module"] = None
+
+    def _load(self):
+        module = self.__dict__["_module"]
+        if module is None:
+            name = self.__dict__["_name"]
+            if _report is not None:
+                _report.lazy.add(name)
+            __import__(name)
+            module = sys.modules[name]
+            self.__dict__["_module"] = module
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+    def __repr__(self):
+        if self.__dict__["_module"] is None:
+            return "<lazy module '%s' (not loaded)>" % self.__dict__["_name"]
+        return repr(self.__dict__["_module"])
+
+def lazyModule(name):
+    """
+    return the named module if it is already loaded, or a LazyModule that
+    loads it upon first use otherwise
+    """
+    if sys.modules.get(name) is not None:
+        return sys.modules[name]
+    return LazyModule(name)
+
+class ImportReport(object):
+    """
+    a record of the time spent in each import
+    """
+    def __init__(self, out=sys.stderr, limit=25, minTime=0.001):
+        """
+        @param out      the stream to write the report to
+        @param limit    the maximum number of imports to list
+        @param minTime  do not list imports taking less than this many
+                          seconds in total
+        """
+        self.out = out
+        self.limit = limit
+        self.minTime = minTime
+        self.start = time.time()
+        # module name -> [inclusive time, self time]
+        self.times = {}
+        self.lazy = set()
+        self._stack = []
+        self._import = __builtin__.__import__
+
+    def install(self):
+        __builtin__.__import__ = self._timedImport
+        atexit.register(self.write)
+
+    def _timedImport(self, name, *args, **kw):
+        known = len(sys.modules)
+        self._stack.append(0.0)
+        t0 = time.time()
+        try:
+            return self._import(name, *args, **kw)
+        finally:
+            elapsed = time.time() - t0
+            children = self._stack.pop()
+            if self._stack:
+                self._stack[-1] += elapsed
+            if len(sys.modules) > known:
+                entry = self.times.setdefault(name, [0.0, 0.0])
+                entry[0] += elapsed
+                entry[1] += elapsed - children
+
+    def write(self):
+        total = time.time() - self.start
+        names = [n for n in self.times.keys()
+                   if self.times[n][0] >= self.minTime]
+        names.sort(lambda a, b: cmp(self.times[b][1], self.times[a][1]))
+        print >> self.out, "Import times (process ran %.3f s):" % total
+        print >> self.out, "%10s %10s  %s" % ("self", "inclusive", "module")
+        for name in names[:self.limit]:
+            lazy = ""
+            if name in self.lazy:
+                lazy = "  (lazy)"
+            print >> self.out, "%10.4f %10.4f  %s%s" % \
+                  (self.times[name][1], self.times[name][0], name, lazy)
+
+_report = None
+if os.environ.get("MOSPIPE_IMPORT_REPORT"):
+    _report = ImportReport()
+    _report.install()
@@ -0,0 +1,224 @@
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+"""
+An in-process stand-in for the ActiveMQ event broker.
+
+This module provides EventTransmitter and EventReceiver classes with the
+same constructor signatures and the same publish/receive/matchingReceive
+methods as those in lsst.ctrl.events, so that code written against that
+module can be exercised without a live broker:
+
+    import lsst.ctrl.mospipe.LocalEventBroker as events
+    trx = events.EventTransmitter("localhost", "LSSTLogging")
+    rcvr = events.EventReceiver("localhost", "LSSTLogging")
+
+Each receiver gets its own copy of every event published to its topic
+after the receiver was created, just as a topic subscriber would with the
+real broker.  Events are passed by reference; they are typically
+PropertySet instances but any object that supports get() and exists() will
+do.  All timeouts are in milliseconds, as with lsst.ctrl.events.
+"""
+
+import threading, time
+from collections import deque
+
+class LocalEventBroker(object):
+    """
+    a registry of topics and the receivers subscribed to them.  A single
+    default instance is shared by all transmitters and receivers created
+    for a given broker host name.
+    """
+
+    _brokers = {}
+    _brokersLock = threading.Lock()
+
+    def __init__(self, host="localhost"):
+        self.host = host
+        self._subscribers = {}
+        self._lock = threading.Lock()
+        self.published = 0
+
+    def getBroker(cls, host="localhost"):
+        """
+        return the broker registered for the given host name, creating
+        it if necessary.
+        """
+        cls._brokersLock.acquire()
+        try:
+            if not cls._brokers.has_key(host):
+                cls._brokers[host] = cls(host)
+            return cls._brokers[host]
+        finally:
+            cls._brokersLock.release()
+    getBroker = classmethod(getBroker)
+
+    def reset(cls):
+        """
+        forget all registered brokers (and thus all subscriptions)
+        """
+        cls._brokersLock.acquire()
+        try:
+            cls._brokers = {}
+        finally:
+            cls._brokersLock.release()
+    reset = classmethod(reset)
+
+    def subscribe(self, topic, mailbox):
+        self._lock.acquire()
+        try:
+            self._subscribers.setdefault(topic, []).append(mailbox)
+        finally:
+            self._lock.release()
+
+    def unsubscribe(self, topic, mailbox):
+        self._lock.acquire()
+        try:
+            boxes = self._subscribers.get(topic, [])
+            if mailbox in boxes:
+                boxes.remove(mailbox)
+        finally:
+            self._lock.release()
+
+    def publish(self, topic, event):
+        """
+        deliver an event to all receivers currently subscribed to topic
+        @return int   the number of receivers the event was delivered to
+        """
+        self._lock.acquire()
+        try:
+            boxes = list(self._subscribers.get(topic, []))
+            self.published += 1
+        finally:
+            self._lock.release()
+
+        for box in boxes:
+            box.put(event)
+        return len(boxes)
+
+class _Mailbox(object):
+    """
+    a thread-safe FIFO of events awaiting receipt by one receiver
+    """
+    def __init__(self):
+        self._events = deque()
+        self._cond = threading.Condition()
+
+    def put(self, event):
+        self._cond.acquire()
+        try:
+            self._events.append(event)
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def get(self, timeout=None, match=None):
+        """
+        return the next event, waiting up to timeout milliseconds for
+        one to arrive.  If timeout is None, wait indefinitely.  If match
+        is given, return the first event for which match(event) is true;
+        the other events stay in the mailbox, in order.
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout / 1000.0
+
+        self._cond.acquire()
+        try:
+            # events before this index have already been rejected by match
+            checked = 0
+            while True:
+                if match is None:
+                    if self._events:
+                        return self._events.popleft()
+                else:
+                    while checked < len(self._events):
+                        event = self._events[checked]
+                        if match(event):
+                            del self._events[checked]
+                            return event
+                        checked += 1
+                if deadline is None:
+                    self._cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return None
+                    self._cond.wait(remaining)
+        finally:
+            self._cond.release()
+
+    def __len__(self):
+        return len(self._events)
+
+class EventTransmitter(object):
+    """
+    publish events to a topic on the local broker
+    """
+    def __init__(self, hostName, topicName):
+        self._broker = LocalEventBroker.getBroker(hostName)
+        self._topic = topicName
+
+    def getTopicName(self):
+        return self._topic
+
+    def publish(self, event):
+        self._broker.publish(self._topic, event)
+
+class EventReceiver(object):
+    """
+    receive events published to a topic on the local broker
+    """
+    def __init__(self, hostName, topicName):
+        self._broker = LocalEventBroker.getBroker(hostName)
+        self._topic = topicName
+        self._mailbox = _Mailbox()
+        self._broker.subscribe(topicName, self._mailbox)
+
+    def getTopicName(self):
+        return self._topic
+
+    def receive(self, timeout=None):
+        """
+        return the next event, or None if none arrives within timeout
+        milliseconds.  A timeout of 0 returns immediately; a timeout of
+        None waits indefinitely.
+        """
+        return self._mailbox.get(timeout)
+
+    def matchingReceive(self, name, value, timeout=None):
+        """
+        return the next event whose property name has the given value;
+        events that do not match are kept for later calls to receive().
+        """
+        def match(event):
+            return event.exists(name) and event.get(name) == value
+        return self._mailbox.get(timeout, match)
+
+    def pending(self):
+        """
+        return the number of events waiting to be received
+        """
+        return len(self._mailbox)
+
+    def close(self):
+        self._broker.unsubscribe(self._topic, self._mailbox)
@@ -0,0 +1,421 @@
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+"""
+A time-partitioned, compressed, columnar archive of log messages.
+
+An archive is a directory holding one subdirectory per time partition
+(one hour by default).  Each partition holds immutable segment files, each
+written by a single flush of a LogArchiveWriter, along with an index.json
+file that summarizes every segment in the partition (time range, record
+count and the distinct run, slice, host and log names it contains) so that
+queries can skip segments without opening them.
+
+A segment stores each column as a separate zlib-compressed JSON array.  The
+low-cardinality string columns are dictionary-encoded:  the column holds
+integer codes and the segment header holds the code table, so a query on
+one of these columns only needs to decompress that column's codes.
+
+Records are plain dictionaries with the keys listed in COLUMNS; PROPS holds
+any additional scalar properties of the original log event (e.g. the
+timings reported by instrumented stages).
+"""
+
+import os, time, calendar, struct, zlib
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from lsst.ctrl.mospipe.LogMatchers import NameMatcher, PrefixMatcher
+
+COLUMNS = ("ts", "runId", "pipeline", "sliceId", "stageId", "hostId",
+           "LOG", "LEVEL", "COMMENT", "PROPS")
+DICT_COLUMNS = ("runId", "pipeline", "hostId", "LOG")
+INDEXED_COLUMNS = ("runId", "sliceId", "hostId", "LOG")
+
+MAGIC = "MOSLOG1\n"
+ARCHIVE_CONFIG = "archive.json"
+PARTITION_INDEX = "index.json"
+PARTITION_FORMAT = "%Y%m%dT%H%M%S"
+
+_standardProps = set(["TIMESTAMP", "DATE", "runId", "pipeline", "sliceId",
+                      "stageId", "hostId", "LOG", "LEVEL", "COMMENT"])
+
+def _getProp(event, name, default):
+    if event.exists(name):
+        try:
+            return event.get(name)
+        except Exception:
+            pass
+    return default
+
+def recordFromEvent(event, receiptTime=None):
+    """
+    convert a log message event into an archive record
+    @param event        the event received on the logging topic
+    @param receiptTime  the time the event was received; used as the
+                          record time if the event carries no TIMESTAMP.
+    """
+    ts = receiptTime
+    if ts is None:
+        ts = time.time()
+    if event.exists("TIMESTAMP"):
+        stamp = event.get("TIMESTAMP")
+        if hasattr(stamp, "nsecs"):
+            stamp = stamp.nsecs()
+        ts = stamp / 1.0e9
+
+    comment = []
+    if event.exists("COMMENT"):
+        comment = list(event.getArrayString("COMMENT"))
+
+    props = {}
+    try:
+        names = event.names()
+    except Exception:
+        names = []
+    for name in names:
+        if name in _standardProps:
+            continue
+        value = _getProp(event, name, None)
+        if isinstance(value, (int, long, float, str, bool)):
+            props[name] = value
+
+    return { "ts":       ts,
+             "runId":    str(_getProp(event, "runId", "")),
+             "pipeline": str(_getProp(event, "pipeline", "")),
+             "sliceId":  _getProp(event, "sliceId", -1),
+             "stageId":  _getProp(event, "stageId", -1),
+             "hostId":   str(_getProp(event, "hostId", "")),
+             "LOG":      str(_getProp(event, "LOG", "")),
+             "LEVEL":    _getProp(event, "LEVEL", 0),
+             "COMMENT":  comment,
+             "PROPS":    props }
+
+def _partitionOf(ts, partitionSecs):
+    start = int(ts // partitionSecs) * partitionSecs
+    return start, time.strftime(PARTITION_FORMAT, time.gmtime(start))
+
+def _writeJson(path, data):
+    tmp = "%s.tmp%d" % (path, os.getpid())
+    fd = open(tmp, "w")
+    try:
+        json.dump(data, fd)
+    finally:
+        fd.close()
+    os.rename(tmp, path)
+
+def _readJson(path, default=None):
+    if not os.path.exists(path):
+        return default
+    fd = open(path)
+    try:
+        return json.load(fd)
+    finally:
+        fd.close()
+
+class LogArchiveWriter(object):
+    """
+    buffer log records and write them into an archive as segments
+    """
+
+    def __init__(self, rootdir, partitionSecs=3600, maxRecords=5000,
+                 maxAge=10.0):
+        """
+        @param rootdir        the archive directory (created if necessary)
+        @param partitionSecs  the time span of each partition in seconds.
+                                An existing archive keeps the span it was
+                                created with.
+        @param maxRecords     flush once this many records are buffered
+        @param maxAge         flush once the oldest buffered record was
+                                added this many seconds ago
+        """
+        self.rootdir = rootdir
+        if not os.path.isdir(rootdir):
+            os.makedirs(rootdir)
+        config = _readJson(os.path.join(rootdir, ARCHIVE_CONFIG))
+        if config is None:
+            config = { "partitionSecs": partitionSecs }
+            _writeJson(os.path.join(rootdir, ARCHIVE_CONFIG), config)
+        self.partitionSecs = config["partitionSecs"]
+        self.maxRecords = maxRecords
+        self.maxAge = maxAge
+        self._buffer = []
+        self._since = None
+        self._seq = 0
+        self.written = 0
+
+    def add(self, record):
+        """
+        add a record, flushing the buffer if it is full or old enough
+        """
+        if not self._buffer:
+            self._since = time.time()
+        self._buffer.append(record)
+        if len(self._buffer) >= self.maxRecords:
+            self.flush()
+
+    def flushIfDue(self):
+        """
+        flush the buffer if its oldest record has been waiting too long
+        """
+        if self._buffer and time.time() - self._since >= self.maxAge:
+            self.flush()
+
+    def flush(self):
+        """
+        write all buffered records, one segment per partition spanned
+        """
+        if not self._buffer:
+            return
+        byPartition = {}
+        for rec in self._buffer:
+            part = _partitionOf(rec["ts"], self.partitionSecs)[1]
+            byPartition.setdefault(part, []).append(rec)
+        for part, records in byPartition.items():
+            self._writeSegment(part, records)
+        self.written += len(self._buffer)
+        self._buffer = []
+        self._since = None
+
+    def close(self):
+        self.flush()
+
+    def _writeSegment(self, part, records):
+        records.sort(lambda a, b: cmp(a["ts"], b["ts"]))
+        partdir = os.path.join(self.rootdir, part)
+        if not os.path.isdir(partdir):
+            os.makedirs(partdir)
+
+        self._seq += 1
+        segname = "seg-%.6f-%d-%d.mlc" % (records[0]["ts"], os.getpid(),
+                                           self._seq)
+
+        header = { "nrec": len(records), "columns": {}, "dicts": {} }
+        blocks = []
+        offset = 0
+        for col in COLUMNS:
+            values = [rec.get(col) for rec in records]
+            if col in DICT_COLUMNS:
+                codes = {}
+                table = []
+                encoded = []
+                for v in values:
+                    if not codes.has_key(v):
+                        codes[v] = len(table)
+                        table.append(v)
+                    encoded.append(codes[v])
+                header["dicts"][col] = table
+                values = encoded
+            block = zlib.compress(json.dumps(values), 6)
+            header["columns"][col] = [offset, len(block)]
+            blocks.append(block)
+            offset += len(block)
+
+        hdrdata = json.dumps(header)
+        path = os.path.join(partdir, segname)
+        tmp = path + ".tmp"
+        fd = open(tmp, "wb")
+        try:
+            fd.write(MAGIC)
+            fd.write(struct.pack(">I", len(hdrdata)))
+            fd.write(hdrdata)
+            for block in blocks:
+                fd.write(block)
+        finally:
+            fd.close()
+        os.rename(tmp, path)
+
+        summary = { "file": segname, "nrec": len(records),
+                    "tsmin": records[0]["ts"], "tsmax": records[-1]["ts"],
+                    "minLevel": min([r["LEVEL"] for r in records]),
+                    "maxLevel": max([r["LEVEL"] for r in records]) }
+        for col in INDEXED_COLUMNS:
+            summary[col] = sorted(set([r[col] for r in records]))
+
+        indexfile = os.path.join(partdir, PARTITION_INDEX)
+        index = _readJson(indexfile, [])
+        index.append(summary)
+        _writeJson(indexfile, index)
+
+class _Segment(object):
+    """
+    lazy access to the columns of one segment file
+    """
+    def __init__(self, path):
+        self.path = path
+        self._fd = open(path, "rb")
+        if self._fd.read(len(MAGIC)) != MAGIC:
+            self._fd.close()
+            raise IOError("%s: not a log archive segment" % path)
+        hdrlen = struct.unpack(">I", self._fd.read(4))[0]
+        self.header = json.loads(self._fd.read(hdrlen))
+        self._base = len(MAGIC) + 4 + hdrlen
+        self._cache = {}
+
+    def codes(self, col):
+        """
+        return the raw (possibly dictionary-encoded) values of a column
+        """
+        if not self._cache.has_key(col):
+            offset, length = self.header["columns"][col]
+            self._fd.seek(self._base + offset)
+            self._cache[col] = json.loads(zlib.decompress(
+                self._fd.read(length)))
+        return self._cache[col]
+
+    def column(self, col):
+        values = self.codes(col)
+        if self.header["dicts"].has_key(col):
+            table = self.header["dicts"][col]
+            values = [table[c] for c in values]
+        return values
+
+    def close(self):
+        self._fd.close()
+
+class LogArchiveReader(object):
+    """
+    query records from a log archive
+    """
+
+    def __init__(self, rootdir):
+        self.rootdir = rootdir
+        config = _readJson(os.path.join(rootdir, ARCHIVE_CONFIG))
+        if config is None:
+            raise IOError("%s: not a log archive" % rootdir)
+        self.partitionSecs = config["partitionSecs"]
+        self.segmentsRead = 0
+
+    def partitions(self, since=None, until=None):
+        """
+        return the partition directory names overlapping a time range
+        """
+        out = []
+        for name in sorted(os.listdir(self.rootdir)):
+            path = os.path.join(self.rootdir, name)
+            if not os.path.isdir(path):
+                continue
+            try:
+                start = calendar.timegm(time.strptime(name, PARTITION_FORMAT))
+            except ValueError:
+                continue
+            if until is not None and start > until:
+                continue
+            if since is not None and start + self.partitionSecs < since:
+                continue
+            out.append(name)
+        return out
+
+    def query(self, runId=None, sliceId=None, hosts=None, minLevel=None,
+              maxLevel=None, lognames=None, since=None, until=None):
+        """
+        return an iterator over the records matching all the given
+        criteria, in time order within each segment.
+        @param runId     restrict to this run
+        @param sliceId   restrict to this slice
+        @param hosts     restrict to hosts beginning with one of these
+        @param minLevel  restrict to this importance level or higher
+        @param maxLevel  restrict to this importance level or lower
+        @param lognames  restrict to these log names (see NameMatcher)
+        @param since     restrict to records at or after this time
+        @param until     restrict to records at or before this time
+        """
+        names = NameMatcher(lognames or [])
+        hostmatch = PrefixMatcher(hosts or [])
+
+        def segmentMayMatch(summary):
+            if since is not None and summary["tsmax"] < since:  return False
+            if until is not None and summary["tsmin"] > until:  return False
+            if minLevel is not None and summary["maxLevel"] < minLevel:
+                return False
+            if maxLevel is not None and summary["minLevel"] > maxLevel:
+                return False
+            if runId is not None and runId not in summary["runId"]:
+                return False
+            if sliceId is not None and sliceId not in summary["sliceId"]:
+                return False
+            if hostmatch and \
+               not filter(hostmatch.matches, summary["hostId"]):
+                return False
+            if not names.matchAll and \
+               not filter(names.matches, summary["LOG"]):
+                return False
+            return True
+
+        def allowedCodes(seg, col, accept):
+            return set([i for i, v in enumerate(seg.header["dicts"][col])
+                          if accept(v)])
+
+        for part in self.partitions(since, until):
+            partdir = os.path.join(self.rootdir, part)
+            index = _readJson(os.path.join(partdir, PARTITION_INDEX), [])
+            for summary in index:
+                if not segmentMayMatch(summary):
+                    continue
+                seg = _Segment(os.path.join(partdir, summary["file"]))
+                self.segmentsRead += 1
+                try:
+                    rows = range(seg.header["nrec"])
+                    if runId is not None:
+                        ok = allowedCodes(seg, "runId", lambda v: v == runId)
+                        codes = seg.codes("runId")
+                        rows = [i for i in rows if codes[i] in ok]
+                    if hostmatch and rows:
+                        ok = allowedCodes(seg, "hostId", hostmatch.matches)
+                        codes = seg.codes("hostId")
+                        rows = [i for i in rows if codes[i] in ok]
+                    if not names.matchAll and rows:
+                        ok = allowedCodes(seg, "LOG", names.matches)
+                        codes = seg.codes("LOG")
+                        rows = [i for i in rows if codes[i] in ok]
+                    if sliceId is not None and rows:
+                        vals = seg.codes("sliceId")
+                        rows = [i for i in rows if vals[i] == sliceId]
+                    if (minLevel is not None or maxLevel is not None) \
+                       and rows:
+                        vals = seg.codes("LEVEL")
+                        if minLevel is not None:
+                            rows = [i for i in rows if vals[i] >= minLevel]
+                        if maxLevel is not None:
+                            rows = [i for i in rows if vals[i] <= maxLevel]
+                    if (since is not None or until is not None) and rows:
+                        vals = seg.codes("ts")
+                        if since is not None:
+                            rows = [i for i in rows if vals[i] >= since]
+                        if until is not None:
+                            rows = [i for i in rows if vals[i] <= until]
+                    if not rows:
+                        continue
+
+                    columns = {}
+                    for col in COLUMNS:
+                        columns[col] = seg.column(col)
+                    for i in rows:
+                        rec = {}
+                        for col in COLUMNS:
+                            rec[col] = columns[col][i]
+                        yield rec
+                finally:
+                    seg.close()
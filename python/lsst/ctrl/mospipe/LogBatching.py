@@ -0,0 +1,463 @@
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+"""
+Batching of log message events.
+
+A LogBatcher stands in front of an EventTransmitter on the logging topic
+and coalesces the log events from each slice (runId, pipeline, sliceId,
+hostId) into a single batch event, published when the batch holds
+maxRecords messages, when its oldest message is maxDelay milliseconds old,
+when a FATAL message is added, or when the process exits.  Messages with
+certain log names (by default, the one launchMospipe waits for) are never
+held back.
+
+A batch event has the log name "mospipe.logbatch", the preamble properties
+shared by its messages, and one BATCH_RECORDS string per message holding
+the rest of that message as JSON.  unbatch() turns a batch back into the
+individual message events; wrapping an EventReceiver in an
+UnbatchingReceiver does so transparently, so that tools reading the logging
+topic see the same events whether or not the sender batched them.
+
+The package's own logs (getLog()) send through the pex_logging default log
+unless a BatchedLog has been installed with installDefaultLog(); the
+SliceInfoStage does so in each pipeline process when its policy has a
+logBatching block.
+
+Only these logs, whose names start with "mospipe.", are batched.  The
+harness logs through the EventLog that events.EventLog.createDefaultLog()
+installs, whose destination publishes each record from C++ as it is
+written; batching it would take a batching destination in ctrl_events
+itself, which is beyond this package.  The harness's share of the broker
+traffic is instead kept down by its log thresholds (see LogSampling).
+Tools that read the package's logs (stage timings, metrics, stragglers,
+latencies, archives, watchLogs and showEvents) unpack the batches; those
+that only read harness or startup messages do not need to.
+"""
+
+import time, threading, atexit
+from collections import deque
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+import lsst.daf.base as dafBase
+import lsst.pex.logging as pexLog
+from lsst.ctrl.mospipe.LogArchive import recordFromEvent
+
+BATCH_LOG = "mospipe.logbatch"
+PREAMBLE = ("runId", "pipeline", "sliceId", "hostId")
+UNBATCHED_LOGS = ("harness.pipeline.visit.stage.handleEvents.eventwait",)
+
+def isBatch(event):
+    """
+    return True if the given event is a batch of log messages
+    """
+    return event.exists("LOG") and event.getString("LOG") == BATCH_LOG
+
+def _setProp(event, name, value):
+    if isinstance(value, bool):
+        event.setBool(name, value)
+    elif isinstance(value, (int, long)):
+        if -2**31 <= value < 2**31:
+            event.setInt(name, value)
+        else:
+            event.setLongLong(name, value)
+    elif isinstance(value, float):
+        event.setDouble(name, value)
+    else:
+        event.setString(name, str(value))
+
+def unbatch(event):
+    """
+    return the log message events packed in a batch event as a list of
+    PropertySets; any other event is returned as the sole member of the
+    list.
+    """
+    if not isBatch(event):
+        return [event]
+
+    preamble = []
+    for name in PREAMBLE:
+        if event.exists(name):
+            preamble.append((name, event.get(name)))
+
+    out = []
+    for packed in event.getArrayString("BATCH_RECORDS"):
+        rec = json.loads(packed)
+        msg = dafBase.PropertySet()
+        for name, value in preamble:
+            _setProp(msg, name, value)
+        msg.setString("LOG", str(rec["LOG"]))
+        msg.setInt("LEVEL", rec["LEVEL"])
+        msg.set("TIMESTAMP", dafBase.DateTime(long(rec["ns"])))
+        if rec["stageId"] != -1:
+            _setProp(msg, "stageId", rec["stageId"])
+        comments = rec["COMMENT"]
+        if comments:
+            msg.setString("COMMENT", str(comments[0]))
+            for comment in comments[1:]:
+                msg.addString("COMMENT", str(comment))
+        for name, value in rec["PROPS"].items():
+            if isinstance(value, unicode):
+                value = str(value)
+            _setProp(msg, str(name), value)
+        out.append(msg)
+    return out
+
+class LogBatcher(object):
+    """
+    coalesce log message events per slice before publishing them
+    """
+
+    def __init__(self, transmitter, maxRecords=100, maxDelay=500,
+                 flushLevel=pexLog.Log.FATAL, unbatched=UNBATCHED_LOGS):
+        """
+        @param transmitter  the EventTransmitter for the logging topic
+        @param maxRecords   publish a batch once it holds this many messages
+        @param maxDelay     publish a batch once its oldest message is this
+                              many milliseconds old
+        @param flushLevel   publish a slice's batch immediately upon a
+                              message at this level or higher
+        @param unbatched    log names whose messages are published on their
+                              own, after any batch pending for their slice
+        """
+        self.transmitter = transmitter
+        self.maxRecords = maxRecords
+        self.maxDelay = maxDelay / 1000.0
+        self.flushLevel = flushLevel
+        self.unbatched = set(unbatched)
+        self.published = 0
+        self.received = 0
+        # preamble tuple -> [time of oldest message, list of packed records]
+        self._batches = {}
+        # events ready to publish, in order; the transmitter is only called
+        # outside _cond, by one thread at a time (holding _sendLock)
+        self._outgoing = deque()
+        self._cond = threading.Condition()
+        self._sendLock = threading.Lock()
+        self._closed = False
+
+        self._flusher = threading.Thread(target=self._flushAged,
+                                         name="logbatch-flusher")
+        self._flusher.setDaemon(True)
+        self._flusher.start()
+        atexit.register(self.close)
+
+    def publish(self, event):
+        """
+        add a log message event to its slice's batch
+        """
+        rec = recordFromEvent(event)
+        key = tuple([rec[name] for name in PREAMBLE])
+
+        self._cond.acquire()
+        try:
+            self.received += 1
+            if self._closed or rec["LOG"] in self.unbatched:
+                self._queue(key)
+                self._outgoing.append(event)
+            else:
+                packed = json.dumps({ "ns": long(round(rec["ts"] * 1.0e9)),
+                                      "stageId": rec["stageId"],
+                                      "LOG": rec["LOG"],
+                                      "LEVEL": rec["LEVEL"],
+                                      "COMMENT": rec["COMMENT"],
+                                      "PROPS": rec["PROPS"] },
+                                    separators=(",", ":"))
+                if not self._batches.has_key(key):
+                    self._batches[key] = [time.time(), []]
+                    self._cond.notify()
+                batch = self._batches[key][1]
+                batch.append(packed)
+                if len(batch) >= self.maxRecords or \
+                   rec["LEVEL"] >= self.flushLevel:
+                    self._queue(key)
+        finally:
+            self._cond.release()
+        self._drain()
+
+    def _queue(self, key):
+        # the caller holds _cond
+        if not self._batches.has_key(key):
+            return
+        since, batch = self._batches.pop(key)
+        event = dafBase.PropertySet()
+        for name, value in zip(PREAMBLE, key):
+            if value != "":
+                _setProp(event, name, value)
+        event.setString("LOG", BATCH_LOG)
+        event.setInt("LEVEL", pexLog.Log.INFO)
+        event.setInt("BATCH_COUNT", len(batch))
+        event.setString("BATCH_RECORDS", batch[0])
+        for packed in batch[1:]:
+            event.addString("BATCH_RECORDS", packed)
+        self._outgoing.append(event)
+
+    def _drain(self):
+        """
+        publish the queued events in order
+        """
+        self._sendLock.acquire()
+        try:
+            while True:
+                self._cond.acquire()
+                try:
+                    if not self._outgoing:
+                        return
+                    event = self._outgoing.popleft()
+                finally:
+                    self._cond.release()
+                self.transmitter.publish(event)
+                self.published += 1
+        finally:
+            self._sendLock.release()
+
+    def flush(self):
+        """
+        publish all pending batches
+        """
+        self._cond.acquire()
+        try:
+            for key in self._batches.keys():
+                self._queue(key)
+        finally:
+            self._cond.release()
+        self._drain()
+
+    def _flushAged(self):
+        while True:
+            self._cond.acquire()
+            try:
+                if self._closed:
+                    return
+                now = time.time()
+                wait = None
+                for key, (since, batch) in self._batches.items():
+                    due = since + self.maxDelay
+                    if due <= now:
+                        self._queue(key)
+                    elif wait is None or due - now < wait:
+                        wait = due - now
+                if not self._outgoing:
+                    self._cond.wait(wait)
+            finally:
+                self._cond.release()
+            self._drain()
+
+    def close(self):
+        """
+        publish all pending batches and stop batching; later messages are
+        published individually.
+        """
+        self._cond.acquire()
+        try:
+            if self._closed:
+                return
+            self._closed = True
+            for key in self._batches.keys():
+                self._queue(key)
+            self._cond.notify()
+        finally:
+            self._cond.release()
+        self._drain()
+        self._flusher.join(1.0)
+
+class UnbatchingReceiver(object):
+    """
+    a wrapper around an EventReceiver that unpacks batch events, returning
+    their messages one at a time
+    """
+    def __init__(self, receiver):
+        self.receiver = receiver
+        self._pending = deque()
+
+    def getTopicName(self):
+        return self.receiver.getTopicName()
+
+    def receive(self, timeout=None):
+        """
+        return the next event, or None if none arrives within timeout
+        milliseconds.
+        """
+        while not self._pending:
+            event = self.receiver.receive(timeout)
+            if event is None:
+                return None
+            self._pending.extend(unbatch(event))
+        return self._pending.popleft()
+
+    def matchingReceive(self, name, value, timeout=None):
+        """
+        return the next event whose property name has the given value;
+        events that do not match are kept for later calls to receive().
+        """
+        if timeout is not None:
+            deadline = time.time() + timeout / 1000.0
+        skipped = []
+        try:
+            while True:
+                wait = timeout
+                if timeout is not None:
+                    wait = max(0, int(1000 * (deadline - time.time())))
+                event = self.receive(wait)
+                if event is None:
+                    return None
+                if event.exists(name) and event.get(name) == value:
+                    return event
+                skipped.append(event)
+        finally:
+            skipped.reverse()
+            self._pending.extendleft(skipped)
+
+class BatchedLog(object):
+    """
+    a minimal stand-in for an EventLog that sends its messages through a
+    LogBatcher
+    """
+    def __init__(self, batcher, name="", preamble=None,
+                 threshold=pexLog.Log.INFO):
+        """
+        @param batcher    the LogBatcher (or SamplingTransmitter) to send
+                            messages through
+        @param name       the log name
+        @param preamble   a dictionary of properties attached to every
+                            message (runId, sliceId, ...)
+        @param threshold  the minimum level of messages to send
+        """
+        self.batcher = batcher
+        self.name = name
+        self.preamble = dict(preamble or {})
+        self.threshold = threshold
+
+    def getThreshold(self):
+        return self.threshold
+
+    def setThreshold(self, threshold):
+        self.threshold = threshold
+
+    def sends(self, level):
+        return level >= self.threshold
+
+    def child(self, name):
+        """
+        return a log for the named child of this log
+        """
+        if self.name:
+            name = "%s.%s" % (self.name, name)
+        return BatchedLog(self.batcher, name, self.preamble, self.threshold)
+
+    def log(self, level, message, props=None):
+        if not self.sends(level):
+            return
+        event = dafBase.PropertySet()
+        for name, value in self.preamble.items():
+            _setProp(event, name, value)
+        event.setString("LOG", self.name)
+        event.setInt("LEVEL", level)
+        event.set("TIMESTAMP", dafBase.DateTime(long(time.time() * 1.0e9)))
+        event.setString("COMMENT", message)
+        if props is not None:
+            for name in props.names():
+                event.set(name, props.get(name))
+        self.batcher.publish(event)
+
+def createDefaultLog(runId, sliceId, broker, topic="LSSTLogging",
+                     maxRecords=100, maxDelay=500, pipeline=None,
+                     threshold=pexLog.Log.INFO, sampling=None):
+    """
+    return a BatchedLog publishing to the given broker and topic with the
+    same preamble properties EventLog.createDefaultLog() attaches
+    @param sampling   if not None, a log sampling policy (see
+                         pipeline/logSampling.paf) selecting the messages
+                         to send
+    """
+    import socket
+    import lsst.ctrl.events as events
+
+    preamble = { "runId": runId, "sliceId": sliceId,
+                 "hostId": socket.gethostname() }
+    if pipeline is not None:
+        preamble["pipeline"] = pipeline
+    batcher = LogBatcher(events.EventTransmitter(broker, topic), maxRecords,
+                         maxDelay)
+    if sampling is not None:
+        from lsst.ctrl.mospipe.LogSampling import \
+             samplingTransmitterFromPolicy
+        batcher = samplingTransmitterFromPolicy(batcher, sampling)
+    return BatchedLog(batcher, "", preamble, threshold)
+
+_defaultLog = None
+
+def installDefaultLog(log):
+    """
+    send the messages of this package's logs (see getLog()) through the
+    given BatchedLog from now on; None reverts to the pex_logging default
+    log
+    """
+    global _defaultLog
+    _defaultLog = log
+
+def getLog(name):
+    """
+    return the log of the given name for this package's own messages
+    """
+    return PackageLog(name)
+
+class PackageLog(object):
+    """
+    a log that sends through the BatchedLog installed with
+    installDefaultLog(), or through the pex_logging default log until one
+    is installed
+    """
+    DEBUG = pexLog.Log.DEBUG
+    INFO = pexLog.Log.INFO
+    WARN = pexLog.Log.WARN
+    FATAL = pexLog.Log.FATAL
+
+    def __init__(self, name):
+        self.name = name
+        self._pexLog = None
+        self._batched = None
+
+    def _target(self):
+        if _defaultLog is not None:
+            if self._batched is None or \
+               self._batched.batcher is not _defaultLog.batcher:
+                self._batched = _defaultLog.child(self.name)
+            return self._batched
+        if self._pexLog is None:
+            self._pexLog = pexLog.Log(pexLog.Log.getDefaultLog(), self.name)
+        return self._pexLog
+
+    def sends(self, level):
+        target = self._target()
+        if hasattr(target, "sends"):
+            return target.sends(level)
+        return level >= target.getThreshold()
+
+    def log(self, level, message, props=None):
+        if props is None:
+            self._target().log(level, message)
+        else:
+            self._target().log(level, message, props)
@@ -0,0 +1,120 @@
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+"""
+Precompiled matchers for selecting log messages received as events.
+"""
+
+import re
+
+class PrefixMatcher(object):
+    """
+    match strings that begin with any of a list of prefixes.  The
+    prefixes are compiled once into a single regular expression.
+    """
+
+    def __init__(self, prefixes):
+        """
+        @param prefixes   a list of prefix strings
+        """
+        prefixes = list(prefixes)
+        self._regex = None
+        if prefixes:
+            # longest first so that the alternation fails fast on the
+            # common leading characters
+            prefixes.sort(lambda a, b: cmp(len(b), len(a)))
+            self._regex = re.compile("|".join(map(re.escape, prefixes)))
+
+    def __nonzero__(self):
+        return self._regex is not None
+
+    def matches(self, name):
+        return self._regex is not None and \
+               self._regex.match(name) is not None
+
+class NameMatcher(object):
+    """
+    match log names against a list of names, where a name ending in '*'
+    matches any log name beginning with the string preceding the '*'.  An
+    empty list matches everything.
+    """
+
+    def __init__(self, lognames):
+        """
+        @param lognames   a list of log names and log name patterns
+        """
+        self.matchAll = not lognames
+        self._names = set([x for x in lognames if not x.endswith('*')])
+        self._likenames = PrefixMatcher([x[:-1] for x in lognames
+                                                  if x.endswith('*')])
+
+    def matches(self, name):
+        return self.matchAll or name in self._names or \
+               self._likenames.matches(name)
+
+class LogMessageFilter(object):
+    """
+    select log message events by log name, slice, originating host, and
+    importance level.
+    """
+
+    def __init__(self, lognames=None, sliceid=None, hosts=None,
+                 hostexclude=False, minimport=None, maximport=None):
+        """
+        @param lognames  a list of log names to accept (see NameMatcher);
+                           if empty or None, accept all names
+        @param sliceid   accept only messages from this slice.  If None,
+                           accept all slices.
+        @param hosts     a list of host name prefixes to restrict to
+        @param hostexclude  if True, the hosts are hosts to ignore
+                           messages from
+        @param minimport accept only messages at this importance or higher
+        @param maximport accept only messages at this importance or lower
+        """
+        self.names = NameMatcher(lognames or [])
+        self.sliceid = sliceid
+        self.hosts = PrefixMatcher(hosts or [])
+        self.hostexclude = hostexclude
+        self.minimport = minimport
+        self.maximport = maximport
+
+    def accepts(self, event):
+        """
+        return True if the given log event passes this filter
+        """
+        if not self.names.matchAll and \
+           not self.names.matches(event.getString("LOG", "")):
+            return False
+        if self.sliceid is not None and \
+           event.getInt("sliceId", -2) != self.sliceid:
+            return False
+        if self.hosts:
+            if self.hosts.matches(event.getString("hostId", "")) == \
+               self.hostexclude:
+                return False
+        if self.minimport is not None or self.maximport is not None:
+            level = event.getInt("LEVEL", 0)
+            if self.minimport is not None and level < self.minimport:
+                return False
+            if self.maximport is not None and level > self.maximport:
+                return False
+        return True
@@ -0,0 +1,314 @@
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+"""
+Sampling and rate limiting of log message events by log name.
+
+A LogSampler decides, message by message, whether a log event should be
+sent.  Messages whose names are on the whitelist, and messages at or above
+the pass level (WARN by default), always pass.  Every other message is
+matched against an ordered list of rules, each giving a set of log names
+(exact names or prefixes ending in '*', as with watchLogs), the fraction of
+messages to keep, and a token-bucket rate limit (a sustained rate in
+messages per second and a burst size) applied per log name.  Messages
+matching no rule fall under the default rule.
+
+A SamplingTransmitter applies a sampler in front of an EventTransmitter (or
+a LogBatcher) and periodically sends a "mospipe.logsampling" message
+summarizing how many messages were dropped from each log name.  See
+pipeline/logSampling.paf for the policy format; the SliceInfoStage applies
+it to the mospipe stage logs when its logBatching policy has a sampling
+entry (see LogBatching).
+
+Sampling only applies to the logs this package sends itself.  The harness's
+messages are cut at the source instead, by giving the pex_logging default
+log a threshold per log name (applyLogThresholds()): the pipelines can then
+run at their usual verbosity while the one harness log launchMospipe needs
+at trace level, handleEvents, stays there.  See pipeline/logThresholds.paf.
+"""
+
+import time, random, threading
+
+import lsst.daf.base as dafBase
+import lsst.pex.logging as pexLog
+from lsst.ctrl.mospipe.LazyImport import lazyModule
+from lsst.ctrl.mospipe.LogMatchers import NameMatcher
+from lsst.ctrl.mospipe.LogBatching import PREAMBLE
+
+run = lazyModule("lsst.pex.harness.run")
+
+SUMMARY_LOG = "mospipe.logsampling"
+WHITELIST = ("harness.pipeline.visit.stage.handleEvents.eventwait",)
+
+class SamplingRule(object):
+    """
+    the sampling fraction and rate limit applied to a set of log names
+    """
+    def __init__(self, names=None, sample=1.0, rate=0, burst=None):
+        """
+        @param names   the log names (or '*' prefixes) the rule applies to;
+                         None or empty matches all names
+        @param sample  the fraction of messages to keep
+        @param rate    the sustained messages per second allowed per log
+                         name; 0 means no limit
+        @param burst   the number of messages per log name that may be sent
+                         at once; by default, the rate (at least 1)
+        """
+        self.names = NameMatcher(names or [])
+        self.sample = sample
+        self.rate = rate
+        if burst is None:
+            burst = max(1, rate)
+        self.burst = burst
+
+    def matches(self, logname):
+        return self.names.matches(logname)
+
+    def fromPolicy(cls, policy):
+        """
+        create a rule from a policy with optional names, sample, rate and
+        burst parameters
+        """
+        names = []
+        if policy.exists("names"):
+            names = policy.getStringArray("names")
+        sample, rate, burst = 1.0, 0, None
+        if policy.exists("sample"):
+            sample = policy.get("sample")
+        if policy.exists("rate"):
+            rate = policy.get("rate")
+        if policy.exists("burst"):
+            burst = policy.get("burst")
+        return cls(names, sample, rate, burst)
+    fromPolicy = classmethod(fromPolicy)
+
+class LogSampler(object):
+    """
+    decide which log messages to send
+    """
+
+    def __init__(self, rules=None, default=None, whitelist=WHITELIST,
+                 passLevel=pexLog.Log.WARN):
+        """
+        @param rules      a list of SamplingRules; the first one matching a
+                            message's log name applies
+        @param default    the SamplingRule for messages matching no rule;
+                            by default, everything passes
+        @param whitelist  the log names whose messages always pass
+        @param passLevel  messages at this level or above always pass
+        """
+        self.rules = list(rules or [])
+        if default is None:
+            default = SamplingRule()
+        self.default = default
+        self.whitelist = None
+        if whitelist:
+            self.whitelist = NameMatcher(list(whitelist))
+        self.passLevel = passLevel
+        # log name -> [rule, tokens, time of last refill]
+        self._buckets = {}
+        self.passed = 0
+        self.dropped = {}
+
+    def fromPolicy(cls, policy):
+        """
+        create a sampler from a policy (see pipeline/logSampling.paf)
+        """
+        rules = []
+        if policy.exists("rule"):
+            rules = [SamplingRule.fromPolicy(p)
+                     for p in policy.getArray("rule")]
+        default = None
+        if policy.exists("default"):
+            default = SamplingRule.fromPolicy(policy.getPolicy("default"))
+        whitelist = list(WHITELIST)
+        if policy.exists("whitelist"):
+            whitelist += policy.getStringArray("whitelist")
+        passLevel = pexLog.Log.WARN
+        if policy.exists("passLevel"):
+            passLevel = policy.getInt("passLevel")
+        return cls(rules, default, whitelist, passLevel)
+    fromPolicy = classmethod(fromPolicy)
+
+    def _bucket(self, logname, now):
+        bucket = self._buckets.get(logname)
+        if bucket is None:
+            rule = self.default
+            for r in self.rules:
+                if r.matches(logname):
+                    rule = r
+                    break
+            bucket = [rule, rule.burst, now]
+            self._buckets[logname] = bucket
+        return bucket
+
+    def accepts(self, logname, level, now=None):
+        """
+        return True if a message to the given log at the given level should
+        be sent, counting it as dropped otherwise.
+        """
+        if level >= self.passLevel or \
+           (self.whitelist and self.whitelist.matches(logname)):
+            self.passed += 1
+            return True
+        if now is None:
+            now = time.time()
+
+        rule, tokens, last = bucket = self._bucket(logname, now)
+        keep = rule.sample >= 1.0 or random.random() < rule.sample
+        if keep and rule.rate > 0:
+            tokens = min(rule.burst, tokens + (now - last) * rule.rate)
+            bucket[2] = now
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                keep = False
+            bucket[1] = tokens
+
+        if keep:
+            self.passed += 1
+        else:
+            self.dropped[logname] = self.dropped.get(logname, 0) + 1
+        return keep
+
+    def takeDropped(self):
+        """
+        return the counts of dropped messages per log name since the last
+        call and reset them
+        """
+        out = self.dropped
+        self.dropped = {}
+        return out
+
+class SamplingTransmitter(object):
+    """
+    a stand-in for the EventTransmitter on the logging topic that only
+    publishes the log events a LogSampler accepts, and periodically
+    publishes a summary of those it dropped
+    """
+
+    def __init__(self, transmitter, sampler, summaryInterval=60):
+        """
+        @param transmitter      the EventTransmitter (or LogBatcher) to
+                                  publish through
+        @param sampler          the LogSampler deciding what to send
+        @param summaryInterval  the minimum seconds between summaries
+        """
+        self.transmitter = transmitter
+        self.sampler = sampler
+        self.summaryInterval = summaryInterval
+        self._lastSummary = time.time()
+        self._preamble = []
+        self._lock = threading.Lock()
+
+    def publish(self, event):
+        logname = event.getString("LOG", "")
+        level = event.getInt("LEVEL", 0)
+        self._lock.acquire()
+        try:
+            if not self._preamble:
+                self._preamble = [(name, event.get(name)) for name in PREAMBLE
+                                                          if event.exists(name)]
+            now = time.time()
+            keep = self.sampler.accepts(logname, level, now)
+            if now - self._lastSummary >= self.summaryInterval:
+                self._summarize(now)
+        finally:
+            self._lock.release()
+        if keep:
+            self.transmitter.publish(event)
+
+    def _summarize(self, now):
+        # the caller holds the lock
+        dropped = self.sampler.takeDropped()
+        self._lastSummary = now
+        if not dropped:
+            return
+        names = dropped.keys()
+        names.sort()
+        event = dafBase.PropertySet()
+        for name, value in self._preamble:
+            event.set(name, value)
+        event.setString("LOG", SUMMARY_LOG)
+        event.setInt("LEVEL", pexLog.Log.INFO)
+        event.set("TIMESTAMP", dafBase.DateTime(long(now * 1.0e9)))
+        event.setInt("dropped", sum(dropped.values()))
+        event.setString("COMMENT", "%s: %d messages dropped" %
+                        (names[0], dropped[names[0]]))
+        for name in names[1:]:
+            event.addString("COMMENT", "%s: %d messages dropped" %
+                            (name, dropped[name]))
+        self.transmitter.publish(event)
+
+    def flush(self):
+        """
+        publish a summary of any dropped messages, then flush the
+        underlying transmitter if it supports it
+        """
+        self._lock.acquire()
+        try:
+            self._summarize(time.time())
+        finally:
+            self._lock.release()
+        if hasattr(self.transmitter, "flush"):
+            self.transmitter.flush()
+
+def samplingTransmitterFromPolicy(transmitter, policy):
+    """
+    return a SamplingTransmitter configured from a sampling policy (see
+    pipeline/logSampling.paf)
+    """
+    interval = 60
+    if policy.exists("summaryInterval"):
+        interval = policy.getInt("summaryInterval")
+    return SamplingTransmitter(transmitter, LogSampler.fromPolicy(policy),
+                               interval)
+
+def logThresholdsFromPolicy(policy):
+    """
+    return the (log name, threshold) pairs of a log thresholds policy (see
+    pipeline/logThresholds.paf), in policy order.  A level may be given as
+    a threshold or as a verbosity name accepted by the harness's -L option
+    (e.g. "trace").
+    """
+    out = []
+    if policy is None or not policy.exists("threshold"):
+        return out
+    for entry in policy.getPolicyArray("threshold"):
+        level = entry.get("level")
+        if isinstance(level, str):
+            level = run.verbosity2threshold(level)
+        out.append((entry.getString("log"), int(level)))
+    return out
+
+def applyLogThresholds(policy, log=None):
+    """
+    set the threshold of each log named in a log thresholds policy (see
+    pipeline/logThresholds.paf)
+    @param policy  the log thresholds policy
+    @param log     the root log the names are relative to; by default, the
+                     pex_logging default log
+    """
+    if log is None:
+        log = pexLog.Log.getDefaultLog()
+    for name, threshold in logThresholdsFromPolicy(policy):
+        log.setThresholdFor(name, threshold)
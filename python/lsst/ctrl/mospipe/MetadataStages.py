@@ -31,9 +31,12 @@ import lsst.pex.logging as pexLog
 import lsst.utils as lsstutils
 
 from lsst.pex.harness.Stage import Stage
+from lsst.ctrl.mospipe.StageTiming import timed
+from lsst.ctrl.mospipe.LogBatching import getLog
+from lsst.ctrl.mospipe.CalibrationStore import CALIBRATION_IDS
 
 propertySetTypeInfos = {}
-logger = pexLog.Log(pexLog.Log.getDefaultLog(), "mospipe.MetadataStages.py")
+logger = getLog("mospipe.MetadataStages.py")
 
 def setTypeInfos():
     global propertySetTypeInfos
@@ -154,6 +157,7 @@ class ValidateMetadataStage(Stage):
     with a survey-specific policy file specifying this mapping.
     """
 
+    @timed
     def process(self):
         clipboard = self.inputQueue.getNextDataset()
         metadataPolicy = self._policy.getPolicy("metadata")
@@ -171,6 +175,7 @@ class TransformMetadataStage(Stage):
     represents the location of LSST metadata in the particular data
     set."""
 
+    @timed
     def process(self):
         clipboard = self.inputQueue.getNextDataset()
         metadataPolicy = self._policy.getPolicy("metadata")
@@ -231,6 +236,7 @@ class TransformExposureMetadataStage(Stage):
     string in the datatypePolicy named metadataKeyword that represents the
     location of LSST metadata in the particular data set."""
 
+    @timed
     def process(self):
         clipboard = self.inputQueue.getNextDataset()
         metadataPolicy = self._policy.getPolicy("metadata")
@@ -255,8 +261,17 @@ class TransformExposureMetadataStage(Stage):
 class TransformCalibrationImageStage(Stage):
 
     """This stage takes a list of input DecoratedImages and transforms them into Exposures
-    for use by ISR. """
+    for use by ISR.  An Exposure is reused for as long as the same image
+    comes in (see CalibrationStore); as ISR may change it in place, each
+    visit gets a deep copy of it and of its metadata.  The calibration id
+    of each image (see CalibrationStore) is passed on for its Exposure. """
 
+    def __init__(self, stageId=-1, stagePolicy=None):
+        Stage.__init__(self, stageId, stagePolicy)
+        # image key -> (DecoratedImage, Exposure made from it)
+        self.exposures = {}
+
+    @timed
     def process(self):
         clipboard = self.inputQueue.getNextDataset()
         metadataPolicy = self._policy.getPolicy("metadata")
@@ -268,17 +283,28 @@ class TransformCalibrationImageStage(Stage):
         else:
             suffix = "Keyword"
 
+        ids = clipboard.get(CALIBRATION_IDS)
         for imageKey in imageKeys:
             exposureKey = re.sub(r'Image','Exposure', imageKey)
+            if ids is not None and ids.has_key(imageKey):
+                ids[exposureKey] = ids[imageKey]
             dImage = clipboard.get(imageKey)
-            mask = afwImage.MaskU(dImage.getDimensions())
-            mask.set(0)
-            var = afwImage.ImageF(dImage.getDimensions())
-            var.set(0)
-            maskedImage = afwImage.makeMaskedImage(dImage.getImage(), mask, var)
-            metadata = dImage.getMetadata()
-            exposure = afwImage.makeExposure(maskedImage)
-            exposure.setMetadata(metadata)
+            previous = self.exposures.get(imageKey)
+            if previous is None or previous[0] is not dImage:
+                mask = afwImage.MaskU(dImage.getDimensions())
+                mask.set(0)
+                var = afwImage.ImageF(dImage.getDimensions())
+                var.set(0)
+                maskedImage = afwImage.makeMaskedImage(dImage.getImage(), mask, var)
+                exposure = afwImage.makeExposure(maskedImage)
+                exposure.setMetadata(dImage.getMetadata())
+                previous = (dImage, exposure)
+                self.exposures[imageKey] = previous
+            # ISR gets a copy; the cached Exposure shares its pixels with
+            # the cached image
+            exposure = afwImage.makeExposure(
+                afwImage.MaskedImageF(previous[1].getMaskedImage(), True))
+            exposure.setMetadata(previous[1].getMetadata().deepCopy())
             clipboard.put(exposureKey, exposure)
-            
+
         self.outputQueue.addDataset(clipboard)
@@ -0,0 +1,352 @@
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+"""
+Aggregation of pipeline events into metrics in the Prometheus text
+exposition format.
+
+PipelineMetrics consumes events from the logging topic and any other
+topics (typically the visit trigger topic) and keeps:
+
+  mospipe_events_total, mospipe_event_rate         events per topic
+  mospipe_visits_triggered_total                   trigger events seen
+  mospipe_visits_completed_total                   visits through the
+                                                     last stage
+  mospipe_visits_per_minute                        recent completion rate
+  mospipe_stage_duration_seconds                   stage call wall times
+  mospipe_stage_failures_total                     failed stage calls
+  mospipe_db_write_seconds                         wall times of the stages
+                                                     that write to the
+                                                     database (dbWrite)
+  mospipe_pipeline_ready                           1 once a pipeline waits
+                                                     for its first event
+
+Rates and quantiles are computed over a rolling window made of a fixed
+number of buckets, so memory use does not grow with time or traffic.
+"""
+
+import time, threading
+
+from lsst.ctrl.mospipe.StageTiming import TIMING_LOG, TimingHistogram, \
+                                          timingFromRecord
+from lsst.ctrl.mospipe.LogArchive import recordFromEvent
+
+READY_LOG = "harness.pipeline.visit.stage.handleEvents.eventwait"
+QUANTILES = (0.5, 0.95, 0.99)
+
+class RollingWindow(object):
+    """
+    a ring of time buckets covering the most recent window seconds
+    """
+    def __init__(self, factory, window=300, step=10):
+        """
+        @param factory  a callable returning a new, empty bucket
+        @param window   the time span covered, in seconds
+        @param step     the time span of each bucket
+        """
+        self.factory = factory
+        self.step = step
+        self.nbuckets = max(1, int(window // step))
+        self.window = self.nbuckets * step
+        # each entry is [bucket number, bucket]
+        self.ring = [[None, None] for i in xrange(self.nbuckets)]
+
+    def bucket(self, now):
+        """
+        return the bucket for the given time, emptying it if stale
+        """
+        number = int(now // self.step)
+        entry = self.ring[number % self.nbuckets]
+        if entry[0] != number:
+            entry[0] = number
+            entry[1] = self.factory()
+        return entry[1]
+
+    def buckets(self, now):
+        """
+        return the buckets that fall within the window ending now
+        """
+        number = int(now // self.step)
+        return [b for n, b in self.ring
+                  if n is not None and number - self.nbuckets < n <= number]
+
+class RollingCounter(object):
+    """
+    a monotonic count plus its rate over a rolling window
+    """
+    def __init__(self, window=300, step=10):
+        self.total = 0
+        self.recent = RollingWindow(lambda: [0], window, step)
+
+    def add(self, now, count=1):
+        self.total += count
+        self.recent.bucket(now)[0] += count
+
+    def rate(self, now):
+        """
+        return the rate in counts per second over the window
+        """
+        return sum([b[0] for b in self.recent.buckets(now)]) / \
+               float(self.recent.window)
+
+class RollingHistogram(object):
+    """
+    cumulative count and sum of a duration plus a histogram of its
+    recent values
+    """
+    def __init__(self, window=300, step=10):
+        self.count = 0
+        self.total = 0.0
+        self.recent = RollingWindow(TimingHistogram, window, step)
+
+    def add(self, now, value):
+        self.count += 1
+        self.total += value
+        self.recent.bucket(now).add(value)
+
+    def merged(self, now):
+        """
+        return a TimingHistogram of the values within the window
+        """
+        out = TimingHistogram()
+        for hist in self.recent.buckets(now):
+            if not hist.count:
+                continue
+            for b, n in hist.bins.items():
+                out.bins[b] = out.bins.get(b, 0) + n
+            out.count += hist.count
+            out.total += hist.total
+            if out.min is None or hist.min < out.min:
+                out.min = hist.min
+            if out.max is None or hist.max > out.max:
+                out.max = hist.max
+        return out
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"") \
+                     .replace("\n", "\\n")
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join(['%s="%s"' % (k, _escape(v)) for k, v in labels])
+
+class PipelineMetrics(object):
+    """
+    metrics aggregated from pipeline log and trigger events.  add() and
+    render() may be called from different threads.
+    """
+
+    def __init__(self, triggerTopic="triggerImageprocEvent", lastStage=None,
+                 window=300, step=10, maxExposures=1000):
+        """
+        @param triggerTopic  the visit trigger event topic
+        @param lastStage     the stageIndex of the last pipeline stage; a
+                               visit is complete when the master finishes
+                               its postprocess().  If None, a visit is
+                               counted when its first stage timing arrives.
+        @param window        the span of the rolling windows in seconds
+        @param step          the span of each window bucket in seconds
+        @param maxExposures  the number of recent exposureIds remembered to
+                               avoid counting a visit twice
+        """
+        self.triggerTopic = triggerTopic
+        self.lastStage = lastStage
+        self.window = window
+        self.step = step
+        self.maxExposures = maxExposures
+        self._lock = threading.Lock()
+
+        self.events = {}
+        self.lastEvent = {}
+        self.triggered = RollingCounter(window, step)
+        self.completed = RollingCounter(window, step)
+        self.seenExposures = set()
+        self.exposureOrder = []
+        self.stageDurations = {}
+        self.stageFailures = {}
+        self.dbWrites = {}
+        # (pipeline, runId) -> time ready, or None
+        self.ready = {}
+
+    def add(self, topic, receiptTime, event):
+        """
+        account for an event
+        @param topic        the topic the event arrived on
+        @param receiptTime  when it arrived
+        @param event        the event's PropertySet
+        """
+        self._lock.acquire()
+        try:
+            self._add(topic, receiptTime, event)
+        finally:
+            self._lock.release()
+
+    def _add(self, topic, now, event):
+        if not self.events.has_key(topic):
+            self.events[topic] = RollingCounter(self.window, self.step)
+        self.events[topic].add(now)
+        self.lastEvent[topic] = now
+
+        if topic == self.triggerTopic:
+            self.triggered.add(now)
+            return
+        if not event.exists("LOG"):
+            return
+
+        rec = recordFromEvent(event, now)
+        pipeline = rec.get("pipeline")
+        if pipeline:
+            key = (pipeline, rec.get("runId") or "")
+            if not self.ready.has_key(key):
+                self.ready[key] = None
+            if rec["LOG"] == READY_LOG and self.ready[key] is None and \
+               event.exists("STATUS") and event.getString("STATUS") == "start":
+                self.ready[key] = now
+
+        if rec["LOG"] == TIMING_LOG:
+            timing = timingFromRecord(rec)
+            if timing is not None:
+                self._addTiming(timing, now)
+
+    def _addTiming(self, timing, now):
+        key = (timing.get("stage", ""), timing.get("stageIndex", -1),
+               timing.get("method", ""))
+        if not self.stageDurations.has_key(key):
+            self.stageDurations[key] = RollingHistogram(self.window, self.step)
+            self.stageFailures[key] = 0
+        self.stageDurations[key].add(now, timing["wallTime"])
+        if timing.get("status", "ok") != "ok":
+            self.stageFailures[key] += 1
+
+        if timing.get("dbWrite"):
+            if not self.dbWrites.has_key(key):
+                self.dbWrites[key] = RollingHistogram(self.window, self.step)
+            self.dbWrites[key].add(now, timing["wallTime"])
+
+        expid = timing.get("exposureId")
+        if expid is None or expid in self.seenExposures:
+            return
+        if self.lastStage is None or \
+           (key[1] == self.lastStage and key[2] == "postprocess"):
+            self.seenExposures.add(expid)
+            self.exposureOrder.append(expid)
+            if len(self.exposureOrder) > self.maxExposures:
+                self.seenExposures.discard(self.exposureOrder.pop(0))
+            self.completed.add(now)
+
+    def render(self, now=None):
+        """
+        return the metrics in the Prometheus text exposition format
+        """
+        if now is None:
+            now = time.time()
+        self._lock.acquire()
+        try:
+            lines = []
+            self._render(lines, now)
+        finally:
+            self._lock.release()
+        return "\n".join(lines) + "\n"
+
+    def _header(self, lines, name, mtype, help):
+        lines.append("# HELP %s %s" % (name, help))
+        lines.append("# TYPE %s %s" % (name, mtype))
+
+    def _summary(self, lines, name, labels, hist, now):
+        recent = hist.merged(now)
+        for q in QUANTILES:
+            lines.append("%s%s %g" % (name, _labels(labels +
+                                                    [("quantile", q)]),
+                                      recent.quantile(q)))
+        lines.append("%s_sum%s %g" % (name, _labels(labels), hist.total))
+        lines.append("%s_count%s %d" % (name, _labels(labels), hist.count))
+
+    def _render(self, lines, now):
+        topics = self.events.keys()
+        topics.sort()
+        self._header(lines, "mospipe_events_total", "counter",
+                     "Events received per topic.")
+        for topic in topics:
+            lines.append("mospipe_events_total%s %d" %
+                         (_labels([("topic", topic)]),
+                          self.events[topic].total))
+        self._header(lines, "mospipe_event_rate", "gauge",
+                     "Events per second per topic over the last %d s." %
+                     self.window)
+        for topic in topics:
+            lines.append("mospipe_event_rate%s %g" %
+                         (_labels([("topic", topic)]),
+                          self.events[topic].rate(now)))
+        self._header(lines, "mospipe_last_event_timestamp_seconds", "gauge",
+                     "When the last event arrived per topic.")
+        for topic in topics:
+            lines.append("mospipe_last_event_timestamp_seconds%s %.3f" %
+                         (_labels([("topic", topic)]), self.lastEvent[topic]))
+
+        self._header(lines, "mospipe_visits_triggered_total", "counter",
+                     "Visit trigger events received.")
+        lines.append("mospipe_visits_triggered_total %d" %
+                     self.triggered.total)
+        self._header(lines, "mospipe_visits_completed_total", "counter",
+                     "Exposures that finished the pipeline.")
+        lines.append("mospipe_visits_completed_total %d" %
+                     self.completed.total)
+        self._header(lines, "mospipe_visits_per_minute", "gauge",
+                     "Exposures completed per minute over the last %d s." %
+                     self.window)
+        lines.append("mospipe_visits_per_minute %g" %
+                     (60 * self.completed.rate(now)))
+
+        keys = self.stageDurations.keys()
+        keys.sort(lambda a, b: cmp((a[1], a[0], a[2]), (b[1], b[0], b[2])))
+        self._header(lines, "mospipe_stage_duration_seconds", "summary",
+                     "Wall time of stage calls; quantiles over the last %d s."
+                     % self.window)
+        for key in keys:
+            labels = [("stage", key[0]), ("index", key[1]), ("method", key[2])]
+            self._summary(lines, "mospipe_stage_duration_seconds", labels,
+                          self.stageDurations[key], now)
+        self._header(lines, "mospipe_stage_failures_total", "counter",
+                     "Stage calls that raised an exception.")
+        for key in keys:
+            labels = [("stage", key[0]), ("index", key[1]), ("method", key[2])]
+            lines.append("mospipe_stage_failures_total%s %d" %
+                         (_labels(labels), self.stageFailures[key]))
+
+        keys = self.dbWrites.keys()
+        keys.sort(lambda a, b: cmp((a[1], a[0], a[2]), (b[1], b[0], b[2])))
+        self._header(lines, "mospipe_db_write_seconds", "summary",
+                     "Wall time of database-writing stage calls; quantiles over the last %d s." % self.window)
+        for key in keys:
+            labels = [("stage", key[0]), ("index", key[1]), ("method", key[2])]
+            self._summary(lines, "mospipe_db_write_seconds", labels,
+                          self.dbWrites[key], now)
+
+        pipelines = self.ready.keys()
+        pipelines.sort()
+        self._header(lines, "mospipe_pipeline_ready", "gauge",
+                     "1 once the pipeline is waiting for its first event.")
+        for key in pipelines:
+            lines.append("mospipe_pipeline_ready%s %d" %
+                         (_labels([("pipeline", key[0]), ("runId", key[1])]),
+                          self.ready[key] is not None))
@@ -0,0 +1,251 @@
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+
+"""
+A cache of fully resolved policy files.
+
+A production policy such as IP.paf includes dozens of other policy files
+(written "@IP/01-sliceInfo_policy.paf"), each of which must be found,
+opened and parsed every time a tool loads it.  loadPolicy() instead writes
+the fully resolved policy, with all includes expanded, to a single
+snapshot file and reloads that on later calls.
+
+Each snapshot is accompanied by a manifest listing every file that went
+into it with its modification time, size and SHA-1.  A snapshot is used
+only if every file still has the same contents:  files whose mtime and
+size are unchanged are trusted without being read, and the others are
+rehashed.  Any change (or a new file appearing where an include used to be
+missing) makes loadPolicy() parse the policy again and replace the
+snapshot.
+
+Snapshots are kept in $MOSPIPE_POLICY_CACHE, or ~/.mospipe/policycache
+if that is not set; if it is set to an empty string, no caching is done.
+"""
+
+import os, re, tempfile
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+import lsst.pex.policy as pexPolicy
+
+_include = re.compile(r":\s*@(\S+)")
+
+def defaultCacheDir():
+    """
+    return the directory to keep snapshots in, or None if caching is
+    turned off
+    """
+    dir = os.environ.get("MOSPIPE_POLICY_CACHE")
+    if dir is None:
+        dir = os.path.join(os.path.expanduser("~"), ".mospipe", "policycache")
+    return dir or None
+
+def _hashFile(filename):
+    digest = sha1()
+    f = open(filename, "rb")
+    try:
+        data = f.read(65536)
+        while data:
+            digest.update(data)
+            data = f.read(65536)
+    finally:
+        f.close()
+    return digest.hexdigest()
+
+def _fileEntry(filename):
+    """
+    return [filename, mtime, size, sha1] for a file; the last three are
+    None if it does not exist.
+    """
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return [filename, None, None, None]
+    return [filename, st.st_mtime, st.st_size, _hashFile(filename)]
+
+def includedFiles(filename, repos=None):
+    """
+    return the absolute names of the given policy file and of all the
+    files it includes, directly or indirectly.
+    @param filename   the policy file
+    @param repos      the directory relative include names are resolved
+                        against; if None, the policy file's directory
+    """
+    if repos is None:
+        repos = os.path.dirname(os.path.abspath(filename))
+    out = []
+    seen = set()
+    todo = [os.path.abspath(filename)]
+    while todo:
+        name = todo.pop(0)
+        if name in seen:
+            continue
+        seen.add(name)
+        out.append(name)
+        if not os.path.exists(name):
+            continue
+        for line in open(name):
+            line = line.split("#", 1)[0]
+            for inc in _include.findall(line):
+                inc = inc.strip("\"'")
+                if not os.path.isabs(inc):
+                    inc = os.path.join(repos, inc)
+                todo.append(os.path.abspath(inc))
+    return out
+
+class PolicyCache(object):
+    """
+    a directory of resolved policy snapshots
+    """
+
+    def __init__(self, cacheDir=None):
+        """
+        @param cacheDir   the directory to keep snapshots in; by default,
+                            the one given by defaultCacheDir()
+        """
+        if cacheDir is None:
+            cacheDir = defaultCacheDir()
+        self.cacheDir = cacheDir
+        self.hits = 0
+        self.misses = 0
+
+    def _paths(self, filename, repos):
+        key = "%s\0%s" % (os.path.abspath(filename),
+                          repos and os.path.abspath(repos) or "")
+        base = os.path.join(self.cacheDir, sha1(key).hexdigest())
+        return base + ".paf", base + ".manifest"
+
+    def _valid(self, manifest):
+        """
+        return True if all the files in the manifest are unchanged,
+        updating the recorded mtimes of files that were touched but not
+        modified.
+        """
+        for entry in manifest:
+            try:
+                st = os.stat(entry[0])
+            except OSError:
+                if entry[1] is not None:
+                    return False
+                continue
+            if entry[1] is None:
+                return False
+            if st.st_mtime == entry[1] and st.st_size == entry[2]:
+                continue
+            if st.st_size != entry[2] or _hashFile(entry[0]) != entry[3]:
+                return False
+            entry[1] = st.st_mtime
+        return True
+
+    def _write(self, filename, writer):
+        # write to a temporary file and move it into place, so that
+        # readers never see a partial file
+        fd, tmp = tempfile.mkstemp(dir=self.cacheDir)
+        os.close(fd)
+        try:
+            writer(tmp)
+            os.rename(tmp, filename)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def _writeManifest(self, filename, manifest):
+        def write(tmp):
+            f = open(tmp, "w")
+            try:
+                json.dump(manifest, f)
+            finally:
+                f.close()
+        self._write(filename, write)
+
+    def _writeSnapshot(self, filename, policy):
+        def write(tmp):
+            writer = pexPolicy.PAFWriter(tmp)
+            writer.write(policy, True)
+            writer.close()
+        self._write(filename, write)
+
+    def load(self, filename, repos=None):
+        """
+        return the Policy in the given file with all of its includes
+        loaded, from the cache if possible
+        @param filename   the policy file
+        @param repos      the policy repository directory that includes
+                            are resolved against
+        """
+        if self.cacheDir is None:
+            return self._parse(filename, repos)
+
+        snapshot, manifestFile = self._paths(filename, repos)
+        if os.path.exists(snapshot) and os.path.exists(manifestFile):
+            try:
+                manifest = json.load(open(manifestFile))
+                before = [e[1] for e in manifest]
+                if self._valid(manifest):
+                    policy = pexPolicy.Policy.createPolicy(snapshot, False)
+                    self.hits += 1
+                    if [e[1] for e in manifest] != before:
+                        self._writeManifest(manifestFile, manifest)
+                    return policy
+            except (ValueError, IndexError, EnvironmentError):
+                pass
+
+        self.misses += 1
+        manifest = [_fileEntry(f) for f in includedFiles(filename, repos)]
+        policy = self._parse(filename, repos)
+        try:
+            if not os.path.isdir(self.cacheDir):
+                os.makedirs(self.cacheDir)
+            self._writeSnapshot(snapshot, policy)
+            self._writeManifest(manifestFile, manifest)
+        except EnvironmentError:
+            # the cache is an optimization; carry on without it
+            pass
+        return policy
+
+    def _parse(self, filename, repos):
+        if repos is None:
+            repos = os.path.dirname(os.path.abspath(filename))
+        return pexPolicy.Policy.createPolicy(filename, repos)
+
+_cache = None
+
+def loadPolicy(filename, repos=None):
+    """
+    return the Policy in the given file with all of its includes loaded,
+    using the default PolicyCache
+    @param filename   the policy file
+    @param repos      the policy repository directory that includes are
+                        resolved against; if None, the policy file's
+                        directory
+    """
+    global _cache
+    if _cache is None:
+        _cache = PolicyCache()
+    return _cache.load(filename, repos)
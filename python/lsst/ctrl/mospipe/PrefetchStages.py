@@ -0,0 +1,490 @@
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+
+"""
+Prefetching of the input files of upcoming visits.
+
+The trigger event for a visit is published while the pipeline is still
+busy with earlier visits, but an InputStage only starts reading once the
+harness hands it that event.  PrefetchInputStage is an InputStage that
+also runs an InputPrefetcher:  a background thread subscribed to the
+trigger topic that, as soon as a trigger event is published, reads the
+FITS data that the stage (and any other PrefetchInputStage in the same
+slice) will need for that visit.  The prefetcher subscribes when the
+stage is initialized, before the first trigger event can be published,
+and starts reading once the stage's first visit has told it the slice's
+ccdId, ampId and hduId.  When the stage gets to a visit, it waits for
+that visit's prefetch to finish (if it is still running) and then reads
+its items as usual, now from memory.
+
+The prefetcher reads the raw bytes of the primary header and of the HDU
+that each FitsStorage item of the stage policy refers to, so that they
+are in the operating system's page cache; decoding them in the thread
+would hold the interpreter lock and stall the stages doing the actual
+work.  The thread waits for trigger events in a blocking receive with a
+timeout (receiveTimeout), so that it starts on a visit as soon as its
+event is published.  At most maxAhead visits are prefetched ahead of
+the one being processed, so the memory used is bounded.  After every
+visit, the stage logs whether its inputs were prefetched in time, with
+the running counts of hits and misses, to the "mospipe.InputPrefetcher"
+log.
+
+When the stage policy has a "staging" policy (that of a StagingCacheStage,
+see StagingCache), the stage first stages the files of its visit into the
+node-local cache and links them into the input directory, and the
+prefetcher does the same for each upcoming visit, from its trigger event,
+before reading its inputs.  A file that cannot be staged or read is
+reported as a prefetch failure; the stage itself then fails to read it.
+
+The stage policy is that of an InputStage with an optional "prefetch"
+policy:
+
+    prefetch: {
+       maxAhead:       2    # visits to read ahead of the current one
+       waitTimeout:    60   # seconds to wait for an unfinished prefetch
+       receiveTimeout: 1.0  # seconds each receive of a trigger event
+                            #   blocks
+       eventBrokerHost: ... # default: the pipeline's event broker
+    }
+
+The topic listened to is given as "triggerTopic" in the prefetch policy
+(triggerImageprocEvent by default).
+
+A CalibrationInputStage with a prefetch policy shares the slice's
+prefetcher (see CalibrationStore):  for each upcoming visit, the
+prefetcher also extracts the calibration HDUs that the visit will need
+into the node's CalibrationStore, where they are usually found already.
+"""
+
+import os, time, threading
+
+from lsst.pex.harness.IOStage import InputStage
+import lsst.pex.logging as pexLog
+from lsst.ctrl.mospipe.StageTiming import timed, exposureIdOf
+from lsst.ctrl.mospipe.FitsUtils import hduExtent, splitLocation, readRange
+from lsst.ctrl.mospipe.LogBatching import getLog
+from lsst.ctrl.mospipe.StageUtils import PushbackQueue
+from lsst.ctrl.mospipe.StagingCache import STAGING_LOG, getCache, \
+     stageFiles, logStats
+
+class PrefetchItem(object):
+    """
+    a FITS input item of an InputStage policy
+    """
+    def __init__(self, key, location, additionalData):
+        """
+        @param key             the clipboard key of the item
+        @param location        the location template, e.g.
+                                 "%(input)/raw/obj%(exposureId).fits#%(hduId)"
+        @param additionalData  the "name=source" strings giving the values
+                                 substituted into the template
+        """
+        self.key = key
+        self.location = location
+        self.additionalData = additionalData
+
+def prefetchItems(policy):
+    """
+    return the PrefetchItems of the FitsStorage InputItems of an
+    InputStage policy
+    """
+    additional = []
+    if policy.exists("AdditionalData"):
+        additional = policy.getStringArray("AdditionalData")
+    out = []
+    if not policy.exists("InputItems"):
+        return out
+    items = policy.getPolicy("InputItems")
+    for key in items.names(True):
+        item = items.getPolicy(key)
+        if not item.exists("StoragePolicy"):
+            continue
+        storage = item.getPolicy("StoragePolicy")
+        if storage.getString("Storage") != "FitsStorage":
+            continue
+        out.append(PrefetchItem(key, storage.getString("Location"),
+                                additional))
+    return out
+
+class _Prefetch(object):
+    """
+    the state of the prefetch for one visit
+    """
+    def __init__(self, exposureId):
+        self.exposureId = exposureId
+        self.done = False
+        self.bytes = 0
+        self.seconds = 0.0
+        self.errors = []
+
+class InputPrefetcher(object):
+    """
+    a background thread that reads the input files of upcoming visits as
+    their trigger events are published
+    """
+
+    def __init__(self, broker, topic, maxAhead=2, log=None,
+                 receiveTimeout=1.0):
+        """
+        Subscribe to the trigger topic; the thread is only started by
+        start().
+        @param broker          the event broker host
+        @param topic           the trigger event topic
+        @param maxAhead        the maximum number of visits prefetched
+                                 ahead of the one being processed
+        @param receiveTimeout  the seconds each receive blocks waiting for
+                                 a trigger event
+        """
+        import lsst.ctrl.events as events
+        self.broker = broker
+        self.topic = topic
+        self.maxAhead = maxAhead
+        self.receiveTimeout = receiveTimeout
+        self.receiver = events.EventReceiver(broker, topic)
+        if log is None:
+            log = getLog("mospipe.InputPrefetcher")
+        self.log = log
+        self.items = []
+        self.sliceData = {}
+        # nothing is read until the slice data are known
+        self.ready = False
+        # the visit being processed that was not being prefetched, whose
+        # trigger event is not to be prefetched if it is received late
+        self.missed = None
+        # prefetches in order of arrival; the first is the current visit's
+        # once current is set
+        self.prefetches = []
+        self.current = None
+        self.hits = 0
+        self.misses = 0
+        self.staging = None
+        self.cache = None
+        # (CalibrationStore, PrefetchItems) warmed for each visit
+        self.stores = []
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def addItems(self, items):
+        self._cond.acquire()
+        try:
+            known = [(i.key, i.location) for i in self.items]
+            for item in items:
+                if (item.key, item.location) not in known:
+                    self.items.append(item)
+        finally:
+            self._cond.release()
+
+    def setSliceData(self, data):
+        """
+        set the per-slice values (ccdId, ampId, hduId, ...) used in the
+        item locations
+        """
+        self._cond.acquire()
+        try:
+            self.sliceData.update(data)
+            if not self.ready:
+                self.ready = True
+                self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
+    def setStaging(self, policy):
+        """
+        stage the files of each upcoming visit, as given by a staging
+        policy, before reading its inputs
+        """
+        self._cond.acquire()
+        try:
+            if self.staging is None:
+                self.staging = policy
+                self.cache = getCache(policy)
+        finally:
+            self._cond.release()
+
+    def addStore(self, store, items):
+        """
+        extract the calibration HDUs of the given items into a
+        CalibrationStore for each upcoming visit
+        """
+        self._cond.acquire()
+        try:
+            self.stores.append((store, items))
+        finally:
+            self._cond.release()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run,
+                                        name="input-prefetch")
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def _ahead(self):
+        return len([p for p in self.prefetches if p is not self.current])
+
+    def _run(self):
+        timeout = int(1000 * self.receiveTimeout)
+        while True:
+            self._cond.acquire()
+            try:
+                while not self.ready or self._ahead() >= self.maxAhead:
+                    self._cond.wait()
+            finally:
+                self._cond.release()
+
+            event = self.receiver.receive(timeout)
+            if event is None or not event.exists("exposureId"):
+                continue
+            prefetch = _Prefetch(event.get("exposureId"))
+            self._cond.acquire()
+            try:
+                if prefetch.exposureId == self.missed:
+                    # the stage is already reading it
+                    continue
+                self.prefetches.append(prefetch)
+                items = list(self.items)
+                sliceData = dict(self.sliceData)
+                staging = self.staging
+                stores = list(self.stores)
+            finally:
+                self._cond.release()
+
+            start = time.time()
+            if staging is not None:
+                # the event is all the clipboard the AdditionalData need
+                try:
+                    stageFiles(self.cache, staging, {self.topic: event})
+                except Exception, e:
+                    prefetch.errors.append("staging: %s" % e)
+            for item in items:
+                try:
+                    prefetch.bytes += self._read(item, event, sliceData)
+                except Exception, e:
+                    prefetch.errors.append("%s: %s" % (item.key, e))
+            for store, calibItems in stores:
+                for item in calibItems:
+                    try:
+                        filename, hdu = splitLocation(
+                            self._location(item, event, sliceData))
+                        store.warm(filename, hdu)
+                    except Exception, e:
+                        prefetch.errors.append("%s: %s" % (item.key, e))
+            prefetch.seconds = time.time() - start
+
+            self._cond.acquire()
+            try:
+                prefetch.done = True
+                self._cond.notifyAll()
+            finally:
+                self._cond.release()
+            self.log.log(pexLog.Log.DEBUG,
+                         "prefetched %d bytes for exposure %s in %.2f s" %
+                         (prefetch.bytes, prefetch.exposureId,
+                          prefetch.seconds))
+            for error in prefetch.errors:
+                self.log.log(pexLog.Log.WARN, "prefetch failed for %s" % error)
+
+    def _location(self, item, event, sliceData):
+        import lsst.daf.base as dafBase
+        import lsst.daf.persistence as dafPersist
+        additionalData = dafBase.PropertySet()
+        for spec in item.additionalData:
+            name, source = [s.strip() for s in spec.split("=", 1)]
+            if "." in source:
+                source = source.split(".", 1)[1]
+                if event.exists(source):
+                    additionalData.set(name, event.get(source))
+            elif sliceData.has_key(source):
+                additionalData.set(name, sliceData[source])
+        return dafPersist.LogicalLocation(item.location,
+                                          additionalData).locString()
+
+    def _read(self, item, event, sliceData):
+        filename, hdu = splitLocation(self._location(item, event, sliceData))
+        if hdu is None:
+            return readRange(filename, 0, os.path.getsize(filename))
+        extent = hduExtent(filename, hdu)
+        primary = hduExtent(filename, 1)
+        done = readRange(filename, 0, primary.size())
+        if extent.hdu != 1:
+            done += readRange(filename, extent.offset, extent.size())
+        return done
+
+    def _setCurrent(self, exposureId):
+        # the caller holds the lock
+        prefetch = None
+        for i, p in enumerate(self.prefetches):
+            if p.exposureId == exposureId:
+                # anything that arrived before is of no more use
+                del self.prefetches[:i]
+                prefetch = p
+                break
+        if prefetch is None:
+            self.current = None
+            self.missed = exposureId
+        elif prefetch is not self.current:
+            self.current = prefetch
+            self._cond.notifyAll()
+        return prefetch
+
+    def visit(self, exposureId):
+        """
+        mark the given visit as the one being processed, without waiting
+        for its prefetch or counting it as a hit or a miss
+        """
+        self._cond.acquire()
+        try:
+            self._setCurrent(exposureId)
+        finally:
+            self._cond.release()
+
+    def wait(self, exposureId, timeout=60):
+        """
+        mark the given visit as the one being processed and wait until its
+        prefetch, if any, is done
+        @return True if the visit's inputs were prefetched
+        """
+        deadline = time.time() + timeout
+        self._cond.acquire()
+        try:
+            prefetch = self._setCurrent(exposureId)
+            if prefetch is None:
+                self.misses += 1
+                return False
+            while not prefetch.done and time.time() < deadline:
+                self._cond.wait(max(0.01, deadline - time.time()))
+            if prefetch.done and prefetch.bytes and not prefetch.errors:
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+        finally:
+            self._cond.release()
+
+    def report(self, exposureId, hit):
+        """
+        log whether the given visit's inputs were prefetched, along with
+        the hits and misses so far
+        """
+        import lsst.daf.base as dafBase
+        props = dafBase.PropertySet()
+        props.setInt("hits", self.hits)
+        props.setInt("misses", self.misses)
+        if exposureId is not None:
+            props.setLongLong("exposureId", long(exposureId))
+        outcome = "miss"
+        if hit:
+            outcome = "hit"
+        self.log.log(pexLog.Log.INFO,
+                     "prefetch %s for exposure %s: %d hits, %d misses" %
+                     (outcome, exposureId, self.hits, self.misses), props)
+
+_prefetchers = {}
+
+def getPrefetcher(broker, topic, maxAhead=2, receiveTimeout=1.0):
+    """
+    return this process's InputPrefetcher for the given broker and topic
+    """
+    key = (broker, topic)
+    if not _prefetchers.has_key(key):
+        _prefetchers[key] = InputPrefetcher(broker, topic, maxAhead,
+                                            receiveTimeout=receiveTimeout)
+    return _prefetchers[key]
+
+class PrefetchInputStage(InputStage):
+    '''An InputStage whose FITS inputs for upcoming visits are read ahead
+    in a background thread.'''
+
+    def __init__(self, stageId=-1, stagePolicy=None):
+        InputStage.__init__(self, stageId, stagePolicy)
+        self.prefetchPolicy = None
+        if stagePolicy is not None and stagePolicy.exists("prefetch"):
+            self.prefetchPolicy = stagePolicy.getPolicy("prefetch")
+        self.stagingPolicy = None
+        if stagePolicy is not None and stagePolicy.exists("staging"):
+            self.stagingPolicy = stagePolicy.getPolicy("staging")
+        self.items = []
+        if stagePolicy is not None:
+            self.items = prefetchItems(stagePolicy)
+        self.prefetcher = None
+        self.cache = None
+        self.stagingLog = None
+
+    def _param(self, name, default):
+        if self.prefetchPolicy is not None and \
+           self.prefetchPolicy.exists(name):
+            return self.prefetchPolicy.get(name)
+        return default
+
+    def initialize(self, outQueue, inQueue):
+        InputStage.initialize(self, outQueue, inQueue)
+        # subscribe before the first trigger event can be published
+        broker = self._param("eventBrokerHost", None)
+        if broker is None:
+            # set by the harness through setEventBrokerHost()
+            broker = getattr(self, "_evbroker", None)
+        topic = self._param("triggerTopic", "triggerImageprocEvent")
+        self.prefetcher = getPrefetcher(broker, topic,
+                                        self._param("maxAhead", 2),
+                                        self._param("receiveTimeout", 1.0))
+        self.prefetcher.addItems(self.items)
+        if self.stagingPolicy is not None:
+            self.prefetcher.setStaging(self.stagingPolicy)
+        self.prefetcher.start()
+
+    def _setSliceData(self, clipboard):
+        sliceData = {}
+        for key in ("ccdId", "ampId", "hduId"):
+            if clipboard.get(key) is not None:
+                sliceData[key] = clipboard.get(key)
+        self.prefetcher.setSliceData(sliceData)
+
+    def _stage(self, clipboard):
+        if self.cache is None:
+            self.cache = getCache(self.stagingPolicy)
+            self.stagingLog = getLog(STAGING_LOG)
+        # hits unless the prefetcher could not stage the files in time
+        staged = stageFiles(self.cache, self.stagingPolicy, clipboard)
+        self.cache.evict(staged)
+        logStats(self.stagingLog, self.cache, staged)
+
+    @timed
+    def process(self):
+        clipboard = self.inputQueue.getNextDataset()
+        if not self.prefetcher.ready:
+            # the first visit lets the prefetcher start reading
+            self._setSliceData(clipboard)
+        exposureId = exposureIdOf(clipboard)
+        hit = self.prefetcher.wait(exposureId,
+                                   self._param("waitTimeout", 60))
+        self.prefetcher.report(exposureId, hit)
+        if self.stagingPolicy is not None:
+            self._stage(clipboard)
+
+        queue = self.inputQueue
+        self.inputQueue = PushbackQueue(queue, clipboard)
+        try:
+            InputStage.process(self)
+        finally:
+            self.inputQueue = queue
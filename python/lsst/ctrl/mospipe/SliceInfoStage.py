@@ -26,27 +26,109 @@
 from lsst.pex.harness.Stage import Stage
 from lsst.pex.policy import Policy
 import lsst.afw.image as afwImage
+import lsst.pex.logging as pexLog
+from lsst.ctrl.mospipe.StageTiming import timed
+from lsst.ctrl.mospipe.Startup import getReporter
+from lsst.ctrl.mospipe.LogBatching import createDefaultLog, \
+     installDefaultLog
+from lsst.ctrl.mospipe.LogSampling import applyLogThresholds
 
 class SliceInfoStage(Stage):
-    '''Compute per-slice information.'''
+    '''Compute per-slice information.
+
+    As the first stage of the pipeline, this stage also reports the startup
+    phases of its process (see Startup), applies the per-log thresholds
+    of its logThresholds policy (see LogSampling) and, if its policy has a
+    logBatching block, sends the messages of the mospipe stages to the
+    event broker in batches (see LogBatching).'''
 
     def __init__(self, stageId=-1, stagePolicy=None):
         Stage.__init__(self, stageId, stagePolicy)
+        # before the harness starts its event loop, so that its eventwait
+        # message gets out
+        if stagePolicy is not None and stagePolicy.exists("logThresholds"):
+            applyLogThresholds(stagePolicy.getPolicy("logThresholds"))
+        reporter = getReporter()
+        reporter.phase("policyLoaded")
+        interval = 5.0
+        if stagePolicy is not None and stagePolicy.exists("heartbeatInterval"):
+            interval = stagePolicy.get("heartbeatInterval")
+        reporter.startHeartbeat(interval)
+
+    def setRank(self, rank):
+        Stage.setRank(self, rank)
+        getReporter().phase("mpiUp")
+
+    def setRun(self, run):
+        if hasattr(Stage, "setRun"):
+            Stage.setRun(self, run)
+        self.runId = run
+
+    def setEventBrokerHost(self, host):
+        if hasattr(Stage, "setEventBrokerHost"):
+            Stage.setEventBrokerHost(self, host)
+        self.brokerHost = host
+
+    def initialize(self, outQueue, inQueue):
+        Stage.initialize(self, outQueue, inQueue)
+        self._installLog()
+
+    def _installLog(self):
+        """
+        send the mospipe logs through a LogBatcher, as configured by the
+        logBatching policy
+        """
+        if self._policy is None or not self._policy.exists("logBatching"):
+            return
+        policy = self._policy.getPolicy("logBatching")
+        broker = getattr(self, "brokerHost", None)
+        if not broker:
+            pexLog.Log(pexLog.Log.getDefaultLog(), "mospipe.SliceInfoStage") \
+                .log(pexLog.Log.WARN, "no event broker; not batching logs")
+            return
+        maxRecords, maxDelay, pipeline, sampling = 100, 500, None, None
+        if policy.exists("maxRecords"):
+            maxRecords = policy.getInt("maxRecords")
+        if policy.exists("maxDelay"):
+            maxDelay = policy.getInt("maxDelay")
+        if policy.exists("pipeline"):
+            pipeline = policy.getString("pipeline")
+        if policy.exists("sampling"):
+            sampling = policy.getPolicy("sampling")
+        threshold = pexLog.Log.getDefaultLog().getThreshold()
+        installDefaultLog(createDefaultLog(getattr(self, "runId", ""),
+                                           self.getRank(), broker,
+                                           maxRecords=maxRecords,
+                                           maxDelay=maxDelay,
+                                           pipeline=pipeline,
+                                           threshold=threshold,
+                                           sampling=sampling))
 
+    @timed
     def preprocess(self): 
+        # the harness only starts the stage loop once every stage has been
+        # constructed and initialized
+        getReporter().phase("stagesConstructed")
         self.activeClipboard = self.inputQueue.getNextDataset()
         self._impl(self.activeClipboard)
         # Let postprocess() put self.activeClipboard on the output queue
 
+    @timed
     def process(self): 
         """
         Compute the ampId and ccdId corresponding to this slice.
         """
+        getReporter().phase("stagesConstructed")
         clipboard = self.inputQueue.getNextDataset()
         self._impl(clipboard)
         self.outputQueue.addDataset(clipboard)
 
     def _impl(self, clipboard):
+        # with reportOnly (e.g. when an AmpWorkQueueStage assigns the
+        # amplifiers), this stage only reports the startup phases
+        if self._policy.exists("reportOnly") and \
+           self._policy.getBool("reportOnly"):
+            return
         sliceId = self.getRank()
 
         nAmps = self._policy.get("nAmps")
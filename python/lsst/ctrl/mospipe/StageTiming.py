@@ -0,0 +1,339 @@
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+"""
+Per-stage, per-slice timing of pipeline stages.
+
+Decorating a Stage's preprocess(), process() or postprocess() method with
+timed() makes each call send a message to the "mospipe.timing" log with
+the following properties:
+
+    stage         the name of the Stage class
+    method        preprocess, process or postprocess
+    stageIndex    the stage's position in the pipeline
+    startTime     when the call began (seconds since the epoch)
+    endTime       when the call finished
+    wallTime      the elapsed time of the call in seconds
+    cpuTime       the CPU (user + system) time used by the process
+    clipboardIn   the number of items on the clipboard taken as input
+    clipboardOut  the number of items on the clipboard passed on
+    exposureId    the exposure being processed, if it can be determined
+    status        "ok", or "failed" if the call raised an exception
+    dbWrite       true if the stage writes to the database (see
+                    writesDatabase())
+
+When the pipeline log is sent to the event broker, these arrive as log
+events that can be summarized with the bin/stageTimings.py tool.  The
+first call whose clipboard carries a trigger event also reports the
+process's "firstEvent" startup phase (see Startup).
+timedStage() creates a timed subclass of an existing Stage class.
+"""
+
+import os, time, math
+
+import lsst.daf.base as dafBase
+import lsst.pex.logging as pexLog
+from lsst.ctrl.mospipe.LogBatching import getLog
+from lsst.ctrl.mospipe.Startup import getReporter
+
+TIMING_LOG = "mospipe.timing"
+EVENT_KEYS = ("triggerImageprocEvent",)
+
+timingLog = getLog(TIMING_LOG)
+
+class QueueTap(object):
+    """
+    a stand-in for a stage's input or output queue that remembers the
+    clipboards passing through it (and the number of items on each at
+    that moment) while delegating to the real queue.
+    """
+    def __init__(self, queue):
+        self.queue = queue
+        self.clipboards = []
+        self.sizes = []
+
+    def getNextDataset(self):
+        clipboard = self.queue.getNextDataset()
+        self.clipboards.append(clipboard)
+        self.sizes.append(clipboardSize(clipboard))
+        return clipboard
+
+    def addDataset(self, clipboard):
+        self.clipboards.append(clipboard)
+        self.sizes.append(clipboardSize(clipboard))
+        self.queue.addDataset(clipboard)
+
+    def __getattr__(self, name):
+        return getattr(self.queue, name)
+
+def clipboardSize(clipboard):
+    """
+    return the number of items on a clipboard, or -1 if unknown
+    """
+    if clipboard is None:
+        return -1
+    try:
+        return len(clipboard.getKeys())
+    except Exception:
+        return -1
+
+def exposureIdOf(clipboard, eventKeys=EVENT_KEYS):
+    """
+    return the exposureId of the triggering event on a clipboard, or None
+    """
+    if clipboard is None:
+        return None
+    for key in eventKeys:
+        try:
+            event = clipboard.get(key)
+            if event is not None and event.exists("exposureId"):
+                return event.get("exposureId")
+        except Exception:
+            pass
+    return None
+
+def _cpuTime():
+    t = os.times()
+    return t[0] + t[1]
+
+def writesDatabase(stage):
+    """
+    return True if a stage writes to the database:  if one of the
+    OutputItems of its policy has a DbStorage StoragePolicy, or if the
+    stage sets a writesDatabase attribute of its own
+    """
+    if hasattr(stage, "writesDatabase"):
+        return stage.writesDatabase
+    found = False
+    policy = getattr(stage, "_policy", None)
+    if policy is not None and policy.exists("OutputItems"):
+        items = policy.getPolicy("OutputItems")
+        for key in items.names(True):
+            item = items.getPolicy(key)
+            if not item.exists("StoragePolicy"):
+                continue
+            for storage in item.getPolicyArray("StoragePolicy"):
+                if storage.getString("Storage") == "DbStorage":
+                    found = True
+    stage.writesDatabase = found
+    return found
+
+def reportTiming(stage, method, start, wall, cpu, sizeIn, sizeOut,
+                 exposureId, status="ok"):
+    """
+    send a timing message to the timing log
+    """
+    props = dafBase.PropertySet()
+    props.setString("stage", stage.__class__.__name__)
+    props.setString("method", method)
+    props.setInt("stageIndex", getattr(stage, "stageId", -1))
+    props.setDouble("startTime", start)
+    props.setDouble("endTime", start + wall)
+    props.setDouble("wallTime", wall)
+    props.setDouble("cpuTime", cpu)
+    props.setInt("clipboardIn", sizeIn)
+    props.setInt("clipboardOut", sizeOut)
+    if exposureId is not None:
+        props.setLongLong("exposureId", long(exposureId))
+    props.setString("status", status)
+    if writesDatabase(stage):
+        props.setBool("dbWrite", True)
+    timingLog.log(pexLog.Log.INFO, "%s.%s: %.3f s" %
+                  (stage.__class__.__name__, method, wall), props)
+
+def timed(method):
+    """
+    decorate a Stage's preprocess(), process() or postprocess() method so
+    that each call reports its timing to the timing log.
+    """
+    name = method.__name__
+
+    def timedMethod(self):
+        intap = QueueTap(self.inputQueue)
+        outtap = QueueTap(self.outputQueue)
+        self.inputQueue, self.outputQueue = intap, outtap
+        status = "failed"
+        start = time.time()
+        cpu0 = _cpuTime()
+        try:
+            result = method(self)
+            status = "ok"
+            return result
+        finally:
+            wall = time.time() - start
+            cpu = _cpuTime() - cpu0
+            self.inputQueue, self.outputQueue = intap.queue, outtap.queue
+            try:
+                clipIn, clipOut = None, None
+                sizeIn, sizeOut = -1, -1
+                if intap.clipboards:
+                    clipIn, sizeIn = intap.clipboards[0], intap.sizes[0]
+                if outtap.clipboards:
+                    clipOut, sizeOut = outtap.clipboards[-1], outtap.sizes[-1]
+                elif name == "preprocess":
+                    clipOut = getattr(self, "activeClipboard", None)
+                    sizeOut = clipboardSize(clipOut)
+                eventKeys = getattr(self, "timingEventKeys", EVENT_KEYS)
+                exposureId = exposureIdOf(clipOut or clipIn, eventKeys)
+                if exposureId is not None:
+                    getReporter().phase("firstEvent", start)
+                reportTiming(self, name, start, wall, cpu, sizeIn, sizeOut,
+                             exposureId, status)
+            except Exception, e:
+                timingLog.log(pexLog.Log.WARN,
+                              "failed to report timing: %s" % e)
+
+    timedMethod.__name__ = name
+    timedMethod.__doc__ = method.__doc__
+    return timedMethod
+
+def timedStage(cls, methods=("preprocess", "process", "postprocess")):
+    """
+    return a subclass of the given Stage class whose methods are timed
+    @param cls       the Stage class to time
+    @param methods   the names of the methods to time
+    """
+    attrs = { "__doc__": cls.__doc__, "__module__": __name__ }
+    for name in methods:
+        if hasattr(cls, name):
+            attrs[name] = timed(getattr(cls, name).im_func)
+    return type(cls.__name__, (cls,), attrs)
+
+def percentile(values, frac):
+    """
+    return the value at the given fraction of a sorted list
+    """
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(frac * len(values)))]
+
+class TimingHistogram(object):
+    """
+    a histogram of durations with logarithmically spaced bins, so that
+    memory use does not grow with the number of samples.
+    """
+
+    def __init__(self, binsPerDecade=10, minValue=1.0e-4):
+        self.binsPerDecade = binsPerDecade
+        self.minValue = minValue
+        self.bins = {}
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def _bin(self, value):
+        if value <= self.minValue:
+            return 0
+        return int(math.floor(self.binsPerDecade *
+                              math.log10(value / self.minValue))) + 1
+
+    def binEdges(self, index):
+        """
+        return the (low, high) edges of a bin
+        """
+        if index == 0:
+            return (0.0, self.minValue)
+        return (self.minValue * 10 ** ((index - 1.0) / self.binsPerDecade),
+                self.minValue * 10 ** (float(index) / self.binsPerDecade))
+
+    def add(self, value):
+        b = self._bin(value)
+        self.bins[b] = self.bins.get(b, 0) + 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def mean(self):
+        if not self.count:
+            return 0.0
+        return self.total / self.count
+
+    def quantile(self, frac):
+        """
+        return an estimate of the given quantile: the upper edge of the
+        bin containing it, limited to the largest value seen.
+        """
+        if not self.count:
+            return 0.0
+        target = frac * self.count
+        seen = 0
+        for b in sorted(self.bins.keys()):
+            seen += self.bins[b]
+            if seen >= target:
+                return min(self.binEdges(b)[1], self.max)
+        return self.max
+
+def timingFromRecord(rec):
+    """
+    return the timing properties of a log archive record (see
+    LogArchive.recordFromEvent) as a dictionary, or None if the record is
+    not a timing message.  The sliceId, hostId and runId of the message are
+    included.
+    """
+    if rec.get("LOG") != TIMING_LOG:
+        return None
+    props = rec.get("PROPS") or {}
+    if not props.has_key("wallTime"):
+        return None
+    out = dict(props)
+    out["sliceId"] = rec.get("sliceId", -1)
+    out["hostId"] = rec.get("hostId", "")
+    out["runId"] = rec.get("runId", "")
+    out["pipeline"] = rec.get("pipeline", "")
+    return out
+
+class StageTimingAggregator(object):
+    """
+    collect timing messages into per-stage histograms
+    """
+
+    def __init__(self):
+        self.wall = {}
+        self.cpu = {}
+        self.failed = {}
+
+    def add(self, timing):
+        """
+        add the timing dictionary returned by timingFromRecord()
+        """
+        key = (timing.get("stageIndex", -1), timing.get("stage", ""),
+               timing.get("method", ""))
+        if not self.wall.has_key(key):
+            self.wall[key] = TimingHistogram()
+            self.cpu[key] = TimingHistogram()
+            self.failed[key] = 0
+        self.wall[key].add(timing["wallTime"])
+        self.cpu[key].add(timing.get("cpuTime", 0.0))
+        if timing.get("status", "ok") != "ok":
+            self.failed[key] += 1
+
+    def keys(self):
+        """
+        return the (stageIndex, stage, method) keys in pipeline order
+        """
+        keys = self.wall.keys()
+        keys.sort()
+        return keys
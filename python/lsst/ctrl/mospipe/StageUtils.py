@@ -0,0 +1,98 @@
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+
+"""
+Helpers shared by the mospipe stages:  the values of the AdditionalData
+entries of a stage policy, locks on files shared by the slices of a node,
+and a stand-in input queue that hands back a clipboard already taken.
+"""
+
+import os, time, errno, fcntl
+
+import lsst.daf.base as dafBase
+
+class FileLock(object):
+    """
+    an flock on a lock file, exclusive unless shared is True
+    """
+    def __init__(self, path, blocking=True, shared=False):
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0666)
+        self.waited = 0.0
+        flags = fcntl.LOCK_EX
+        if shared:
+            flags = fcntl.LOCK_SH
+        try:
+            try:
+                fcntl.flock(self.fd, flags | fcntl.LOCK_NB)
+            except IOError, e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES) or \
+                   not blocking:
+                    raise
+                start = time.time()
+                fcntl.flock(self.fd, flags)
+                self.waited = time.time() - start
+        except:
+            os.close(self.fd)
+            raise
+
+    def release(self):
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
+
+def additionalData(policy, clipboard):
+    """
+    return a PropertySet of the values named by the AdditionalData entries
+    of a stage policy, taken from the clipboard as an InputStage or
+    OutputStage does:  "name=key.property" takes a property of a clipboard
+    item, "name=key" a clipboard item itself
+    """
+    out = dafBase.PropertySet()
+    if not policy.exists("AdditionalData"):
+        return out
+    for spec in policy.getStringArray("AdditionalData"):
+        name, source = [s.strip() for s in spec.split("=", 1)]
+        if "." in source:
+            key, prop = source.split(".", 1)
+            item = clipboard.get(key)
+            if item is not None and item.exists(prop):
+                out.set(name, item.get(prop))
+        elif clipboard.get(source) is not None:
+            out.set(name, clipboard.get(source))
+    return out
+
+class PushbackQueue(object):
+    """
+    a queue whose next dataset is one already taken from another queue
+    """
+    def __init__(self, queue, clipboard):
+        self.queue = queue
+        self.clipboard = clipboard
+
+    def getNextDataset(self):
+        if self.clipboard is not None:
+            clipboard, self.clipboard = self.clipboard, None
+            return clipboard
+        return self.queue.getNextDataset()
+
+    def __getattr__(self, name):
+        return getattr(self.queue, name)
@@ -0,0 +1,326 @@
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+
+"""
+A node-local cache of the input files of a visit.
+
+Rather than having every slice read its raw MEF and calibration frames from
+the shared file system, StagingCacheStage copies each file a visit needs
+into a cache directory on local disk, once per node, and links it into the
+pipeline's input directory.  The cache directory has the same path on every
+node, so the links made by one node are valid on all the others; each slice
+makes sure the files of its visit are in its own node's cache before the
+input stages read them.
+
+Slices on the same node that need a file at the same time serialize on a
+per-file lock (flock), so only the first one copies it and the others wait
+for the copy and then use it.  When the cache holds more than maxBytes, the
+least recently used files that are not being staged are evicted.  The
+hits, copies, waits and evictions of each process are logged to the
+"mospipe.stagingcache" log after every visit.
+
+The files of a visit can only be named once its trigger event is on the
+clipboard, so StagingCacheStage must come after the stage that receives
+the event.  In IP.paf the staging is instead done by the PrefetchInputStage
+that receives it (see PrefetchStages), which also stages the files of
+upcoming visits from their trigger events so that they can be read ahead.
+
+The staging policy (see pipeline/IP/02-stagingCache_policy.paf) gives the
+cache directory and size cap, the AdditionalData used to build file names,
+as with an InputStage, and one Stage entry per source directory:
+
+    Stage: {
+        sourcePath: /data/CFHTLS_Deep/D4
+        destPath: %(input)/raw
+        file: "%(exposureId).fits"
+    }
+"""
+
+import os, time, shutil, thread
+
+import lsst.daf.base as dafBase
+import lsst.pex.logging as pexLog
+from lsst.pex.harness.Stage import Stage
+from lsst.ctrl.mospipe.StageTiming import timed
+from lsst.ctrl.mospipe.LogBatching import getLog
+from lsst.ctrl.mospipe.StageUtils import FileLock, additionalData
+
+STAGING_LOG = "mospipe.stagingcache"
+LOCK_SUFFIX = ".lock"
+
+class StagingStats(object):
+    """
+    the counts of cache operations of one process
+    """
+    def __init__(self):
+        self.hits = 0
+        self.copies = 0
+        self.bytesCopied = 0
+        self.copyTime = 0.0
+        self.waits = 0
+        self.waitTime = 0.0
+        self.evictions = 0
+        self.bytesEvicted = 0
+
+    def propertySet(self):
+        props = dafBase.PropertySet()
+        for name in ("hits", "copies", "waits", "evictions"):
+            props.setInt(name, getattr(self, name))
+        for name in ("bytesCopied", "bytesEvicted"):
+            props.setLongLong(name, long(getattr(self, name)))
+        props.setDouble("copyTime", self.copyTime)
+        props.setDouble("waitTime", self.waitTime)
+        return props
+
+class StagingCache(object):
+    """
+    a size-capped, least-recently-used cache of copies of shared files in
+    a local directory
+    """
+
+    def __init__(self, cacheDir, maxBytes=None):
+        """
+        @param cacheDir  the local cache directory
+        @param maxBytes  the size above which files are evicted; None for
+                           no limit
+        """
+        self.cacheDir = cacheDir
+        self.maxBytes = maxBytes
+        self.stats = StagingStats()
+        if not os.path.isdir(cacheDir):
+            try:
+                os.makedirs(cacheDir)
+            except OSError:
+                if not os.path.isdir(cacheDir):
+                    raise
+
+    def cachePath(self, source):
+        """
+        return the path of the cached copy of a source file
+        """
+        return os.path.join(self.cacheDir,
+                            os.path.abspath(source).lstrip(os.sep))
+
+    def _isCurrent(self, cached, st):
+        try:
+            cst = os.stat(cached)
+        except OSError:
+            return False
+        return cst.st_size == st.st_size and \
+               int(cst.st_mtime) == int(st.st_mtime)
+
+    def stage(self, source):
+        """
+        make sure the cache holds a current copy of a source file
+        @return the path of the copy
+        """
+        cached = self.cachePath(source)
+        dirname = os.path.dirname(cached)
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                if not os.path.isdir(dirname):
+                    raise
+
+        st = os.stat(source)
+        lock = FileLock(cached + LOCK_SUFFIX)
+        try:
+            if lock.waited > 0:
+                self.stats.waits += 1
+                self.stats.waitTime += lock.waited
+            if self._isCurrent(cached, st):
+                self.stats.hits += 1
+            else:
+                start = time.time()
+                tmp = "%s.tmp%d" % (cached, os.getpid())
+                shutil.copyfile(source, tmp)
+                os.utime(tmp, (time.time(), st.st_mtime))
+                os.rename(tmp, cached)
+                self.stats.copies += 1
+                self.stats.bytesCopied += st.st_size
+                self.stats.copyTime += time.time() - start
+            # the access time records the last use, for eviction
+            os.utime(cached, (time.time(), st.st_mtime))
+        finally:
+            lock.release()
+        return cached
+
+    def _files(self):
+        out = []
+        for dirpath, dirnames, filenames in os.walk(self.cacheDir):
+            for name in filenames:
+                if name.endswith(LOCK_SUFFIX) or ".tmp" in name:
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                out.append((st.st_atime, st.st_size, path))
+        return out
+
+    def evict(self, keep=()):
+        """
+        remove the least recently used files until the cache is within
+        maxBytes, sparing the given paths and files being staged
+        @return the number of files removed
+        """
+        if self.maxBytes is None:
+            return 0
+        lock = FileLock(os.path.join(self.cacheDir, "evict" + LOCK_SUFFIX))
+        try:
+            files = self._files()
+            total = sum([f[1] for f in files])
+            if total <= self.maxBytes:
+                return 0
+            files.sort()
+            keep = set(keep)
+            removed = 0
+            for atime, size, path in files:
+                if total <= self.maxBytes:
+                    break
+                if path in keep:
+                    continue
+                try:
+                    fileLock = FileLock(path + LOCK_SUFFIX, False)
+                except IOError:
+                    # being staged by another slice
+                    continue
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                fileLock.release()
+                total -= size
+                removed += 1
+                self.stats.evictions += 1
+                self.stats.bytesEvicted += size
+            return removed
+        finally:
+            lock.release()
+
+def _link(target, linkPath):
+    """
+    make linkPath a symbolic link to target, atomically replacing anything
+    already there
+    """
+    try:
+        if os.readlink(linkPath) == target:
+            return
+    except OSError:
+        pass
+    dirname = os.path.dirname(linkPath)
+    if os.path.islink(dirname):
+        # a directory link left by SymLinkStage; the links go in a real
+        # directory instead
+        try:
+            os.remove(dirname)
+        except OSError:
+            pass
+    if not os.path.isdir(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError:
+            if not os.path.isdir(dirname):
+                raise
+    # a prefetch thread may link the same file as the stage itself
+    tmp = "%s.link%d.%d" % (linkPath, os.getpid(), thread.get_ident())
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    os.symlink(target, tmp)
+    os.rename(tmp, linkPath)
+
+def getCache(policy):
+    """
+    return a StagingCache with the cache directory and size cap of a
+    staging policy
+    """
+    maxBytes = None
+    if policy.exists("maxBytes"):
+        maxBytes = long(policy.get("maxBytes"))
+    return StagingCache(policy.getString("cacheDir"), maxBytes)
+
+def stageFiles(cache, policy, clipboard):
+    """
+    stage the files named by the Stage entries of a staging policy into a
+    cache and link them into their destination directories
+    @param cache      the StagingCache
+    @param policy     the staging policy
+    @param clipboard  the clipboard, or anything with a get(key) method,
+                        holding the items named by the AdditionalData
+    @return the paths of the cached copies
+    """
+    import lsst.daf.persistence as dafPersist
+
+    data = additionalData(policy, clipboard)
+
+    def location(template):
+        return dafPersist.LogicalLocation(template, data).locString()
+
+    staged = []
+    for entry in policy.getPolicyArray("Stage"):
+        sourcePath = location(entry.getString("sourcePath"))
+        destPath = location(entry.getString("destPath"))
+        for name in entry.getStringArray("file"):
+            name = location(name)
+            cached = cache.stage(os.path.join(sourcePath, name))
+            _link(cached, os.path.join(destPath, name))
+            staged.append(cached)
+    return staged
+
+def logStats(log, cache, staged):
+    """
+    log the files just staged and the running counts of a cache
+    """
+    stats = cache.stats
+    log.log(pexLog.Log.INFO,
+            "staged %d files: %d hits, %d copies, %d evictions" %
+            (len(staged), stats.hits, stats.copies, stats.evictions),
+            stats.propertySet())
+
+class StagingCacheStage(Stage):
+    '''Stage the input files of each visit into a node-local cache and
+    link them into the input directory.'''
+
+    def __init__(self, stageId=-1, stagePolicy=None):
+        Stage.__init__(self, stageId, stagePolicy)
+        self.log = getLog(STAGING_LOG)
+        self.cache = None
+
+    def _getCache(self):
+        if self.cache is None:
+            self.cache = getCache(self._policy)
+        return self.cache
+
+    @timed
+    def process(self):
+        """
+        Stage this visit's files and link them into the input directory.
+        """
+        clipboard = self.inputQueue.getNextDataset()
+        cache = self._getCache()
+        staged = stageFiles(cache, self._policy, clipboard)
+        cache.evict(staged)
+        logStats(self.log, cache, staged)
+        self.outputQueue.addDataset(clipboard)
@@ -0,0 +1,436 @@
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+"""
+Startup phases and heartbeats of pipeline processes.
+
+Each pipeline process (the master and every slice) reports its progress
+through startup to the "mospipe.startup" log at INFO level, so that the
+messages reach the event broker without trace-level logging.  Each message
+carries these properties:
+
+    phase         the phase reached (see PHASES) or "heartbeat"
+    phaseTime     when it was reached (seconds since the epoch)
+    processStart  when the process started
+    pid           the process ID
+
+The first three phases are reported by SliceInfoStage, the first stage of
+the pipeline: "stagesConstructed" when it first runs, which the harness
+only does once every stage has been constructed and initialized.
+"firstEvent" is reported by the timed() wrapper of StageTiming when a
+stage first sees a clipboard carrying a trigger event.  Until then, each
+process also sends a heartbeat every few seconds.
+
+No stage runs between the moment the harness subscribes to a stage's
+event topic and the moment it starts waiting for the event, so the
+"eventwait" phase cannot be reported from here:  it is taken from the
+harness's own trace-level eventwait message, and a pipeline only counts as
+ready once its master has sent that message.  Until then, visit triggers
+published to the (non-durable) trigger topic could be lost, so readiness
+can only be tracked if that message is logged:  either the pipeline logs
+at trace level, or (as the IP pipelines do) its SliceInfoStage policy
+keeps just the handleEvents log at trace through a logThresholds entry
+(see eventwaitLogged()).
+
+StartupTracker gathers these messages on the receiving end; launchMospipe
+uses it to decide when the pipelines are ready, to notice processes that
+stop sending heartbeats or never start (the master and the slices a
+pipeline policy calls for, see expectedSlices()), and to report how long
+each phase took.
+"""
+
+import os, time, threading
+
+import lsst.daf.base as dafBase
+import lsst.pex.logging as pexLog
+from lsst.ctrl.mospipe.LogSampling import logThresholdsFromPolicy
+from lsst.ctrl.mospipe.CapacityPlanner import sliceCount
+
+STARTUP_LOG = "mospipe.startup"
+EVENTWAIT_LOG = "harness.pipeline.visit.stage.handleEvents.eventwait"
+
+# phases in the order they are reached
+PHASES = ("policyLoaded", "mpiUp", "stagesConstructed", "eventwait",
+          "firstEvent")
+HEARTBEAT = "heartbeat"
+
+# the threshold at or below which the harness sends its eventwait message
+EVENTWAIT_THRESHOLD = -1
+
+def _processStartTime():
+    """
+    return the time this process started, or the current time if that
+    cannot be determined.
+    """
+    try:
+        btime = None
+        for line in open("/proc/stat"):
+            if line.startswith("btime"):
+                btime = int(line.split()[1])
+        stat = open("/proc/self/stat").read()
+        # the command name may contain spaces; fields resume after ')'
+        fields = stat[stat.rindex(")") + 2:].split()
+        ticks = float(fields[19])
+        return btime + ticks / os.sysconf("SC_CLK_TCK")
+    except Exception:
+        return time.time()
+
+class StartupReporter(object):
+    """
+    report the startup phases of this process to the startup log
+    """
+
+    def __init__(self, log=None):
+        if log is None:
+            log = pexLog.Log(pexLog.Log.getDefaultLog(), STARTUP_LOG)
+        self.log = log
+        self.processStart = _processStartTime()
+        self.reached = {}
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._heartbeat = None
+
+    def phase(self, name, when=None):
+        """
+        report that the given phase has been reached; only the first
+        report of each phase is sent.
+        @param name   the phase
+        @param when   when it was reached; by default, now
+        """
+        if when is None:
+            when = time.time()
+        self._lock.acquire()
+        try:
+            if self.reached.has_key(name):
+                return
+            self.reached[name] = when
+        finally:
+            self._lock.release()
+        self._send(name, self.reached[name])
+        if name == "firstEvent":
+            self.stopHeartbeat()
+
+    def _send(self, name, when):
+        props = dafBase.PropertySet()
+        props.setString("phase", name)
+        props.setDouble("phaseTime", when)
+        props.setDouble("processStart", self.processStart)
+        props.setInt("pid", os.getpid())
+        self.log.log(pexLog.Log.INFO, "startup %s after %.1f s" %
+                     (name, when - self.processStart), props)
+
+    def startHeartbeat(self, interval=5.0):
+        """
+        send a heartbeat every interval seconds until the first event
+        arrives (or stopHeartbeat() is called)
+        """
+        if self._heartbeat is not None or self.reached.has_key("firstEvent"):
+            return
+        self._stopping.clear()
+        self._heartbeat = threading.Thread(target=self._beat,
+                                           args=(interval,),
+                                           name="startup-heartbeat")
+        self._heartbeat.setDaemon(True)
+        self._heartbeat.start()
+
+    def _beat(self, interval):
+        while True:
+            self._stopping.wait(interval)
+            if self._stopping.isSet():
+                break
+            self._send(HEARTBEAT, time.time())
+
+    def stopHeartbeat(self):
+        self._stopping.set()
+        self._heartbeat = None
+
+def eventwaitLogged(config):
+    """
+    return True if the logThresholds of a pipeline's stage policies let
+    the harness's eventwait message through, whatever the pipeline's own
+    verbosity
+    @param config   the pipeline policy, or its execute policy
+    """
+    if config.exists("execute"):
+        config = config.getPolicy("execute")
+    if not config.exists("appStage"):
+        return False
+    threshold, longest = None, -1
+    for stage in config.getPolicyArray("appStage"):
+        if not stage.exists("stagePolicy"):
+            continue
+        stagePolicy = stage.getPolicy("stagePolicy")
+        if not stagePolicy.exists("logThresholds"):
+            continue
+        for name, thresh in logThresholdsFromPolicy(
+                                   stagePolicy.getPolicy("logThresholds")):
+            # the most specific entry wins, as in pex_logging
+            if (name == EVENTWAIT_LOG or
+                EVENTWAIT_LOG.startswith(name + ".")) and len(name) > longest:
+                threshold, longest = thresh, len(name)
+    return threshold is not None and threshold <= EVENTWAIT_THRESHOLD
+
+def expectedSlices(config):
+    """
+    return the number of slices a pipeline is launched with, from the
+    geometry (nAmps x nCcds) of its SliceInfoStage policy, or None if the
+    policy does not fix it (as in work-queue mode)
+    @param config   the pipeline policy, or its execute policy
+    """
+    return sliceCount(config, None)
+
+_reporter = None
+
+def getReporter():
+    """
+    return the StartupReporter for this process
+    """
+    global _reporter
+    if _reporter is None:
+        _reporter = StartupReporter()
+    return _reporter
+
+class ProcessStartup(object):
+    """
+    the startup progress of one pipeline process
+    """
+    def __init__(self, sliceId, hostId):
+        self.sliceId = sliceId
+        self.hostId = hostId
+        self.processStart = None
+        self.phases = {}
+        self.lastHeard = None
+
+    def isMaster(self):
+        return self.sliceId < 0
+
+    def latestPhase(self):
+        """
+        return the latest phase reached, or None
+        """
+        latest = None
+        for name in PHASES:
+            if self.phases.has_key(name):
+                latest = name
+        return latest
+
+class PipelineStartup(object):
+    """
+    the startup progress of one pipeline
+    """
+    def __init__(self, name):
+        self.name = name
+        self.processes = {}
+        self.readyTime = None
+
+    def process(self, sliceId, hostId):
+        key = (sliceId, hostId)
+        if not self.processes.has_key(key):
+            self.processes[key] = ProcessStartup(sliceId, hostId)
+        return self.processes[key]
+
+def describeSlice(sliceId):
+    """
+    return "master" or "slice N" for a sliceId
+    """
+    if sliceId < 0:
+        return "master"
+    return "slice %d" % sliceId
+
+class StartupTracker(object):
+    """
+    follow the startup of a set of pipelines from their log messages
+    """
+
+    def __init__(self, pipelines, runId, heartbeatTimeout=30, launchTime=None,
+                 startTimeout=300, slices=None):
+        """
+        @param pipelines         the names of the pipelines to follow
+        @param runId             the run ID of the pipelines
+        @param heartbeatTimeout  the seconds without a message after which
+                                   a process that is not ready is
+                                   considered hung
+        @param launchTime        when the pipelines were launched
+        @param startTimeout      the seconds after launch by which every
+                                   expected process should have been
+                                   heard from
+        @param slices            the number of slices of each pipeline, by
+                                   name, where known (see expectedSlices());
+                                   the master is always expected
+        """
+        self.runId = runId
+        self.heartbeatTimeout = heartbeatTimeout
+        self.startTimeout = startTimeout
+        if launchTime is None:
+            launchTime = time.time()
+        self.launchTime = launchTime
+        self.pipelines = {}
+        self.slices = {}
+        for name in pipelines:
+            self.pipelines[name] = PipelineStartup(name)
+            if slices:
+                self.slices[name] = slices.get(name)
+
+    def add(self, event, now=None):
+        """
+        account for a message received on the logging topic
+        @return bool   True if the message was relevant to startup
+        """
+        if now is None:
+            now = time.time()
+        if event.getString("runId", "") != self.runId:
+            return False
+        pipeline = self.pipelines.get(event.getString("pipeline", ""))
+        if pipeline is None:
+            return False
+
+        proc = pipeline.process(event.getInt("sliceId", -1),
+                                event.getString("hostId", ""))
+        proc.lastHeard = now
+        logname = event.getString("LOG", "")
+        if logname == STARTUP_LOG:
+            phase = event.getString("phase", "")
+            if event.exists("processStart"):
+                proc.processStart = event.getDouble("processStart")
+            if phase != HEARTBEAT and not proc.phases.has_key(phase):
+                when = now
+                if event.exists("phaseTime"):
+                    when = event.getDouble("phaseTime")
+                proc.phases[phase] = when
+            return True
+        if logname == EVENTWAIT_LOG and \
+           event.getString("STATUS", "") == "start":
+            # the harness has subscribed to the trigger topic
+            if not proc.phases.has_key("eventwait"):
+                proc.phases["eventwait"] = now
+            if pipeline.readyTime is None:
+                pipeline.readyTime = now
+            return True
+        return False
+
+    def waitingFor(self):
+        """
+        return the names of the pipelines that are not yet ready
+        """
+        return [name for name, p in self.pipelines.items()
+                     if p.readyTime is None]
+
+    def hung(self, now=None):
+        """
+        return the (pipeline name, ProcessStartup) of the processes of
+        pipelines not yet ready that have not been heard from within the
+        heartbeat timeout
+        """
+        if now is None:
+            now = time.time()
+        out = []
+        for name, pipeline in self.pipelines.items():
+            if pipeline.readyTime is not None:
+                continue
+            for proc in pipeline.processes.values():
+                if now - proc.lastHeard > self.heartbeatTimeout:
+                    out.append((name, proc))
+        return out
+
+    def notHeardFrom(self, name):
+        """
+        return the sliceIds (-1 for the master) of the expected processes
+        of a pipeline that have not been heard from
+        """
+        heard = {}
+        for proc in self.pipelines[name].processes.values():
+            heard[proc.sliceId] = True
+        expected = [-1]
+        if self.slices.get(name) is not None:
+            expected += range(self.slices[name])
+        return [s for s in expected if not heard.has_key(s)]
+
+    def missing(self, now=None):
+        """
+        return the (pipeline name, sliceId) of the expected processes of
+        pipelines not yet ready that have not been heard from within the
+        start timeout of the launch
+        """
+        if now is None:
+            now = time.time()
+        if now - self.launchTime <= self.startTimeout:
+            return []
+        out = []
+        for name, pipeline in self.pipelines.items():
+            if pipeline.readyTime is None:
+                out += [(name, s) for s in self.notHeardFrom(name)]
+        return out
+
+    def report(self):
+        """
+        return a list of lines describing, for each pipeline, how many
+        processes reached each phase and how long after launch the first
+        and last of them did so, and which process was slowest; for the
+        pipelines not yet ready, which expected processes were never heard
+        from and the last phase of the others.
+        """
+        lines = []
+        names = self.pipelines.keys()
+        names.sort()
+        for name in names:
+            pipeline = self.pipelines[name]
+            procs = pipeline.processes.values()
+            state = "not ready"
+            if pipeline.readyTime is not None:
+                state = "ready after %.1f s" % \
+                        (pipeline.readyTime - self.launchTime)
+            lines.append("%s: %d processes heard from; %s" %
+                         (name, len(procs), state))
+            if pipeline.readyTime is None:
+                silent = self.notHeardFrom(name)
+                if silent:
+                    lines.append("  not heard from: " +
+                                 ", ".join([describeSlice(s) for s in silent]))
+            if not procs:
+                continue
+
+            starts = [p.processStart for p in procs
+                                     if p.processStart is not None]
+            if starts:
+                lines.append("  %-18s %3d  first %7.1f s  last %7.1f s" %
+                             ("processStart", len(starts),
+                              min(starts) - self.launchTime,
+                              max(starts) - self.launchTime))
+            for phase in PHASES:
+                times = [(p.phases[phase], p) for p in procs
+                                              if p.phases.has_key(phase)]
+                if not times:
+                    continue
+                times.sort()
+                slowest = times[-1][1]
+                lines.append("  %-18s %3d  first %7.1f s  last %7.1f s  (slowest: slice %d on %s)" %
+                             (phase, len(times),
+                              times[0][0] - self.launchTime,
+                              times[-1][0] - self.launchTime,
+                              slowest.sliceId, slowest.hostId))
+            if pipeline.readyTime is None:
+                procs.sort(lambda a, b: cmp((a.hostId, a.sliceId),
+                                            (b.hostId, b.sliceId)))
+                for p in procs:
+                    lines.append("  slice %d on %s: last phase %s" %
+                                 (p.sliceId, p.hostId, p.latestPhase()))
+        return lines
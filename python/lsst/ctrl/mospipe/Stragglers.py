@@ -0,0 +1,192 @@
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+"""
+Detection of slow slices and hosts from stage timing messages.
+
+Every stage ends at a barrier:  no slice starts the next stage until all
+have finished this one.  For each (exposure, stage) pair the detector
+compares the end times reported by the slices (see StageTiming).  A slice
+whose end time falls in the tail of the group is counted as being in the
+tail; the slowest slice of the group is charged with the time the whole
+pipeline waited for it, i.e. the difference between its end time and that
+of the next slowest slice.  Slices and hosts that are in the tail much more
+often than chance would suggest are flagged as stragglers.
+"""
+
+import time
+
+class SliceStats(object):
+    """
+    the accumulated tail statistics of one slice or host
+    """
+    def __init__(self, name):
+        self.name = name
+        self.groups = 0
+        self.inTail = 0
+        self.slowest = 0
+        self.lostTime = 0.0
+        self.totalLag = 0.0
+        # stageIndex -> [stage name, lost time]
+        self.byStage = {}
+
+    def tailRate(self):
+        if not self.groups:
+            return 0.0
+        return float(self.inTail) / self.groups
+
+    def meanLag(self):
+        if not self.groups:
+            return 0.0
+        return self.totalLag / self.groups
+
+class StragglerDetector(object):
+    """
+    track per-(stage, slice) completion times and attribute barrier
+    waits to the slices and hosts that cause them.
+    """
+
+    def __init__(self, nSlices=None, tailFraction=0.1, minLag=0.5,
+                 settleTime=60.0):
+        """
+        @param nSlices       the number of slices; if given, a stage's group
+                               is analyzed as soon as all slices report
+        @param tailFraction  the fraction of each group's slices (at least
+                               one) considered to be in the tail
+        @param minLag        a slice must end at least this many seconds
+                               after the group median to count as in the tail
+        @param settleTime    otherwise, analyze a group once no timing has
+                               arrived for it in this many seconds
+        """
+        self.nSlices = nSlices
+        self.tailFraction = tailFraction
+        self.minLag = minLag
+        self.settleTime = settleTime
+        # (exposureId, stageIndex) -> [stage name, last update,
+        #                              {sliceId: (hostId, end time)}]
+        self.pending = {}
+        self.slices = {}
+        self.hosts = {}
+        self.groupsAnalyzed = 0
+        self.totalLost = 0.0
+
+    def addTiming(self, timing, now=None):
+        """
+        record a stage timing (as returned by StageTiming.timingFromRecord);
+        only process() timings from slices are used.
+        """
+        if timing.get("method") != "process" or \
+           timing.get("exposureId") is None:
+            return
+        if now is None:
+            now = time.time()
+        key = (timing["exposureId"], timing.get("stageIndex", -1))
+        if not self.pending.has_key(key):
+            self.pending[key] = [timing.get("stage", ""), now, {}]
+        group = self.pending[key]
+        group[1] = now
+        group[2][timing.get("sliceId", -1)] = (timing.get("hostId", ""),
+                                               timing["endTime"])
+
+    def collect(self, now=None, flush=False):
+        """
+        analyze the groups that are complete
+        @param now     the current time
+        @param flush   if True, analyze all pending groups
+        @return int    the number of groups analyzed
+        """
+        if now is None:
+            now = time.time()
+        count = 0
+        for key, group in self.pending.items():
+            done = flush or now - group[1] >= self.settleTime
+            if self.nSlices is not None and len(group[2]) >= self.nSlices:
+                done = True
+            if done:
+                del self.pending[key]
+                self._analyze(key[1], group[0], group[2])
+                count += 1
+        return count
+
+    def _stats(self, table, name):
+        if not table.has_key(name):
+            table[name] = SliceStats(name)
+        return table[name]
+
+    def _analyze(self, stageIndex, stageName, ends):
+        if len(ends) < 2:
+            return
+        ordered = [(end, sliceId, host) for sliceId, (host, end)
+                                        in ends.items()]
+        ordered.sort()
+        median = ordered[len(ordered) // 2][0]
+        ntail = max(1, int(round(self.tailFraction * len(ordered))))
+        tail = set([o[1] for o in ordered[-ntail:]
+                         if o[0] - median >= self.minLag])
+        lost = ordered[-1][0] - ordered[-2][0]
+
+        self.groupsAnalyzed += 1
+        self.totalLost += lost
+        for end, sliceId, host in ordered:
+            for stats in (self._stats(self.slices, sliceId),
+                          self._stats(self.hosts, host)):
+                stats.groups += 1
+                stats.totalLag += end - median
+                if sliceId in tail:
+                    stats.inTail += 1
+
+        end, sliceId, host = ordered[-1]
+        for stats in (self._stats(self.slices, sliceId),
+                      self._stats(self.hosts, host)):
+            stats.slowest += 1
+            stats.lostTime += lost
+            entry = stats.byStage.setdefault(stageIndex, [stageName, 0.0])
+            entry[1] += lost
+
+    def stragglers(self, table=None, minGroups=5, flagRate=None):
+        """
+        return the SliceStats of the slices (or hosts) that are in the
+        tail consistently, worst first.
+        @param table      self.slices or self.hosts (default: slices)
+        @param minGroups  ignore entries seen in fewer groups than this
+        @param flagRate   the tail rate above which an entry is flagged;
+                            by default, three times the tail fraction
+        """
+        if table is None:
+            table = self.slices
+        if flagRate is None:
+            flagRate = min(0.9, 3 * self.tailFraction)
+        out = [s for s in table.values()
+                 if s.groups >= minGroups and s.tailRate() >= flagRate]
+        out.sort(lambda a, b: cmp(b.lostTime, a.lostTime))
+        return out
+
+    def ranked(self, table=None):
+        """
+        return all SliceStats of the slices (or hosts) ordered by the
+        barrier time attributed to them, worst first.
+        """
+        if table is None:
+            table = self.slices
+        out = table.values()
+        out.sort(lambda a, b: cmp(b.lostTime, a.lostTime))
+        return out
@@ -24,8 +24,10 @@ from lsst.pex.harness.Stage import Stage
 from lsst.pex.harness import Utils
 from lsst.daf.persistence import LogicalLocation
 import lsst.afw.image as afwImage
+from lsst.ctrl.mospipe.StageTiming import timed
 
 class TemplateDimensionStage(Stage):
+    @timed
     def process(self):
         clipboard = self.inputQueue.getNextDataset()
 
@@ -0,0 +1,44 @@
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+"""
+Timed versions of the non-mospipe stages used by the IP pipeline.  Each
+class behaves exactly like the stage of the same name in its original
+package, but reports its timing to the "mospipe.timing" log (see
+StageTiming).
+"""
+
+from lsst.ctrl.mospipe.StageTiming import timedStage
+
+import lsst.pex.harness.IOStage
+import lsst.pex.harness.SymLinkStage
+import lsst.ip.isr
+import lsst.meas.pipeline
+
+InputStage = timedStage(lsst.pex.harness.IOStage.InputStage)
+OutputStage = timedStage(lsst.pex.harness.IOStage.OutputStage)
+SymLinkStage = timedStage(lsst.pex.harness.SymLinkStage.SymLinkStage)
+IsrStage = timedStage(lsst.ip.isr.IsrStage)
+SourceDetectionStage = timedStage(lsst.meas.pipeline.SourceDetectionStage)
+SourceMeasurementStage = timedStage(lsst.meas.pipeline.SourceMeasurementStage)
+PsfDeterminationStage = timedStage(lsst.meas.pipeline.PsfDeterminationStage)
+WcsDeterminationStage = timedStage(lsst.meas.pipeline.WcsDeterminationStage)
@@ -0,0 +1,245 @@
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+"""
+End-to-end latency of visits through the pipeline.
+
+The latency of an exposure is measured from the moment its trigger event
+was published (the publishTime property set by eventFromFitsfile) to the
+moment the last stage finished on the slowest slice, as reported by the
+stage timing messages (see StageTiming), which are joined to the trigger
+on exposureId.
+"""
+
+import time
+
+from lsst.ctrl.mospipe.StageTiming import percentile
+
+class VisitRecord(object):
+    """
+    the timing information gathered for one exposure
+    """
+    def __init__(self, exposureId):
+        self.exposureId = exposureId
+        self.publishTime = None
+        self.runId = None
+        self.firstStart = None
+        self.lastEnd = None
+        self.lastActivity = None
+        # stageIndex -> [stage name, latest end time, longest wall time,
+        #                set of slices]
+        self.stages = {}
+
+    def addTiming(self, timing):
+        idx = timing.get("stageIndex", -1)
+        if not self.stages.has_key(idx):
+            self.stages[idx] = [timing.get("stage", ""), None, 0.0, set()]
+        stage = self.stages[idx]
+        end = timing["endTime"]
+        if stage[1] is None or end > stage[1]:
+            stage[1] = end
+        stage[2] = max(stage[2], timing["wallTime"])
+        if timing.get("method") == "process":
+            stage[3].add(timing.get("sliceId", -1))
+
+        start = timing.get("startTime", end - timing["wallTime"])
+        if self.firstStart is None or start < self.firstStart:
+            self.firstStart = start
+        if self.lastEnd is None or end > self.lastEnd:
+            self.lastEnd = end
+        if self.runId is None:
+            self.runId = timing.get("runId")
+
+    def latency(self):
+        """
+        return the time from publication of the trigger to the end of the
+        last stage, or None if the publication time is unknown.
+        """
+        if self.publishTime is None or self.lastEnd is None:
+            return None
+        return self.lastEnd - self.publishTime
+
+    def processingTime(self):
+        """
+        return the time from the start of the first stage to the end of
+        the last stage.
+        """
+        if self.firstStart is None:
+            return None
+        return self.lastEnd - self.firstStart
+
+    def stageBreakdown(self):
+        """
+        return a list of (stageIndex, stage name, barrier time, longest
+        wall time) in pipeline order, where the barrier time is the time
+        between the previous stage's and this stage's latest end times.
+        The first stage is measured from publication (or from the first
+        stage start if that is unknown).
+        """
+        out = []
+        prev = self.publishTime
+        if prev is None:
+            prev = self.firstStart
+        for idx in sorted(self.stages.keys()):
+            name, end, wall, slices = self.stages[idx]
+            out.append((idx, name, end - prev, wall))
+            prev = end
+        return out
+
+class VisitLatencyTracker(object):
+    """
+    join trigger events and stage timings into per-visit latencies
+    """
+
+    def __init__(self, nSlices=None, lastStage=None, settleTime=60.0,
+                 triggerAge=3600.0, maxTriggers=1000):
+        """
+        @param nSlices     the number of slices in the pipeline.  If given
+                             along with lastStage, a visit is complete as
+                             soon as all slices have reported on the last
+                             stage.
+        @param lastStage   the stageIndex of the last stage of the pipeline
+        @param settleTime  otherwise, a visit is complete once no timing
+                             has arrived for it in this many seconds
+        @param triggerAge  the seconds a visit with a trigger but no timing
+                             is kept; a backlogged pipeline may not start
+                             on a visit for a long time after its trigger
+        @param maxTriggers the most visits with a trigger but no timing
+                             kept; beyond that, the oldest are dropped
+        """
+        self.nSlices = nSlices
+        self.lastStage = lastStage
+        self.settleTime = settleTime
+        self.triggerAge = triggerAge
+        self.maxTriggers = maxTriggers
+        self.active = {}
+        self.done = []
+        # the number of triggers dropped without any timing
+        self.expired = 0
+
+    def _visit(self, exposureId, now):
+        if not self.active.has_key(exposureId):
+            self.active[exposureId] = VisitRecord(exposureId)
+        visit = self.active[exposureId]
+        visit.lastActivity = now
+        return visit
+
+    def addTrigger(self, exposureId, publishTime, now=None):
+        """
+        record the publication of a trigger event
+        """
+        if now is None:
+            now = time.time()
+        self._visit(exposureId, now).publishTime = publishTime
+
+    def addTiming(self, timing, now=None):
+        """
+        record a stage timing (as returned by StageTiming.timingFromRecord)
+        """
+        if timing.get("exposureId") is None:
+            return
+        if now is None:
+            now = time.time()
+        self._visit(timing["exposureId"], now).addTiming(timing)
+
+    def _isComplete(self, visit, now):
+        if self.nSlices is not None and self.lastStage is not None:
+            stage = visit.stages.get(self.lastStage)
+            if stage is not None and len(stage[3]) >= self.nSlices:
+                return True
+        return visit.lastEnd is not None and \
+               now - visit.lastActivity >= self.settleTime
+
+    def collect(self, now=None, flush=False):
+        """
+        move the visits that have completed to the done list; visits that
+        have had a trigger but no timing for triggerAge seconds, or the
+        oldest of them beyond maxTriggers, are dropped
+        @param now     the current time
+        @param flush   if True, consider all visits with any timing complete
+        @return list   the newly completed VisitRecords
+        """
+        if now is None:
+            now = time.time()
+        out = []
+        waiting = []
+        for exposureId, visit in self.active.items():
+            if visit.lastEnd is None:
+                if now - visit.lastActivity >= self.triggerAge:
+                    del self.active[exposureId]
+                    self.expired += 1
+                else:
+                    waiting.append((visit.lastActivity, exposureId))
+                continue
+            if flush or self._isComplete(visit, now):
+                out.append(visit)
+                del self.active[exposureId]
+        if len(waiting) > self.maxTriggers:
+            waiting.sort()
+            for lastActivity, exposureId in waiting[:-self.maxTriggers]:
+                del self.active[exposureId]
+                self.expired += 1
+        out.sort(lambda a, b: cmp(a.lastEnd, b.lastEnd))
+        self.done.extend(out)
+        return out
+
+    def summary(self):
+        """
+        return a summary of the completed visits as a dictionary with
+        keys "count", "expired" (triggers never followed by a timing),
+        "latency" and "processing" (each a dictionary of
+        p50, p95, p99, mean and max) and "stages", a list of (stageIndex,
+        stage name, mean barrier time, p95 barrier time, mean wall time).
+        """
+        def stats(values):
+            values = sorted(values)
+            if not values:
+                return None
+            return { "p50": percentile(values, 0.50),
+                     "p95": percentile(values, 0.95),
+                     "p99": percentile(values, 0.99),
+                     "mean": sum(values) / float(len(values)),
+                     "max": values[-1] }
+
+        latencies = [v.latency() for v in self.done
+                                 if v.latency() is not None]
+        processing = [v.processingTime() for v in self.done]
+
+        perStage = {}
+        for visit in self.done:
+            for idx, name, barrier, wall in visit.stageBreakdown():
+                entry = perStage.setdefault(idx, [name, [], []])
+                entry[1].append(barrier)
+                entry[2].append(wall)
+        stages = []
+        for idx in sorted(perStage.keys()):
+            name, barriers, walls = perStage[idx]
+            barriers.sort()
+            stages.append((idx, name, sum(barriers) / float(len(barriers)),
+                           percentile(barriers, 0.95),
+                           sum(walls) / float(len(walls))))
+
+        return { "count": len(self.done),
+                 "expired": self.expired,
+                 "latency": stats(latencies),
+                 "processing": stats(processing),
+                 "stages": stages }